@@ -0,0 +1,279 @@
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+
+from aiohttp import web
+
+# must match diff_planner.BATCH_FILE_MARKER, packed prompts list one file per marker line
+BATCH_FILE_REGEX = re.compile(r'^### FILE: (.+)$', re.MULTILINE)
+
+REVIEW_TEMPLATE = """"Code Score": {score}
+
+"Quality": no issue
+
+"Logic": no issue
+
+"Security": no issue
+"""
+
+
+class ServiceProfile(object):
+    # latency in seconds, rpm 0 means unlimited, error_rate is the share of requests answered with a 5xx
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rpm: float = 0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rpm = rpm
+        self.error_rate = error_rate
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    async def delay(self, extra: float = 0.0):
+        delay = self.latency + extra + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def over_limit(self):
+        # fixed one minute window, enough to exercise the retry paths of the app
+        if not self.rpm:
+            return None
+        now = time.monotonic()
+        if now - self.window_start >= 60:
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+        if self.window_count > self.rpm:
+            return max(0.0, 60 - (now - self.window_start))
+        return None
+
+    def inject_error(self):
+        return self.error_rate and random.random() < self.error_rate
+
+
+def make_patch(push_id: str, filename: str, lines: int):
+    body = [f"+value_{i} = '{push_id}:{filename}:{i}'" for i in range(lines)]
+    return f"@@ -0,0 +1,{lines} @@\n" + "\n".join(body)
+
+
+class FakeServices(object):
+    """GitHub, GitLab and OpenAI stand-ins on one aiohttp server.
+
+    Commits are registered up front with their files, every comment is recorded with its arrival time
+    so the harness can tell when each file of a push got its review.
+    """
+
+    def __init__(self, github: ServiceProfile, gitlab: ServiceProfile, openai: ServiceProfile,
+                 openai_token_latency: float = 0.0):
+        self.github = github
+        self.gitlab = gitlab
+        self.openai = openai
+        self.openai_token_latency = openai_token_latency
+        self.commits = {}
+        self.reviewed = {}
+        self.comments = {}
+        self.next_comment_id = 1
+        self.counters = {}
+        self.runner = None
+
+    def count(self, name: str):
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def add_commit(self, sha: str, files: list):
+        # files: [(filename, patch)]
+        self.commits[sha] = files
+        self.reviewed[sha] = {}
+
+    def record_comment(self, sha: str, body: str):
+        now = time.monotonic()
+        for filename, _ in self.commits.get(sha, []):
+            if f"`{filename}`" in body:
+                self.reviewed[sha].setdefault(filename, now)
+
+    def pending_files(self):
+        return sum(len(files) - len(self.reviewed[sha]) for sha, files in self.commits.items())
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([
+            web.get("/github/repos/{owner}/{repo}/commits/{sha}", self.github_commit),
+            web.get("/github/repos/{owner}/{repo}/compare/{range}", self.github_compare),
+            web.get("/github/repos/{owner}/{repo}/contents/{path:.+}", self.github_content),
+            web.get("/github/repos/{owner}/{repo}/commits/{sha}/comments", self.github_list_comments),
+            web.post("/github/repos/{owner}/{repo}/commits/{sha}/comments", self.github_comment),
+            web.patch("/github/repos/{owner}/{repo}/comments/{id}", self.github_update_comment),
+            web.get("/gitlab/api/v4/projects/{id}/repository/commits/{sha}/diff", self.gitlab_diff),
+            web.get("/gitlab/api/v4/projects/{id}/repository/compare", self.gitlab_compare),
+            web.get("/gitlab/api/v4/projects/{id}/repository/commits/{sha}/comments", self.gitlab_list_comments),
+            web.post("/gitlab/api/v4/projects/{id}/repository/commits/{sha}/comments", self.gitlab_comment),
+            web.post("/openai/v1/chat/completions", self.openai_chat),
+        ])
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def gate(self, name: str, profile: ServiceProfile, rate_limit_response):
+        # common latency, rate limit and error injection, returns a response to send instead or None
+        self.count(f"{name}_requests")
+        await profile.delay()
+        retry_after = profile.over_limit()
+        if retry_after is not None:
+            self.count(f"{name}_rate_limited")
+            return rate_limit_response(retry_after)
+        if profile.inject_error():
+            self.count(f"{name}_errors")
+            return web.json_response({"message": "injected error"}, status=502)
+        return None
+
+    def github_rate_limited(self, retry_after: float):
+        return web.json_response({"message": "API rate limit exceeded"}, status=403,
+                                 headers={"x-ratelimit-remaining": "0",
+                                          "x-ratelimit-reset": str(int(time.time() + retry_after))})
+
+    def gitlab_rate_limited(self, retry_after: float):
+        return web.json_response({"message": "429 Too Many Requests"}, status=429,
+                                 headers={"Retry-After": str(int(retry_after) + 1)})
+
+    def openai_rate_limited(self, retry_after: float):
+        return web.json_response({"error": {"message": "Rate limit reached", "type": "requests"}}, status=429,
+                                 headers={"retry-after": str(int(retry_after) + 1)})
+
+    def github_file(self, filename: str, patch: str):
+        additions = patch.count("\n+")
+        return {"filename": filename, "status": "added", "additions": additions, "deletions": 0,
+                "changes": additions, "patch": patch}
+
+    async def github_commit(self, request):
+        blocked = await self.gate("github", self.github, self.github_rate_limited)
+        if blocked:
+            return blocked
+        files = self.commits.get(request.match_info["sha"])
+        if files is None:
+            return web.json_response({"message": "Not Found"}, status=404)
+        return web.json_response({"sha": request.match_info["sha"],
+                                  "files": [self.github_file(filename, patch) for filename, patch in files]})
+
+    async def github_compare(self, request):
+        blocked = await self.gate("github", self.github, self.github_rate_limited)
+        if blocked:
+            return blocked
+        head = request.match_info["range"].split("...")[-1]
+        files = self.commits.get(head, [])
+        return web.json_response({"commits": [{"sha": head}],
+                                  "files": [self.github_file(filename, patch) for filename, patch in files]})
+
+    async def github_content(self, request):
+        blocked = await self.gate("github", self.github, self.github_rate_limited)
+        if blocked:
+            return blocked
+        path = request.match_info["path"]
+        return web.Response(text="\n".join(f"value_{i} = '{path}:{i}'" for i in range(200)))
+
+    async def github_list_comments(self, request):
+        self.count("github_requests")
+        return web.json_response(self.comments.get(request.match_info["sha"], []))
+
+    async def github_comment(self, request):
+        blocked = await self.gate("github", self.github, self.github_rate_limited)
+        if blocked:
+            return blocked
+        sha = request.match_info["sha"]
+        data = await request.json()
+        comment = {"id": self.next_comment_id, "body": data.get("body", "")}
+        self.next_comment_id += 1
+        self.comments.setdefault(sha, []).append(comment)
+        self.record_comment(sha, comment["body"])
+        self.count("comments")
+        return web.json_response(comment, status=201)
+
+    async def github_update_comment(self, request):
+        blocked = await self.gate("github", self.github, self.github_rate_limited)
+        if blocked:
+            return blocked
+        data = await request.json()
+        return web.json_response({"id": int(request.match_info["id"]), "body": data.get("body", "")})
+
+    def gitlab_diffs(self, sha: str):
+        return [{"old_path": filename, "new_path": filename, "new_file": True, "diff": patch}
+                for filename, patch in self.commits.get(sha, [])]
+
+    async def gitlab_diff(self, request):
+        blocked = await self.gate("gitlab", self.gitlab, self.gitlab_rate_limited)
+        if blocked:
+            return blocked
+        return web.json_response(self.gitlab_diffs(request.match_info["sha"]))
+
+    async def gitlab_compare(self, request):
+        blocked = await self.gate("gitlab", self.gitlab, self.gitlab_rate_limited)
+        if blocked:
+            return blocked
+        return web.json_response({"diffs": self.gitlab_diffs(request.query.get("to", ""))})
+
+    async def gitlab_list_comments(self, request):
+        self.count("gitlab_requests")
+        return web.json_response([{"note": comment["body"]}
+                                  for comment in self.comments.get(request.match_info["sha"], [])])
+
+    async def gitlab_comment(self, request):
+        blocked = await self.gate("gitlab", self.gitlab, self.gitlab_rate_limited)
+        if blocked:
+            return blocked
+        sha = request.match_info["sha"]
+        data = await request.json()
+        self.comments.setdefault(sha, []).append({"id": self.next_comment_id, "body": data.get("note", "")})
+        self.next_comment_id += 1
+        self.record_comment(sha, data.get("note", ""))
+        self.count("comments")
+        return web.json_response({"note": data.get("note", "")}, status=201)
+
+    def answer_for(self, prompt: str):
+        score = int(hashlib.sha1(prompt.encode()).hexdigest(), 16) % 10 + 1
+        filenames = BATCH_FILE_REGEX.findall(prompt)
+        if not filenames:
+            return REVIEW_TEMPLATE.format(score=score)
+        return "\n".join(f"### FILE: {filename}\n{REVIEW_TEMPLATE.format(score=score)}" for filename in filenames)
+
+    async def openai_chat(self, request):
+        blocked = await self.gate("openai", self.openai, self.openai_rate_limited)
+        if blocked:
+            return blocked
+        data = await request.json()
+        prompt = "".join(message.get("content", "") for message in data.get("messages", []))
+        answer = self.answer_for(prompt)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(answer) // 4
+        headers = {"x-ratelimit-limit-requests": str(int(self.openai.rpm or 10000)),
+                   "x-ratelimit-remaining-requests": str(int(self.openai.rpm or 10000)),
+                   "x-ratelimit-limit-tokens": "1000000",
+                   "x-ratelimit-remaining-tokens": "1000000"}
+
+        if not data.get("stream"):
+            await asyncio.sleep(completion_tokens * self.openai_token_latency)
+            return web.json_response({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "model": data.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            }, headers=headers)
+
+        response = web.StreamResponse(headers=dict(headers, **{"Content-Type": "text/event-stream"}))
+        await response.prepare(request)
+        words = re.findall(r'\S+\s*', answer)
+        for word in words:
+            await asyncio.sleep(self.openai_token_latency)
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": data.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import socket
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+import psutil
+
+from fakes import FakeServices, ServiceProfile, make_patch
+
+# replays synthetic pushes against the app wired to local fakes, e.g.
+#   python bench/offline.py --push-sizes 1,10,50 --repeat 5 --openai-latency 0.5 --output bench_output.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "bench"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))
+    return round(values[index], 4)
+
+
+def github_push(repo: str, sha: str, files: list):
+    return {
+        "ref": "refs/heads/main",
+        "before": hashlib.sha1(f"{sha}:parent".encode()).hexdigest(),
+        "after": sha,
+        "repository": {"full_name": repo},
+        "pusher": {"name": "bench"},
+        "commits": [{"id": sha, "message": f"bench push with {len(files)} files",
+                     "author": {"name": "bench", "username": "bench"}}],
+    }
+
+
+def gitlab_push(project_id: int, sha: str, files: list):
+    return {
+        "ref": "refs/heads/main",
+        "before": hashlib.sha1(f"{sha}:parent".encode()).hexdigest(),
+        "after": sha,
+        "project": {"id": project_id},
+        "user_username": "bench",
+        "commits": [{"id": sha, "author": {"name": "bench"}}],
+    }
+
+
+def app_env(args, fake_port: int):
+    origin = f"http://127.0.0.1:{fake_port}"
+    env = dict(os.environ)
+    env.update({
+        "API_KEY": "bench",
+        "OPENAI_API_BASE": f"{origin}/openai/v1",
+        "GITHUB_API_ORIGIN": f"{origin}/github",
+        "GITHUB_API_TOKEN": "bench",
+        "GITHUB_WEBHOOK_SECRET": SECRET,
+        "GITLAB_API_ORIGIN": f"{origin}/gitlab",
+        "GITLAB_API_TOKEN": "bench",
+        "GITLAB_WEBHOOK_SECRET": SECRET,
+        "MONGO_URL": "mongodb://localhost",
+        "REVIEW_QUEUE_BACKEND": args.backend,
+        "REVIEW_CACHE_MONGO": "true" if args.backend == "mongo" else "false",
+        "TEST_APP": "false",
+        "GIT_MIRROR_ENABLED": "false",
+        "PUSH_COALESCE": "false",
+        "PUBLISH_MIN_INTERVAL": "0",
+    })
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app exited with {process.returncode}")
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("app did not start in time")
+
+
+async def sample_memory(pid: int, samples: list, stop: asyncio.Event):
+    process = psutil.Process(pid)
+    while not stop.is_set():
+        try:
+            samples.append(process.memory_info().rss)
+        except psutil.Error:
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def send_webhook(session: aiohttp.ClientSession, app_url: str, source: str, payload: dict):
+    body = json.dumps(payload).encode()
+    delivery_id = str(uuid.uuid4())
+    if source == "gitlab":
+        url = f"{app_url}/gitlab-webhook"
+        headers = {"X-Gitlab-Token": SECRET, "X-Gitlab-Event-UUID": delivery_id}
+    else:
+        url = f"{app_url}/github-webhook"
+        signature = "sha256=" + hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+        headers = {"X-Hub-Signature-256": signature, "X-GitHub-Delivery": delivery_id}
+    headers["Content-Type"] = "application/json"
+    start = time.monotonic()
+    async with session.post(url, data=body, headers=headers) as response:
+        await response.read()
+        return response.status, time.monotonic() - start
+
+
+async def run(args):
+    fakes = FakeServices(
+        github=ServiceProfile(args.github_latency, args.jitter, args.github_rpm, args.error_rate),
+        gitlab=ServiceProfile(args.gitlab_latency, args.jitter, args.gitlab_rpm, args.error_rate),
+        openai=ServiceProfile(args.openai_latency, args.jitter, args.openai_rpm, args.openai_error_rate),
+        openai_token_latency=args.openai_token_latency)
+    fake_port = await fakes.start()
+    app_port = free_port()
+    app_url = f"http://127.0.0.1:{app_port}"
+
+    # the app writes log/logfile.log and reads ./env relative to its working directory
+    workdir = tempfile.mkdtemp(prefix="reviewbot-bench-")
+    os.makedirs(os.path.join(workdir, "log"), exist_ok=True)
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "bench", "run_app.py"), "--port", str(app_port)],
+                               cwd=workdir, env=app_env(args, fake_port))
+
+    memory = []
+    stop_sampling = asyncio.Event()
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_ready(session, f"{app_url}/review-cache/stats", process)
+            sampler = asyncio.create_task(sample_memory(process.pid, memory, stop_sampling))
+
+            sizes = [int(size) for size in args.push_sizes.split(",")] * args.repeat
+            pushes = []
+            for i, size in enumerate(sizes):
+                sha = hashlib.sha1(f"{args.seed}:{i}".encode()).hexdigest()
+                files = [(f"src/pkg{j % 10}/module_{i}_{j}.py", None) for j in range(size)]
+                files = [(filename, make_patch(sha, filename, args.patch_lines)) for filename, _ in files]
+                fakes.add_commit(sha, files)
+                pushes.append((sha, files))
+
+            semaphore = asyncio.Semaphore(args.concurrency)
+            sent_at = {}
+            ack_latencies = []
+            statuses = {}
+
+            async def push(i, sha, files):
+                async with semaphore:
+                    source = args.source if args.source != "both" else ("gitlab" if i % 2 else "github")
+                    payload = gitlab_push(1, sha, files) if source == "gitlab" else github_push("bench/repo", sha, files)
+                    sent_at[sha] = time.monotonic()
+                    status, latency = await send_webhook(session, app_url, source, payload)
+                    ack_latencies.append(latency)
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if args.interval:
+                        await asyncio.sleep(args.interval)
+
+            start = time.monotonic()
+            await asyncio.gather(*[push(i, sha, files) for i, (sha, files) in enumerate(pushes)])
+
+            deadline = time.monotonic() + args.timeout
+            while fakes.pending_files() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            elapsed = time.monotonic() - start
+
+            stop_sampling.set()
+            await sampler
+            async with session.get(f"{app_url}/metrics") as response:
+                app_metrics = await response.text() if response.status == 200 else ""
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await fakes.stop()
+
+    file_latencies = []
+    by_size = {}
+    for sha, files in pushes:
+        reviewed = fakes.reviewed[sha]
+        latencies = [reviewed[filename] - sent_at[sha] for filename, _ in files if filename in reviewed]
+        file_latencies.extend(latencies)
+        entry = by_size.setdefault(len(files), {"pushes": 0, "files": 0, "reviewed": 0, "latencies": []})
+        entry["pushes"] += 1
+        entry["files"] += len(files)
+        entry["reviewed"] += len(latencies)
+        entry["latencies"].extend(latencies)
+
+    total_files = sum(len(files) for _, files in pushes)
+    reviewed_files = len(file_latencies)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "pushes": len(pushes),
+        "files": total_files,
+        "reviewed_files": reviewed_files,
+        "missing_files": total_files - reviewed_files,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_files_per_s": round(reviewed_files / elapsed, 3) if elapsed else None,
+        "webhook_statuses": {str(status): count for status, count in statuses.items()},
+        "webhook_ack_s": {"p50": percentile(ack_latencies, 50), "p99": percentile(ack_latencies, 99)},
+        "file_latency_s": {"p50": percentile(file_latencies, 50),
+                           "p90": percentile(file_latencies, 90),
+                           "p99": percentile(file_latencies, 99),
+                           "max": round(max(file_latencies), 4) if file_latencies else None},
+        "by_push_size": {str(size): {"pushes": entry["pushes"],
+                                     "files": entry["files"],
+                                     "reviewed": entry["reviewed"],
+                                     "p50_s": percentile(entry["latencies"], 50),
+                                     "p99_s": percentile(entry["latencies"], 99)}
+                         for size, entry in sorted(by_size.items())},
+        "memory_rss_mb": {"start": round(memory[0] / 2 ** 20, 1) if memory else None,
+                          "peak": round(max(memory) / 2 ** 20, 1) if memory else None,
+                          "end": round(memory[-1] / 2 ** 20, 1) if memory else None},
+        "fake_counters": fakes.counters,
+        "app_openai_tokens": sum(float(line.rsplit(" ", 1)[1]) for line in app_metrics.splitlines()
+                                 if line.startswith("reviewbot_openai_tokens_total")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end to end benchmark against local fakes")
+    parser.add_argument("--source", choices=["github", "gitlab", "both"], default="github")
+    parser.add_argument("--backend", choices=["memory", "mongo"], default="memory",
+                        help="review queue and stores, mongo runs them on mongomock")
+    parser.add_argument("--push-sizes", default="1,5,20", help="files per push, comma separated")
+    parser.add_argument("--repeat", type=int, default=3, help="pushes per size")
+    parser.add_argument("--patch-lines", type=int, default=30)
+    parser.add_argument("--concurrency", type=int, default=10, help="webhooks in flight")
+    parser.add_argument("--interval", type=float, default=0.0, help="pause after each webhook")
+    parser.add_argument("--timeout", type=float, default=300, help="give up waiting for reviews after this")
+    parser.add_argument("--seed", default="bench")
+    parser.add_argument("--github-latency", type=float, default=0.05)
+    parser.add_argument("--gitlab-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--openai-token-latency", type=float, default=0.0, help="seconds per completion token")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--github-rpm", type=float, default=0)
+    parser.add_argument("--gitlab-rpm", type=float, default=0)
+    parser.add_argument("--openai-rpm", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of github/gitlab requests failing")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--app-env", action="append", default=[], help="KEY=VALUE passed to the app")
+    parser.add_argument("--output", help="also write the json result to this file")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="only fail when no file was reviewed, for runs injecting errors")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+    # a run that reviewed nothing is a broken app, not a fast one
+    if not result["reviewed_files"]:
+        sys.exit("benchmark failed: no file was reviewed, see the app log")
+    if result["missing_files"] and not args.allow_missing:
+        sys.exit(f"benchmark failed: {result['missing_files']} of {result['files']} files were not reviewed")
+
+
+if __name__ == "__main__":
+    main()
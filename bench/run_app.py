@@ -0,0 +1,27 @@
+import os
+import sys
+import argparse
+
+# starts the app with an in-memory mongo, used by bench/offline.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+
+    import mongomock
+    import pymongo
+    # cr_db and the mongo backed stores pick the client up from pymongo at import time
+    pymongo.MongoClient = mongomock.MongoClient
+
+    sys.path.insert(0, ROOT)
+    import uvicorn
+    uvicorn.run("main:app", host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
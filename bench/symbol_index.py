@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import utils
+import lsp_utils.lsp as lsp
+from symbol_index import SymbolIndex
+
+# compares the recursive hunk to symbol intersection with the flattened index, e.g.
+#   python bench/symbol_index.py --classes 500 --methods 10 --hunks 300
+
+
+def make_range(start: int, end: int):
+    return {"start": {"line": start, "character": 0}, "end": {"line": end, "character": 0}}
+
+
+def make_symbols(classes: int, methods: int, functions: int, method_lines: int):
+    # a generated looking file: classes with fields and methods, then module level functions and constants
+    symbols = []
+    line = 0
+    for c in range(classes):
+        start = line
+        line += 1
+        children = []
+        for f in range(3):
+            children.append({"name": f"field_{f}", "kind": lsp.SymbolKind.Field, "range": make_range(line, line)})
+            line += 1
+        for m in range(methods):
+            children.append({"name": f"method_{m}", "kind": lsp.SymbolKind.Method,
+                             "range": make_range(line, line + method_lines - 1), "children": []})
+            line += method_lines + 1
+        symbols.append({"name": f"Class{c}", "kind": lsp.SymbolKind.Class, "range": make_range(start, line - 1),
+                        "children": children})
+        line += 1
+    for f in range(functions):
+        symbols.append({"name": f"function_{f}", "kind": lsp.SymbolKind.Function,
+                        "range": make_range(line, line + method_lines - 1), "children": []})
+        line += method_lines + 1
+        symbols.append({"name": f"CONSTANT_{f}", "kind": lsp.SymbolKind.Constant, "range": make_range(line, line)})
+        line += 2
+    return symbols, line
+
+
+def make_hunks(count: int, total_lines: int, max_length: int, seed: str):
+    # sorted, non overlapping ranges like the hunks of one diff
+    rng = random.Random(seed)
+    starts = sorted(rng.sample(range(total_lines), min(count, total_lines)))
+    hunks = []
+    for i, start in enumerate(starts):
+        limit = starts[i + 1] - 1 if i + 1 < len(starts) else total_lines - 1
+        hunks.append([start, max(start, min(limit, start + rng.randint(0, max_length)))])
+    return hunks
+
+
+def best_of(repeat: int, func):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recursive symbol intersection against the interval index")
+    parser.add_argument("--classes", type=int, default=500)
+    parser.add_argument("--methods", type=int, default=10)
+    parser.add_argument("--functions", type=int, default=1000)
+    parser.add_argument("--method-lines", type=int, default=8)
+    parser.add_argument("--hunks", type=int, default=300)
+    parser.add_argument("--hunk-lines", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", default="bench")
+    args = parser.parse_args()
+
+    symbols, total_lines = make_symbols(args.classes, args.methods, args.functions, args.method_lines)
+    hunks = make_hunks(args.hunks, total_lines, args.hunk_lines, args.seed)
+
+    recursive_s, expected = best_of(args.repeat, lambda: [utils.get_symbols_intersecting_with_range(symbols, hunk)
+                                                          for hunk in hunks])
+    build_s, index = best_of(args.repeat, lambda: SymbolIndex(symbols))
+    query_s, paths = best_of(args.repeat, lambda: index.query_all(hunks))
+
+    actual = [[index.path_symbols(path) for path in hunk_paths] for hunk_paths in paths]
+    same = [[[id(s) for s in path] for path in hunk_paths] for hunk_paths in expected] == \
+           [[[id(s) for s in path] for path in hunk_paths] for hunk_paths in actual]
+
+    print(json.dumps({
+        "symbols": len(index.symbols),
+        "lines": total_lines,
+        "hunks": len(hunks),
+        "paths": sum(len(hunk_paths) for hunk_paths in paths),
+        "same_result": same,
+        "recursive_ms": round(recursive_s * 1000, 3),
+        "index_build_ms": round(build_s * 1000, 3),
+        "index_query_ms": round(query_s * 1000, 3),
+        "speedup_with_build": round(recursive_s / (build_s + query_s), 2),
+        "speedup_query_only": round(recursive_s / query_s, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
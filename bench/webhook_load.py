@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import hmac
+import uuid
+import hashlib
+import asyncio
+import argparse
+
+import aiohttp
+
+# replays a webhook payload as a burst and reports the handler latency, e.g.
+#   python bench/webhook_load.py --url http://127.0.0.1:8000/github-webhook --secret $GITHUB_WEBHOOK_SECRET
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def unique_payload(data: dict, source: str, i: int):
+    # fresh commit ids so the dedup does not short-circuit the replay
+    data = json.loads(json.dumps(data))
+    for commit in data.get("commits", []):
+        commit["id"] = hashlib.sha1(f"{commit['id']}:{i}".encode()).hexdigest()
+    if data.get("commits"):
+        data["after"] = data["commits"][-1]["id"]
+    return data
+
+
+def sign(source: str, secret: str, body: bytes, delivery_id: str):
+    if source == "gitlab":
+        return {"X-Gitlab-Token": secret, "X-Gitlab-Event-UUID": delivery_id,
+                "X-Gitlab-Event": "Push Hook", "Content-Type": "application/json"}
+    signature = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return {"X-Hub-Signature-256": signature, "X-GitHub-Delivery": delivery_id,
+            "X-GitHub-Event": "push", "Content-Type": "application/json"}
+
+
+async def run(args):
+    with open(args.payload) as f:
+        data = json.load(f)
+
+    bodies = []
+    for i in range(args.requests):
+        payload = unique_payload(data, args.source, i) if args.unique_commits else data
+        body = json.dumps(payload).encode()
+        delivery_id = str(uuid.uuid4())
+        bodies.append((body, sign(args.source, args.secret, body, delivery_id)))
+
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def send(body, headers):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post(args.url, data=body, headers=headers) as response:
+                        await response.read()
+                        status = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = type(e).__name__
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[send(body, headers) for body, headers in bodies])
+        elapsed = time.perf_counter() - start
+
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(args.requests / elapsed, 1) if elapsed else 0,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies), 2) if latencies else 0.0,
+        },
+    }
+
+
+def main():
+    default_payload = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads", "github_push.json")
+    parser = argparse.ArgumentParser(description="Replay a burst of webhook deliveries and report latency")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/github-webhook")
+    parser.add_argument("--source", choices=["github", "gitlab"], default="github")
+    parser.add_argument("--secret", default=os.environ.get("GITHUB_WEBHOOK_SECRET", ""))
+    parser.add_argument("--payload", default=default_payload)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--unique-commits", action="store_true",
+                        help="rewrite commit ids per request so every delivery creates new review jobs")
+    parser.add_argument("--max-p99", type=float, default=None,
+                        help="exit with status 1 when the p99 latency in ms is above this")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    if args.max_p99 is not None and result["latency_ms"]["p99"] > args.max_p99:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
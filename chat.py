@@ -1,6 +1,19 @@
 import config
 import openai
+import aiohttp
+import http_client
+import diff_planner
+import metrics
+import asyncio
+import re
 import json
+import time
+import hashlib
+from openai.api_requestor import APIRequestor
+from review_cache import review_cache, make_cache_key
+from review_store import review_store
+from rate_limiter import backoff_delay
+from model_router import model_router
 import logging
 import logging.config
 logger = logging.getLogger(__name__)
@@ -25,36 +38,352 @@ Please structure your reply in the following four parts in markdown format:
 """
 
 
-def get_chat_answer(prompt):
-    model = "gpt-3.5-turbo"
+# cached reviews are invalidated whenever the prompt text changes
+PROMPT_VERSION = hashlib.sha1(sys_prompt.encode()).hexdigest()[:12]
+
+
+def response_headers(response):
+    # openai 0.27 keeps the headers of an OpenAIResponse in _headers, there is no public attribute
+    return getattr(response, "_headers", None)
+
+
+def request_status(error):
+    return "rate_limited" if isinstance(error, openai.error.RateLimitError) else "error"
+
+
+async def request_chat_completion(tier, messages):
+    # the raw requestor keeps the response headers, the rate limiter follows the x-ratelimit-* values
+    requestor = APIRequestor()
+    start = time.monotonic()
+    try:
+        with metrics.track_external("openai"):
+            response, _, _ = await requestor.arequest(
+                "post", "/chat/completions",
+                params={"model": tier.name, "messages": messages},
+                request_timeout=config.OPENAI_REQUEST_TIMEOUT)
+    except openai.error.InvalidRequestError:
+        # about the prompt, not the health of the model
+        raise
+    except openai.error.OpenAIError as e:
+        model_router.record(tier, request_status(e), time.monotonic() - start)
+        raise
+    tier.limiter.update_from_headers(response_headers(response))
+    usage = response.data.get('usage', {})
+    model_router.record(tier, "ok", time.monotonic() - start,
+                        usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+    metrics.OPENAI_TOKENS.inc(usage.get('prompt_tokens', 0), model=tier.name, kind="prompt")
+    metrics.OPENAI_TOKENS.inc(usage.get('completion_tokens', 0), model=tier.name, kind="completion")
+    return response.data
+
+
+async def route_request(prompt, filenames, count=True):
+    # (tiers to try in order, estimated tokens of the request), count=False for a lookup that sends nothing
+    estimated_tokens = diff_planner.estimate_tokens(sys_prompt + prompt) + config.OPENAI_COMPLETION_TOKENS_ESTIMATE
+    await model_router.refresh_backlog()
+    return model_router.route(diff_planner.estimate_tokens(prompt), estimated_tokens, filenames, count), estimated_tokens
+
+
+async def get_chat_completion(prompt, filenames=(), priority=None):
+    # returns (response, model), filenames of the reviewed files let the router spot sensitive paths
+    messages = [{"role": "system", "content": sys_prompt},
+                {"role": "user", "content": prompt}]
+    tiers, estimated_tokens = await route_request(prompt, filenames)
+
+    # route openai through the shared keep-alive session instead of a session per call
+    openai.aiosession.set(await http_client.get_session())
+
+    with metrics.track("chat") as timer:
+        for i, tier in enumerate(tiers):
+            # while another model is left a failing one gets few retries, the next model is tried instead
+            last = i == len(tiers) - 1
+            max_retries = config.OPENAI_MAX_RETRIES if last else min(config.ROUTER_FALLBACK_RETRIES,
+                                                                      config.OPENAI_MAX_RETRIES)
+            response = await complete_with_retries(tier, messages, estimated_tokens, priority, max_retries)
+            if response is not None:
+                return response, tier.name
+            if not last:
+                logger.warning(f"Model {tier.name} failed, falling back to {tiers[i + 1].name}")
+        timer.status = "error"
+    return None, None
+
+
+async def complete_with_retries(tier, messages, estimated_tokens, priority, max_retries=config.OPENAI_MAX_RETRIES):
+    rate_limiter = tier.limiter
+    for attempt in range(max_retries + 1):
+        with metrics.track("openai_admission"):
+            await rate_limiter.acquire(estimated_tokens, priority)
+        used_tokens = 0
+        delay = 0
+        try:
+            response = await request_chat_completion(tier, messages)
+            used_tokens = response.get('usage', {}).get('total_tokens', 0)
+            return response
+
+        except openai.error.RateLimitError as e:
+            # the limiter pauses admission until the quota resets, no extra sleep needed here
+            wait = rate_limiter.on_rate_limited(e.headers, attempt)
+            logger.warning(f"OpenAI rate limited, retry {attempt + 1} in {wait:.1f}s: {e}")
+        except (openai.error.Timeout, openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError, openai.error.APIError) as e:
+            delay = backoff_delay(attempt)
+            logger.warning(f"OpenAI request failed, retry {attempt + 1} in {delay:.1f}s: {e}")
+        except openai.error.InvalidRequestError as e:
+            logger.error(f"OpenAI invalid request error: {e}")
+            return None
+        finally:
+            rate_limiter.release(estimated_tokens, used_tokens)
+
+        # the last backoff would only hold up the fallback model
+        if delay and attempt < max_retries:
+            await asyncio.sleep(delay)
+
+    logger.error(f"OpenAI request to {tier.name} failed after {max_retries + 1} attempts")
+    return None
+
+
+async def stream_chat_completion(prompt, tier, estimated_tokens):
     messages = [{"role": "system", "content": sys_prompt},
                 {"role": "user", "content": prompt}]
+    prompt_tokens = diff_planner.estimate_tokens(sys_prompt + prompt)
+    rate_limiter = tier.limiter
 
+    openai.aiosession.set(await http_client.get_session())
+
+    with metrics.track("openai_admission"):
+        await rate_limiter.acquire(estimated_tokens)
+    completion_tokens = 0
+    start = time.monotonic()
+    status = "error"
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages
-        )
-        review = response['choices'][0]['message']['content']
-        return review
+        requestor = APIRequestor()
+        responses, _, _ = await requestor.arequest(
+            "post", "/chat/completions",
+            params={"model": tier.name, "messages": messages, "stream": True},
+            stream=True,
+            request_timeout=config.OPENAI_REQUEST_TIMEOUT)
+        first = True
+        async for response in responses:
+            if first:
+                rate_limiter.update_from_headers(response_headers(response))
+                first = False
+            delta = response.data['choices'][0].get('delta', {}).get('content')
+            if delta:
+                # every streamed delta is about one token
+                completion_tokens += 1
+                yield delta
+        status = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "cancelled"
+        raise
+    except openai.error.OpenAIError as e:
+        status = request_status(e)
+        raise
+    finally:
+        rate_limiter.release(estimated_tokens)
+        model_router.record(tier, status, time.monotonic() - start, prompt_tokens, completion_tokens)
+        metrics.OPENAI_TOKENS.inc(prompt_tokens, model=tier.name, kind="prompt")
+        metrics.OPENAI_TOKENS.inc(completion_tokens, model=tier.name, kind="completion")
+
+
+async def get_chat_answer(prompt, filenames=()):
+    response, _ = await get_chat_completion(prompt, filenames)
+    if not response:
+        return None
+    return response['choices'][0]['message']['content']
+
+
+# appended to the posted sections of a stream that failed when no full review could be made instead
+INCOMPLETE_REVIEW_NOTE = "\n\n_The review is incomplete, the model stopped answering._"
+
+SECTION_HEADER_REGEX = re.compile(r'^[\s#*"\'>-]*(Code Score|Quality|Logic|Security)\b', re.MULTILINE | re.IGNORECASE)
+
+batch_prompt = f"""
+The patches of several files follow, each one starts with a line "{diff_planner.BATCH_FILE_MARKER} <filename>". Review every file separately. Start the review of each file with the same "{diff_planner.BATCH_FILE_MARKER} <filename>" line, followed by the four parts for that file.
+
+"""
 
-    except openai.error.Timeout as e:
-        logger.error(f"OpenAI request timed out: {e}")
-    except openai.error.APIConnectionError as e:
-        logger.error(f"OpenAI API connection error: {e}")
-    except openai.error.InvalidRequestError as e:
-        logger.error(f"OpenAI invalid request error: {e}")
-    except openai.error.RateLimitError as e:
-        logger.error(f"OpenAI invalid request error: {e}")
 
-def get_review_for_patch(patch, filename):
+symbol_prompt = """
+The changed functions of the file follow, each after a header with its line range and name.
+Lines starting with + were added by the commit, lines starting with - were removed, the other lines are unchanged context.
+Review the changes, use the surrounding code of the functions to judge them.
+"""
+
+SYMBOL_PROMPT_VERSION = hashlib.sha1((sys_prompt + symbol_prompt).encode()).hexdigest()[:12]
+
+
+async def get_cached_review(prompt, patch, filename, prompt_version=PROMPT_VERSION):
+    # (review, model that wrote it) when the model the router picks for the prompt reviewed the patch before,
+    # (None, None) otherwise
+    tiers, _ = await route_request(prompt, [filename], count=False)
+    entry = await review_cache.get(make_cache_key(patch, tiers[0].name, prompt_version))
+    if not entry or not entry.get("review"):
+        return None, None
+    return entry["review"], entry.get("model") or tiers[0].name
+
+
+async def get_review_for_chunk(patch, filename, prompt_head="commmit patch is:\n", prompt_version=PROMPT_VERSION):
+    # returns (review, tokens, latency, cached, model)
+    prompt = f"{prompt_head}{patch}\n"
+    review, model = await get_cached_review(prompt, patch, filename, prompt_version)
+    if review:
+        logger.info(f"Review cache hit for {filename}")
+        return review, 0, 0.0, True, model
+
+    start = time.monotonic()
+    response, model = await get_chat_completion(prompt, [filename])
+    if not response:
+        return None, 0, 0.0, False, None
+
+    review = response['choices'][0]['message']['content']
+    tokens = response.get('usage', {}).get('total_tokens', 0)
+    latency = time.monotonic() - start
+    # keyed by the model that answered, a fallback answer is reused once the router picks that model
+    await review_cache.put(make_cache_key(patch, model, prompt_version), review, model, latency, tokens)
+    return review, tokens, latency, False, model
+
+
+async def get_review_for_patch(patch, filename):
+    if type(patch) != str:
+        patch = json.dumps(patch)
+
+    # big patches are cut along hunk boundaries and reviewed concurrently
+    chunks = diff_planner.split_patch(patch, config.REVIEW_MAX_PROMPT_TOKENS)
+    if len(chunks) == 1:
+        results = [await get_review_for_chunk(patch, filename)]
+        review = results[0][0]
+    else:
+        logger.info(f"Splitting patch of {filename} into {len(chunks)} requests")
+        results = await asyncio.gather(*[get_review_for_chunk(chunk, filename) for chunk in chunks])
+        parts = [f"**Part {i}/{len(chunks)}**\n\n{result[0]}" for i, result in enumerate(results, 1) if result[0]]
+        review = "\n\n".join(parts) or None
+
+    # the chunks run concurrently, the slowest one is the latency of the file
+    models = ",".join(sorted(set(result[4] for result in results if result[4])))
+    await review_store.record(filename, patch, review, models,
+                              sum(result[1] for result in results),
+                              max(result[2] for result in results),
+                              all(result[3] for result in results))
+    return review
+
+
+async def get_review_for_symbols(context, patch, filename):
+    # context is the output of symbol_context.build_symbol_context, the patch is kept for the review history
+    review, tokens, latency, cached, model = await get_review_for_chunk(context, filename, symbol_prompt,
+                                                                       SYMBOL_PROMPT_VERSION)
+    await review_store.record(filename, patch, review, model, tokens, latency, cached)
+    return review
+
+
+def complete_sections_end(text: str):
+    # a section is complete once the header of the next one shows up
+    headers = list(SECTION_HEADER_REGEX.finditer(text))
+    if len(headers) < 2:
+        return 0
+    return headers[-1].start()
+
+
+async def stream_review_for_patch(patch, filename, publish, incremental=True):
+    # publish(review, final) is awaited with the complete sections so far (incremental) and with the full review
     if type(patch) != str:
         patch = json.dumps(patch)
 
+    if len(diff_planner.split_patch(patch, config.REVIEW_MAX_PROMPT_TOKENS)) > 1:
+        review = await get_review_for_patch(patch, filename)
+        if review:
+            await publish(review, True)
+        return review
+
     prompt = f"commmit patch is:\n{patch}\n"
-    return get_chat_answer(prompt)
+    review, model = await get_cached_review(prompt, patch, filename)
+    if review:
+        logger.info(f"Review cache hit for {filename}")
+        await publish(review, True)
+        await review_store.record(filename, patch, review, model, 0, 0.0, True)
+        return review
+
+    tiers, estimated_tokens = await route_request(prompt, [filename])
+    model = tiers[0].name
+    start = time.monotonic()
+    parts = []
+    published_end = 0
+    try:
+        # no fallback mid stream, a failed stream goes through get_review_for_patch and its fallbacks
+        async for delta in stream_chat_completion(prompt, tiers[0], estimated_tokens):
+            if not parts:
+                logger.info(f"Time to first byte for {filename}: {time.monotonic() - start:.3f}s")
+            parts.append(delta)
+            if not incremental:
+                continue
+            text = "".join(parts)
+            end = complete_sections_end(text)
+            if end > published_end:
+                published_end = end
+                await publish(text[:end].rstrip(), False)
+    except (openai.error.OpenAIError, aiohttp.ClientError) as e:
+        # a cut off answer is not a review, nothing of it is cached or recorded
+        logger.error(f"OpenAI stream failed for {filename} after {len(parts)} deltas, reviewing without streaming: {e}")
+        review = await get_review_for_patch(patch, filename)
+        if review:
+            await publish(review, True)
+        elif published_end:
+            # the sections already posted stay up, marked as incomplete
+            await publish("".join(parts)[:published_end].rstrip() + INCOMPLETE_REVIEW_NOTE, True)
+        return review
+
+    review = "".join(parts)
+    if not review:
+        return None
+
+    latency = time.monotonic() - start
+    logger.info(f"Streamed review of {filename} in {latency:.3f}s")
+    await publish(review, True)
+    tokens = diff_planner.estimate_tokens(prompt + review)
+    await review_cache.put(make_cache_key(patch, model, PROMPT_VERSION), review, model, latency, tokens)
+    await review_store.record(filename, patch, review, model, tokens, latency)
+    return review
+
+
+async def get_reviews_for_patches(file_patches: list):
+    # review many small patches with one request, returns {filename: review}
+    reviews = {}
+    missing = []
+    for filename, patch in file_patches:
+        # the model each file would be sent to on its own decides the cache entry
+        review, model = await get_cached_review(f"commmit patch is:\n{patch}\n", patch, filename)
+        if review:
+            reviews[filename] = review
+            await review_store.record(filename, patch, review, model, 0, 0.0, True)
+        else:
+            missing.append((filename, patch))
+
+    if len(missing) > 1:
+        prompt = batch_prompt + diff_planner.build_batch_prompt(missing)
+        start = time.monotonic()
+        response, model = await get_chat_completion(prompt, [filename for filename, _ in missing])
+        if response:
+            answer = response['choices'][0]['message']['content']
+            batch_reviews = diff_planner.split_batch_answer(answer, [filename for filename, _ in missing])
+            latency = (time.monotonic() - start) / len(missing)
+            tokens = response.get('usage', {}).get('total_tokens', 0) // len(missing)
+            for filename, patch in missing:
+                review = batch_reviews.get(filename)
+                if review:
+                    reviews[filename] = review
+                    await review_cache.put(make_cache_key(patch, model, PROMPT_VERSION), review, model, latency, tokens)
+                    await review_store.record(filename, patch, review, model, tokens, latency)
+            missing = [(filename, patch) for filename, patch in missing if filename not in reviews]
+            if missing:
+                logger.warning(f"Batched answer misses {len(missing)} files, reviewing them one by one")
+
+    # files the batched answer did not cover fall back to a request of their own
+    fallback = await asyncio.gather(*[get_review_for_patch(patch, filename) for filename, patch in missing])
+    for (filename, _), review in zip(missing, fallback):
+        if review:
+            reviews[filename] = review
+    return reviews
 
 
-def get_review_for_content(content: str, filename: str):
+async def get_review_for_content(content: str, filename: str):
     prompt = f"commmit content is:\n{content}\n"
-    return get_chat_answer(prompt)
+    return await get_chat_answer(prompt, [filename])
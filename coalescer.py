@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import config
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_DISPATCHED = "dispatched"
+
+# how often running reviews of a branch look for a force push another process handled
+EPOCH_POLL_SECONDS = 5.0
+
+
+def is_null_sha(sha: str):
+    return not sha or set(sha) == {"0"}
+
+
+class MongoBranchStore(object):
+    def __init__(self, db):
+        self.branches = db["branch_pushes"]
+
+    def on_push(self, key: str, before: str, after: str, forced: bool, commits: list, split: bool):
+        now = datetime.utcnow()
+        # a push inside the debounce window only moves the head, the base of the pending range stays
+        update = {"$set": {"head": after, "update_at": now},
+                  "$push": {"commits": {"$each": commits}},
+                  "$inc": {"generation": 1, "epoch": 1 if forced else 0}}
+        if split:
+            update["$set"]["split"] = True
+        doc = self.branches.find_one_and_update(
+            {"_id": key, "status": STATUS_PENDING}, update, return_document=ReturnDocument.AFTER)
+        if doc is not None:
+            return doc
+
+        try:
+            return self.branches.find_one_and_update(
+                {"_id": key, "status": {"$ne": STATUS_PENDING}},
+                {"$set": {"base": before, "head": after, "status": STATUS_PENDING, "update_at": now,
+                          "commits": commits, "split": split},
+                 "$inc": {"generation": 1, "epoch": 1 if forced else 0}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # another process opened the pending range first
+            return self.on_push(key, before, after, forced, commits, split)
+
+    def claim(self, key: str, generation: int):
+        return self.branches.find_one_and_update(
+            {"_id": key, "generation": generation, "status": STATUS_PENDING},
+            {"$set": {"status": STATUS_DISPATCHED, "update_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER)
+
+    def get_epoch(self, key: str):
+        doc = self.branches.find_one({"_id": key}, {"epoch": 1})
+        return doc["epoch"] if doc else 0
+
+
+class MemoryBranchStore(object):
+    def __init__(self):
+        self.branches = {}
+        self.lock = threading.Lock()
+
+    def on_push(self, key: str, before: str, after: str, forced: bool, commits: list, split: bool):
+        with self.lock:
+            doc = self.branches.setdefault(key, {"_id": key, "generation": 0, "epoch": 0, "status": None})
+            if doc["status"] != STATUS_PENDING:
+                doc["base"] = before
+                doc["status"] = STATUS_PENDING
+                doc["commits"] = []
+                doc["split"] = False
+            doc["head"] = after
+            doc["commits"] = doc["commits"] + commits
+            doc["split"] = doc["split"] or split
+            doc["generation"] += 1
+            if forced:
+                doc["epoch"] += 1
+            return dict(doc)
+
+    def claim(self, key: str, generation: int):
+        with self.lock:
+            doc = self.branches.get(key)
+            if not doc or doc["generation"] != generation or doc["status"] != STATUS_PENDING:
+                return None
+            doc["status"] = STATUS_DISPATCHED
+            return dict(doc)
+
+    def get_epoch(self, key: str):
+        with self.lock:
+            doc = self.branches.get(key)
+            return doc["epoch"] if doc else 0
+
+
+class PushCoalescer(object):
+    # collapses the pushes to one branch inside a debounce window into one net diff,
+    # a force push bumps the branch epoch and cancels reviews started for the old history.
+    # the pending range keeps the commits to review, a range with a skipped commit (split) is reviewed per commit
+    def __init__(self, store, poll_interval: float = None):
+        self.store = store
+        self.tasks = {}
+        # with several worker processes a force push lands in one of them, the others poll the branch epoch
+        self.poll_interval = poll_interval
+        self.watchers = {}
+        # tasks cancelled by a newer push, any other cancellation is a shutdown
+        self.superseded = set()
+
+    async def on_push(self, key: str, before: str, after: str, forced: bool, commits: list, split: bool):
+        doc = await asyncio.to_thread(self.store.on_push, key, before, after, forced, commits, split)
+        self.cancel_stale(key, doc["epoch"])
+        return doc
+
+    async def claim(self, key: str, generation: int):
+        return await asyncio.to_thread(self.store.claim, key, generation)
+
+    async def is_superseded(self, payload: dict):
+        key = payload.get("branch_key")
+        if not key:
+            return False
+        epoch = await asyncio.to_thread(self.store.get_epoch, key)
+        return payload["epoch"] < epoch
+
+    def cancel_stale(self, key: str, epoch: int):
+        for task_epoch, task in list(self.tasks.get(key, ())):
+            if task_epoch < epoch and not task.done():
+                logger.info(f"Cancelling superseded review on {key}")
+                self.superseded.add(task)
+                task.cancel()
+
+    async def watch(self, key: str):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                epoch = await asyncio.to_thread(self.store.get_epoch, key)
+            except Exception as e:
+                logger.warning(f"Reading the epoch of {key} failed: {e}")
+                continue
+            self.cancel_stale(key, epoch)
+
+    async def run(self, payload: dict, coro):
+        key = payload.get("branch_key")
+        if not key:
+            return await coro
+
+        if await self.is_superseded(payload):
+            coro.close()
+            logger.info(f"Skipping superseded review on {key}")
+            return None
+
+        entry = (payload["epoch"], asyncio.create_task(coro))
+        self.tasks.setdefault(key, set()).add(entry)
+        if self.poll_interval and key not in self.watchers:
+            self.watchers[key] = asyncio.create_task(self.watch(key))
+        try:
+            return await entry[1]
+        except asyncio.CancelledError:
+            if entry[1] in self.superseded:
+                return None
+            raise
+        finally:
+            self.superseded.discard(entry[1])
+            running = self.tasks.get(key)
+            if running is not None:
+                running.discard(entry)
+                if not running:
+                    del self.tasks[key]
+                    watcher = self.watchers.pop(key, None)
+                    if watcher is not None:
+                        watcher.cancel()
+
+
+def create_coalescer():
+    if config.REVIEW_QUEUE_BACKEND == "memory":
+        # one process, on_push cancels the stale reviews itself
+        return PushCoalescer(MemoryBranchStore())
+    from cr_db import cr_db
+    return PushCoalescer(MongoBranchStore(cr_db.db), EPOCH_POLL_SECONDS)
+
+
+coalescer = create_coalescer()
@@ -7,6 +7,8 @@ OPENAI_API_PROXY = os.getenv("API_PROXY", None)
 
 GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
 GITHUB_API_TOKEN = os.getenv("GITHUB_API_TOKEN")
+GITHUB_API_ORIGIN = os.getenv("GITHUB_API_ORIGIN", "https://api.github.com")
+GITHUB_GIT_ORIGIN = os.getenv("GITHUB_GIT_ORIGIN", "https://github.com")
 
 GITLAB_API_TOKEN = os.getenv("GITLAB_API_TOKEN")
 GITLAB_API_ORIGIN = os.getenv("GITLAB_API_ORIGIN")
@@ -19,3 +21,111 @@ TEST_APP = os.getenv("TEST_APP") == "true"
 
 lang_server_ts = os.getenv("lang_server_ts", None)
 lang_server = {"typescript": lang_server_ts}
+
+REVIEW_QUEUE_BACKEND = os.getenv("REVIEW_QUEUE_BACKEND", "mongo")
+REVIEW_WORKERS = int(os.getenv("REVIEW_WORKERS", "64"))
+REVIEW_QUEUE_MAX_PENDING = int(os.getenv("REVIEW_QUEUE_MAX_PENDING", "5000"))
+REVIEW_QUEUE_VISIBILITY_TIMEOUT = float(os.getenv("REVIEW_QUEUE_VISIBILITY_TIMEOUT", "300"))
+REVIEW_QUEUE_MAX_ATTEMPTS = int(os.getenv("REVIEW_QUEUE_MAX_ATTEMPTS", "5"))
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "200"))
+HTTP_POOL_SIZE_PER_HOST = int(os.getenv("HTTP_POOL_SIZE_PER_HOST", "50"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+
+LSP_IDLE_TIMEOUT = float(os.getenv("LSP_IDLE_TIMEOUT", "600"))
+LSP_MAX_SERVERS = int(os.getenv("LSP_MAX_SERVERS", "8"))
+
+REVIEW_CACHE_MONGO = os.getenv("REVIEW_CACHE_MONGO", "true") == "true"
+REVIEW_CACHE_SIZE = int(os.getenv("REVIEW_CACHE_SIZE", "2048"))
+REVIEW_CACHE_TTL = float(os.getenv("REVIEW_CACHE_TTL", str(30 * 24 * 3600)))
+
+REVIEW_MAX_PROMPT_TOKENS = int(os.getenv("REVIEW_MAX_PROMPT_TOKENS", "3000"))
+REVIEW_PACK_MAX_FILE_TOKENS = int(os.getenv("REVIEW_PACK_MAX_FILE_TOKENS", "300"))
+REVIEW_PACK_MAX_FILES = int(os.getenv("REVIEW_PACK_MAX_FILES", "8"))
+
+# patch reviews the raw diff, symbols reviews the enclosing functions of the changed lines where a language server is set
+REVIEW_CONTEXT_MODE = os.getenv("REVIEW_CONTEXT_MODE", "patch")
+# functions longer than this are cut down to the changed lines and REVIEW_SYMBOL_PADDING lines around them
+REVIEW_SYMBOL_MAX_LINES = int(os.getenv("REVIEW_SYMBOL_MAX_LINES", "200"))
+REVIEW_SYMBOL_PADDING = int(os.getenv("REVIEW_SYMBOL_PADDING", "3"))
+# where the symbols of a language come from: ast (python only), tree-sitter (needs tree_sitter_languages) or lsp
+SYMBOL_BACKENDS = os.getenv("SYMBOL_BACKENDS", "python:ast")
+
+# comma separated gitignore style rules added to the built in skip list, ! re-includes
+REVIEW_SKIP_RULES = os.getenv("REVIEW_SKIP_RULES", "")
+# per repository rules in the same syntax, one per line, read from this file at the reviewed commit
+REVIEW_FILTER_FILE = os.getenv("REVIEW_FILTER_FILE", ".reviewbot")
+REVIEW_FILTER_TTL = float(os.getenv("REVIEW_FILTER_TTL", "600"))
+REVIEW_FILTER_CACHE_SIZE = int(os.getenv("REVIEW_FILTER_CACHE_SIZE", "1024"))
+
+# local triage before the model, diffs classified as one of TRIAGE_SKIP (trivial, mechanical) are not reviewed
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "true") == "true"
+TRIAGE_SKIP = set(item.strip() for item in os.getenv("TRIAGE_SKIP", "trivial,mechanical").split(",") if item.strip())
+
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "3500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "90000"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "120"))
+OPENAI_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("OPENAI_COMPLETION_TOKENS_ESTIMATE", "400"))
+
+# model tiers from the deepest to the fastest, name:usd per 1k prompt tokens:usd per 1k completion tokens:context tokens
+MODEL_TIERS = os.getenv("MODEL_TIERS", "gpt-3.5-turbo:0.0015:0.002:4096")
+# diffs up to ROUTER_SMALL_TOKENS go to the fastest tier, from ROUTER_LARGE_TOKENS to the deepest, like sensitive paths
+ROUTER_SMALL_TOKENS = int(os.getenv("ROUTER_SMALL_TOKENS", "600"))
+ROUTER_LARGE_TOKENS = int(os.getenv("ROUTER_LARGE_TOKENS", "2500"))
+ROUTER_SENSITIVE_PATHS = [item.strip() for item in os.getenv(
+    "ROUTER_SENSITIVE_PATHS", "auth,login,passw,secret,token,crypt,security,permission,payment,migration").split(",")
+    if item.strip()]
+ROUTER_DEEP_LANGUAGES = set(item.strip() for item in os.getenv("ROUTER_DEEP_LANGUAGES", "cpp").split(",") if item.strip())
+# queued jobs or requests waiting for the rate limiters at which everything goes to the fastest tier, half of it moves one tier
+ROUTER_BURST_PENDING = int(os.getenv("ROUTER_BURST_PENDING", "500"))
+ROUTER_BURST_WAITING = int(os.getenv("ROUTER_BURST_WAITING", "64"))
+# a model goes behind the others for ROUTER_COOLDOWN seconds after that many failed requests in a row or when its
+# average latency passes ROUTER_SLOW_SECONDS, retries are cut to ROUTER_FALLBACK_RETRIES while another model is left
+ROUTER_FAILURE_THRESHOLD = int(os.getenv("ROUTER_FAILURE_THRESHOLD", "3"))
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "60"))
+ROUTER_SLOW_SECONDS = float(os.getenv("ROUTER_SLOW_SECONDS", "60"))
+ROUTER_FALLBACK_RETRIES = int(os.getenv("ROUTER_FALLBACK_RETRIES", "1"))
+
+# off, incremental (post the first complete section and edit the comment as the rest arrives) or buffered
+REVIEW_STREAM_MODE = os.getenv("REVIEW_STREAM_MODE", "off")
+
+# file posts one comment per file, commit collects all reviews of a commit into one comment
+REVIEW_PUBLISH_MODE = os.getenv("REVIEW_PUBLISH_MODE", "file")
+REVIEW_PUBLISH_TIMEOUT = float(os.getenv("REVIEW_PUBLISH_TIMEOUT", "1800"))
+PUBLISH_MIN_INTERVAL = float(os.getenv("PUBLISH_MIN_INTERVAL", "1.0"))
+PUBLISH_MAX_RETRIES = int(os.getenv("PUBLISH_MAX_RETRIES", "5"))
+
+GITHUB_ETAG_CACHE_SIZE = int(os.getenv("GITHUB_ETAG_CACHE_SIZE", "1024"))
+GITHUB_ETAG_CACHE_MB = int(os.getenv("GITHUB_ETAG_CACHE_MB", "64"))
+GITHUB_FETCH_CONCURRENCY = int(os.getenv("GITHUB_FETCH_CONCURRENCY", "16"))
+# pushes touching at least this many files download one tarball instead of every file
+GITHUB_TARBALL_MIN_FILES = int(os.getenv("GITHUB_TARBALL_MIN_FILES", "50"))
+
+# read commits and file contents from local bare mirrors instead of the rest api, needs git 2.31+
+GIT_MIRROR_ENABLED = os.getenv("GIT_MIRROR_ENABLED", "false") == "true"
+GIT_MIRROR_ROOT = os.getenv("GIT_MIRROR_ROOT", os.path.join(os.path.dirname(__file__), "mirrors"))
+GIT_MIRROR_DISK_BUDGET_MB = int(os.getenv("GIT_MIRROR_DISK_BUDGET_MB", "10240"))
+
+# collapse the commits of a push, and pushes to a branch within the debounce window, into one net diff
+PUSH_COALESCE = os.getenv("PUSH_COALESCE", "true") == "true"
+PUSH_DEBOUNCE_SECONDS = float(os.getenv("PUSH_DEBOUNCE_SECONDS", "30"))
+
+REVIEWED_COMMIT_CACHE_SIZE = int(os.getenv("REVIEWED_COMMIT_CACHE_SIZE", "10000"))
+REVIEWED_COMMIT_BLOOM_CAPACITY = int(os.getenv("REVIEWED_COMMIT_BLOOM_CAPACITY", "1000000"))
+# seconds a commit stays claimed until its job is enqueued, keep it below REVIEW_QUEUE_VISIBILITY_TIMEOUT
+REVIEWED_COMMIT_CLAIM_LEASE = float(os.getenv("REVIEWED_COMMIT_CLAIM_LEASE", "60"))
+
+# all runs the webhook api and the review workers in one process, serve.py starts separate api and worker processes
+APP_ROLE = os.getenv("APP_ROLE", "all")
+APP_HOST = os.getenv("APP_HOST", "127.0.0.1")
+APP_PORT = int(os.getenv("APP_PORT", "8010"))
+CPU_COUNT = os.cpu_count() or 1
+# webhook handlers only enqueue, a few api processes serve many cores worth of workers
+API_PROCESSES = int(os.getenv("API_PROCESSES", str(max(1, CPU_COUNT // 4))))
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(CPU_COUNT)))
+# worker i serves /metrics on WORKER_BASE_PORT + i
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", str(APP_PORT + 1)))
+REVIEW_DRAIN_TIMEOUT = float(os.getenv("REVIEW_DRAIN_TIMEOUT", "120"))
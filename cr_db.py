@@ -1,8 +1,26 @@
-from pymongo import MongoClient
+import math
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 import config
 from config import MONGO_URL
 
-from datetime import datetime
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+# a claimed commit is queued once its job is enqueued, a claim left behind by a crashed worker runs out
+CLAIM_CLAIMED = "claimed"
+CLAIM_QUEUED = "queued"
 
 
 class CodeReviewDB(object):
@@ -12,16 +30,192 @@ class CodeReviewDB(object):
         self.reviewed_commits = self.db["reviewed_commits"]
         self.reviewed_commits.create_index([("commit_id", 1), ("source", 1), ("repo", 1)], unique=True)
 
-    def add_reviewed_commit(self, commit_id: str, repo: str, source: str):
-        self.reviewed_commits.insert_one(
-            {"commit_id": commit_id,
-             "repo": repo,
-             "source": source,
-             "created_at": datetime.utcnow(),
-             "update_at": datetime.utcnow()})
 
-    def get_reviewed_commit(self, commit_id: str, source: str):
-        return self.reviewed_commits.find_one({"commit_id": commit_id, "source": source})
+cr_db = CodeReviewDB()
+
 
+class BloomFilter(object):
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
 
-cr_db = CodeReviewDB()
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        if self.count >= self.capacity:
+            # past capacity the false positive rate climbs, start over
+            self.bits = bytearray(len(self.bits))
+            self.count = 0
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class MongoReviewedCommitStore(object):
+    def __init__(self, collection):
+        self.commits = collection
+
+    def find(self, commit_ids: list, repo: str, source: str, lease: float):
+        # queued commits and the ones claimed within the lease
+        expired = datetime.utcnow() - timedelta(seconds=lease)
+        cursor = self.commits.find({"commit_id": {"$in": commit_ids}, "source": source, "repo": repo,
+                                    "$or": [{"status": {"$ne": CLAIM_CLAIMED}}, {"claimed_at": {"$gte": expired}}]},
+                                   {"commit_id": 1, "_id": 0})
+        return {doc["commit_id"] for doc in cursor}
+
+    def insert(self, commit_ids: list, repo: str, source: str, lease: float):
+        # upsert every commit in one round trip, the ones that were not there yet are ours to review,
+        # so are the ones whose claim ran out
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        requests = [UpdateOne({"commit_id": commit_id, "source": source, "repo": repo, "status": CLAIM_CLAIMED,
+                               "claimed_at": {"$lt": now - timedelta(seconds=lease)}},
+                              {"$set": {"claimed_at": now, "claim": token, "update_at": now},
+                               "$setOnInsert": {"created_at": now}},
+                              upsert=True)
+                    for commit_id in commit_ids]
+        try:
+            result = self.commits.bulk_write(requests, ordered=False)
+            upserted = result.upserted_ids.keys()
+            matched = result.matched_count
+        except BulkWriteError as e:
+            # a commit somebody else claimed, or two deliveries of the same push upserting at once,
+            # the loser sees a duplicate key
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            upserted = [item["index"] for item in e.details.get("upserted", [])]
+            matched = e.details.get("nMatched", 0)
+        claimed = {commit_ids[index] for index in upserted}
+        if matched:
+            cursor = self.commits.find({"claim": token, "source": source, "repo": repo}, {"commit_id": 1, "_id": 0})
+            claimed.update(doc["commit_id"] for doc in cursor)
+        return claimed
+
+    def confirm(self, commit_ids: list, repo: str, source: str):
+        self.commits.update_many({"commit_id": {"$in": commit_ids}, "source": source, "repo": repo},
+                                 {"$set": {"status": CLAIM_QUEUED, "update_at": datetime.utcnow()},
+                                  "$unset": {"claim": ""}})
+
+    def delete(self, commit_ids: list, repo: str, source: str):
+        self.commits.delete_many({"commit_id": {"$in": commit_ids}, "source": source, "repo": repo})
+
+
+class MemoryReviewedCommitStore(object):
+    def __init__(self):
+        # (commit id, repo, source) -> monotonic time of the claim, None once queued
+        self.commits = {}
+        self.lock = threading.Lock()
+
+    def _taken(self, key: tuple, lease: float):
+        if key not in self.commits:
+            return False
+        claimed_at = self.commits[key]
+        return claimed_at is None or time.monotonic() - claimed_at < lease
+
+    def find(self, commit_ids: list, repo: str, source: str, lease: float):
+        with self.lock:
+            return {commit_id for commit_id in commit_ids if self._taken((commit_id, repo, source), lease)}
+
+    def insert(self, commit_ids: list, repo: str, source: str, lease: float):
+        with self.lock:
+            inserted = {commit_id for commit_id in commit_ids if not self._taken((commit_id, repo, source), lease)}
+            now = time.monotonic()
+            self.commits.update(((commit_id, repo, source), now) for commit_id in inserted)
+            return inserted
+
+    def confirm(self, commit_ids: list, repo: str, source: str):
+        with self.lock:
+            for commit_id in commit_ids:
+                if (commit_id, repo, source) in self.commits:
+                    self.commits[(commit_id, repo, source)] = None
+
+    def delete(self, commit_ids: list, repo: str, source: str):
+        with self.lock:
+            for commit_id in commit_ids:
+                self.commits.pop((commit_id, repo, source), None)
+
+
+class ReviewedCommits(object):
+    # the lru answers redeliveries and the bloom filter tells which commits were never seen by this process,
+    # only the rest needs a lookup, the upsert decides the races.
+    # a claim holds for lease seconds until confirm() marks the commits queued, shorter than the queue visibility
+    # timeout so the redelivered webhook job of a crashed worker claims them again
+    def __init__(self, store, cache_size: int, bloom_capacity: int, lease: float):
+        self.store = store
+        self.lease = lease
+        self.cache_size = cache_size
+        self.recent = OrderedDict()
+        self.bloom = BloomFilter(bloom_capacity)
+
+        self.cache_hits = 0
+        self.lookups = 0
+
+    def _remember(self, key: str):
+        self.bloom.add(key)
+        self.recent[key] = True
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.cache_size:
+            self.recent.popitem(last=False)
+
+    async def claim(self, commit_ids: list, repo: str, source: str):
+        # claims the commits for review and returns the ones nobody claimed before
+        commit_ids = list(dict.fromkeys(commit_ids))
+        unknown = [commit_id for commit_id in commit_ids if f"{source}:{repo}:{commit_id}" not in self.recent]
+        self.cache_hits += len(commit_ids) - len(unknown)
+
+        maybe_reviewed = [commit_id for commit_id in unknown if f"{source}:{repo}:{commit_id}" in self.bloom]
+        reviewed = set()
+        if maybe_reviewed:
+            self.lookups += 1
+            reviewed = await asyncio.to_thread(self.store.find, maybe_reviewed, repo, source, self.lease)
+
+        candidates = [commit_id for commit_id in unknown if commit_id not in reviewed]
+        claimed = set()
+        if candidates:
+            claimed = await asyncio.to_thread(self.store.insert, candidates, repo, source, self.lease)
+
+        for commit_id in unknown:
+            self._remember(f"{source}:{repo}:{commit_id}")
+        return [commit_id for commit_id in commit_ids if commit_id in claimed]
+
+    async def confirm(self, commit_ids: list, repo: str, source: str):
+        # the jobs for these commits are enqueued, the claim no longer runs out
+        if not commit_ids:
+            return
+        await asyncio.to_thread(self.store.confirm, commit_ids, repo, source)
+
+    async def release(self, commit_ids: list, repo: str, source: str):
+        # the jobs for these commits were not enqueued, let a redelivery try again
+        if not commit_ids:
+            return
+        for commit_id in commit_ids:
+            self.recent.pop(f"{source}:{repo}:{commit_id}", None)
+        await asyncio.to_thread(self.store.delete, commit_ids, repo, source)
+
+    def stats(self):
+        return {"cached": len(self.recent),
+                "cache_hits": self.cache_hits,
+                "lookups": self.lookups}
+
+
+def create_reviewed_commits():
+    if config.REVIEW_QUEUE_BACKEND == "memory":
+        store = MemoryReviewedCommitStore()
+    else:
+        store = MongoReviewedCommitStore(cr_db.reviewed_commits)
+    return ReviewedCommits(store, config.REVIEWED_COMMIT_CACHE_SIZE, config.REVIEWED_COMMIT_BLOOM_CAPACITY,
+                           config.REVIEWED_COMMIT_CLAIM_LEASE)
+
+
+reviewed_commits = create_reviewed_commits()
@@ -0,0 +1,163 @@
+import re
+from array import array
+
+HUNK_HEADER_REGEX = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?([^\n]*)', re.MULTILINE)
+
+CONTEXT = ord(' ')
+ADDED = ord('+')
+REMOVED = ord('-')
+NO_NEWLINE = ord('\\')
+
+
+class Hunk(object):
+    """One hunk of a unified diff, lines are kept as offsets into the patch string it was parsed from.
+
+    position is the github diff position of the header: 0 for the first hunk, every later line of the patch,
+    headers included, is one more. The line kinds are parsed on first use, headers alone are enough for
+    the line ranges and for splitting.
+    """
+
+    __slots__ = ("patch", "old_start", "old_count", "new_start", "new_count", "section",
+                 "offset", "body_offset", "end", "position", "_kinds", "_line_offsets")
+
+    def __init__(self, patch: str, old_start: int, old_count: int, new_start: int, new_count: int, section: str,
+                 offset: int, body_offset: int, end: int, position: int):
+        self.patch = patch
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.section = section
+        # the header starts at offset, the lines at body_offset, the next hunk (or the end of the patch) at end
+        self.offset = offset
+        self.body_offset = body_offset
+        self.end = end
+        self.position = position
+        self._kinds = None
+        self._line_offsets = None
+
+    @property
+    def kinds(self):
+        # one byte per line: ' ', '+', '-' or '\\'
+        if self._kinds is None:
+            self._parse_lines()
+        return self._kinds
+
+    @property
+    def line_offsets(self):
+        if self._line_offsets is None:
+            self._parse_lines()
+        return self._line_offsets
+
+    def _parse_lines(self):
+        patch = self.patch
+        kinds = bytearray()
+        offsets = array('I')
+        old_left, new_left = self.old_count, self.new_count
+        pos = self.body_offset
+        while pos < self.end:
+            line_end = patch.find('\n', pos, self.end)
+            if line_end < 0:
+                line_end = self.end
+            kind = ord(patch[pos]) if pos < line_end else CONTEXT
+            if kind == NO_NEWLINE:
+                kinds.append(kind)
+                offsets.append(pos)
+            elif old_left > 0 or new_left > 0:
+                if kind == ADDED:
+                    new_left -= 1
+                elif kind == REMOVED:
+                    old_left -= 1
+                else:
+                    # github drops the trailing space of empty context lines
+                    kind = CONTEXT
+                    old_left -= 1
+                    new_left -= 1
+                kinds.append(kind)
+                offsets.append(pos)
+            else:
+                # the counted lines are done, what follows is the header of the next file
+                break
+            pos = line_end + 1
+        self._kinds = kinds
+        self._line_offsets = offsets
+
+    @property
+    def new_range(self):
+        # [start, start + count] like utils.parse_diff
+        return [self.new_start, self.new_start + self.new_count]
+
+    @property
+    def old_range(self):
+        return [self.old_start, self.old_start + self.old_count]
+
+    def text(self):
+        return self.patch[self.offset:self.end]
+
+    def line_text(self, index: int):
+        # without the leading kind character
+        patch = self.patch
+        start = self.line_offsets[index]
+        end = patch.find('\n', start, self.end)
+        if end < 0:
+            end = self.end
+        return patch[start + 1:end].rstrip('\r') if end > start else ""
+
+    def lines(self):
+        # (kind, old line, new line, diff position, text), the line number a kind has no line on is None
+        old_line, new_line = self.old_start, self.new_start
+        for index, kind in enumerate(self.kinds):
+            position = self.position + index + 1
+            text = self.line_text(index)
+            if kind == ADDED:
+                yield kind, None, new_line, position, text
+                new_line += 1
+            elif kind == REMOVED:
+                yield kind, old_line, None, position, text
+                old_line += 1
+            elif kind == CONTEXT:
+                yield kind, old_line, new_line, position, text
+                old_line += 1
+                new_line += 1
+            else:
+                yield kind, None, None, position, text
+
+    def added_lines(self):
+        new_line = self.new_start
+        added = []
+        for kind in self.kinds:
+            if kind == ADDED:
+                added.append(new_line)
+            if kind == ADDED or kind == CONTEXT:
+                new_line += 1
+        return added
+
+    def __repr__(self):
+        return f"Hunk(-{self.old_start},{self.old_count} +{self.new_start},{self.new_count}, {len(self.kinds)} lines)"
+
+
+def iter_hunks(patch: str):
+    """Yields the hunks of a unified diff, the patch is scanned once and never copied.
+
+    Single line headers (@@ -1 +1 @@) count one line, text before the first hunk and after the counted lines
+    of a hunk (file headers of a multi file diff) is not part of any hunk's lines.
+    """
+    previous = None
+    position = 0
+    for match in HUNK_HEADER_REGEX.finditer(patch):
+        offset = match.start()
+        if previous is not None:
+            previous.end = offset
+            position = previous.position + patch.count('\n', previous.offset, offset)
+            yield previous
+        body_offset = min(match.end() + 1, len(patch))
+        previous = Hunk(patch, int(match.group(1)), int(match.group(2)) if match.group(2) is not None else 1,
+                        int(match.group(3)), int(match.group(4)) if match.group(4) is not None else 1,
+                        match.group(5).rstrip('\r'), offset, body_offset, len(patch), position)
+
+    if previous is not None:
+        yield previous
+
+
+def parse_hunks(patch: str):
+    return list(iter_hunks(patch))
@@ -0,0 +1,95 @@
+import re
+
+import utils
+
+# rough estimate for code, good enough to keep requests inside the context window
+CHARS_PER_TOKEN = 4
+
+BATCH_FILE_MARKER = "### FILE:"
+BATCH_FILE_REGEX = re.compile(r'^#+\s*FILE:\s*`?([^`\n]+?)`?\s*$', re.MULTILINE)
+
+
+def estimate_tokens(text: str):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _split_hunk(hunk: str, max_tokens: int):
+    if estimate_tokens(hunk) <= max_tokens:
+        return [hunk]
+
+    # a single hunk over budget is cut on line boundaries, every piece keeps the hunk header
+    lines = hunk.splitlines(keepends=True)
+    header = lines[0].rstrip('\n') + " (continued)\n"
+    pieces = []
+    current = [lines[0]]
+    current_tokens = estimate_tokens(lines[0])
+    for line in lines[1:]:
+        line_tokens = estimate_tokens(line)
+        if current_tokens + line_tokens > max_tokens and len(current) > 1:
+            pieces.append(''.join(current))
+            current = [header]
+            current_tokens = estimate_tokens(header)
+        current.append(line)
+        current_tokens += line_tokens
+    pieces.append(''.join(current))
+    return pieces
+
+
+def split_patch(patch: str, max_tokens: int):
+    if estimate_tokens(patch) <= max_tokens:
+        return [patch]
+
+    preamble, hunks = utils.split_patch_hunks(patch)
+    chunks = []
+    current = [preamble] if preamble else []
+    current_tokens = estimate_tokens(preamble) if preamble else 0
+    for hunk in hunks:
+        for piece in _split_hunk(hunk, max_tokens):
+            piece_tokens = estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(''.join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def is_packable(patch, max_file_tokens: int):
+    return isinstance(patch, str) and 0 < len(patch) and estimate_tokens(patch) <= max_file_tokens
+
+
+def pack_files(items: list, get_patch, max_tokens: int, max_files: int):
+    # first-fit packing of small file diffs into batches that fit one request
+    batches = []
+    current = []
+    current_tokens = 0
+    for item in items:
+        tokens = estimate_tokens(get_patch(item))
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_files):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(file_patches: list):
+    sections = [f"{BATCH_FILE_MARKER} {filename}\n{patch}\n" for filename, patch in file_patches]
+    return "\n".join(sections)
+
+
+def split_batch_answer(answer: str, filenames: list):
+    reviews = {}
+    matches = list(BATCH_FILE_REGEX.finditer(answer))
+    for i, match in enumerate(matches):
+        filename = match.group(1).strip()
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(answer)
+        if filename in filenames:
+            reviews[filename] = answer[match.end():end].strip()
+    return reviews
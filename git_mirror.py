@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import base64
+import shutil
+import asyncio
+import contextlib
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DIFF_HEADER_REGEX = re.compile(r'^diff --git a/(.*) b/(.*)$')
+
+
+class GitError(Exception):
+    pass
+
+
+def config_env(extra_config: list):
+    # (key, value) pairs as GIT_CONFIG_* variables (git 2.31+), unlike -c they do not show up in ps
+    env = dict(os.environ, GIT_CONFIG_COUNT=str(len(extra_config)))
+    for i, (key, value) in enumerate(extra_config):
+        env[f"GIT_CONFIG_KEY_{i}"] = key
+        env[f"GIT_CONFIG_VALUE_{i}"] = value
+    return env
+
+
+async def run_git(args: list, cwd: str = None, input: bytes = None, extra_config: list = []):
+    process = await asyncio.create_subprocess_exec(
+        "git", "-c", "core.quotepath=off", *args,
+        cwd=cwd,
+        env=config_env(extra_config),
+        stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate(input)
+    if process.returncode != 0:
+        raise GitError(f"git {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+    return stdout
+
+
+def parse_commit_diff(output: str):
+    # turn `git diff-tree -p` output into the file entries the github commit api returns
+    file_changes = []
+    current = None
+    lines = []
+
+    def flush():
+        if current is None:
+            return
+        patch_start = next((i for i, line in enumerate(lines) if line.startswith("@@")), None)
+        if patch_start is not None:
+            patch_lines = lines[patch_start:]
+            while patch_lines and not patch_lines[-1]:
+                patch_lines.pop()
+            current["patch"] = "\n".join(patch_lines)
+            current["additions"] = sum(1 for line in patch_lines if line.startswith("+"))
+            current["deletions"] = sum(1 for line in patch_lines if line.startswith("-"))
+        current["changes"] = current["additions"] + current["deletions"]
+        for line in lines[:patch_start]:
+            if line.startswith("new file mode"):
+                current["status"] = "added"
+            elif line.startswith("deleted file mode"):
+                current["status"] = "removed"
+            elif line.startswith("rename from "):
+                current["status"] = "renamed"
+                current["previous_filename"] = line[len("rename from "):]
+        file_changes.append(current)
+
+    for line in output.split("\n"):
+        match = DIFF_HEADER_REGEX.match(line)
+        if match:
+            flush()
+            current = {"filename": match.group(2), "status": "modified", "additions": 0, "deletions": 0}
+            lines = []
+        elif current is not None:
+            lines.append(line)
+    flush()
+    return file_changes
+
+
+class GitMirrorCache(object):
+    # one bare mirror per repository, refreshed with an incremental fetch on every push
+    def __init__(self, root: str, disk_budget: int):
+        self.root = root
+        self.disk_budget = disk_budget
+        self.locks = {}
+        # mirrors a request is reading from, eviction leaves them alone
+        self.in_use = {}
+        self.last_used = {}
+        self.usage = {}
+        os.makedirs(root, exist_ok=True)
+
+        # mirrors left by a previous run count against the budget too
+        for entry in os.listdir(root):
+            if entry.endswith(".git"):
+                name = entry[:-len(".git")].replace("__", "/")
+                path = os.path.join(root, entry)
+                self.last_used[name] = os.path.getmtime(path)
+                self.usage[name] = self.disk_usage(path)
+
+    def mirror_path(self, repo_full_name: str):
+        return os.path.join(self.root, repo_full_name.replace("/", "__") + ".git")
+
+    def auth_config(self):
+        token = base64.b64encode(f"x-access-token:{config.GITHUB_API_TOKEN}".encode()).decode()
+        return [("http.extraHeader", f"Authorization: Basic {token}")]
+
+    async def has_commit(self, path: str, sha: str):
+        try:
+            await run_git(["cat-file", "-e", f"{sha}^{{commit}}"], cwd=path)
+            return True
+        except GitError:
+            return False
+
+    async def ensure(self, repo_full_name: str, shas: list):
+        path = self.mirror_path(repo_full_name)
+        lock = self.locks.setdefault(repo_full_name, asyncio.Lock())
+        async with lock:
+            self.last_used[repo_full_name] = time.time()
+            url = f"{config.GITHUB_GIT_ORIGIN}/{repo_full_name}.git"
+            if not os.path.isdir(path):
+                logger.info(f"Creating git mirror of {repo_full_name}")
+                await run_git(["clone", "--bare", "--quiet", url, path], extra_config=self.auth_config())
+
+            missing = [sha for sha in shas if not await self.has_commit(path, sha)]
+            if missing:
+                await run_git(["fetch", "--quiet", "--prune", url, "+refs/heads/*:refs/heads/*"],
+                              cwd=path, extra_config=self.auth_config())
+                missing = [sha for sha in missing if not await self.has_commit(path, sha)]
+            if missing:
+                # force-pushed away or not on a branch yet, ask for the objects directly
+                await run_git(["fetch", "--quiet", url, *missing], cwd=path, extra_config=self.auth_config())
+
+            if missing or repo_full_name not in self.usage:
+                self.usage[repo_full_name] = await asyncio.to_thread(self.disk_usage, path)
+
+        await self.evict()
+        return path
+
+    @contextlib.asynccontextmanager
+    async def use(self, repo_full_name: str, shas: list):
+        # the mirror can't be evicted between the fetch and the git command reading from it
+        self.in_use[repo_full_name] = self.in_use.get(repo_full_name, 0) + 1
+        try:
+            yield await self.ensure(repo_full_name, shas)
+        finally:
+            self.in_use[repo_full_name] -= 1
+            if not self.in_use[repo_full_name]:
+                del self.in_use[repo_full_name]
+
+    async def get_commit_file_changes(self, repo_full_name: str, sha: str):
+        async with self.use(repo_full_name, [sha]) as path:
+            output = await run_git(["diff-tree", "-p", "-M", "--no-commit-id", "--root", "-r", sha], cwd=path)
+        return parse_commit_diff(output.decode("utf-8", errors="replace"))
+
+    async def get_diff(self, repo_full_name: str, base: str, head: str):
+        # from the merge base like the compare api, a rebased push does not bring in the changes of the old base
+        async with self.use(repo_full_name, [base, head]) as path:
+            output = await run_git(["diff", "-M", f"{base}...{head}"], cwd=path)
+        return parse_commit_diff(output.decode("utf-8", errors="replace"))
+
+    async def read_files(self, repo_full_name: str, sha: str, filenames: list):
+        # one cat-file process streams every blob, no per-file request
+        request = "".join(f"{sha}:{filename}\n" for filename in filenames).encode()
+        async with self.use(repo_full_name, [sha]) as path:
+            output = await run_git(["cat-file", "--batch"], cwd=path, input=request)
+
+        contents = {}
+        offset = 0
+        for filename in filenames:
+            header_end = output.index(b"\n", offset)
+            header = output[offset:header_end].split()
+            offset = header_end + 1
+            if len(header) < 3:
+                # "<name> missing", no body follows
+                continue
+            size = int(header[2])
+            if header[1] == b"blob":
+                contents[filename] = output[offset:offset + size].decode("utf-8", errors="replace")
+            # a tree or a submodule commit has a body too
+            offset += size + 1
+        return contents
+
+    async def read_file(self, repo_full_name: str, sha: str, filename: str):
+        contents = await self.read_files(repo_full_name, sha, [filename])
+        return contents.get(filename)
+
+    def disk_usage(self, path: str):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    async def evict(self):
+        total = sum(self.usage.values())
+        for name in sorted(self.usage, key=lambda name: self.last_used.get(name, 0)):
+            if total <= self.disk_budget:
+                break
+            lock = self.locks.get(name)
+            if (lock and lock.locked()) or self.in_use.get(name):
+                continue
+            logger.info(f"Evicting git mirror of {name} ({self.usage[name] // (1024 * 1024)} MB)")
+            await asyncio.to_thread(shutil.rmtree, self.mirror_path(name), True)
+            total -= self.usage.pop(name)
+            self.last_used.pop(name, None)
+
+
+def create_git_mirror():
+    if not config.GIT_MIRROR_ENABLED:
+        return None
+    return GitMirrorCache(config.GIT_MIRROR_ROOT, config.GIT_MIRROR_DISK_BUDGET_MB * 1024 * 1024)
+
+
+git_mirror = create_git_mirror()
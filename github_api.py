@@ -0,0 +1,181 @@
+import io
+import re
+import asyncio
+import tarfile
+import logging
+from collections import OrderedDict
+
+import config
+import http_client
+
+logger = logging.getLogger(__name__)
+
+LINK_NEXT_REGEX = re.compile(r'<([^>]+)>;\s*rel="next"')
+# github lists at most 300 files of a compare, the rest of the diff is missing
+COMPARE_MAX_FILES = 300
+
+
+class GithubApiError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+
+
+class ETagCache(object):
+    # the bodies are whole commits and files, the cache is bounded by their size as well as by the entry count
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, etag: str, content: bytes, headers):
+        if len(content) > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous[1])
+        self.entries[key] = (etag, content, headers)
+        self.size += len(content)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted, _) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self):
+        return {"entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+etag_cache = ETagCache(config.GITHUB_ETAG_CACHE_SIZE, config.GITHUB_ETAG_CACHE_MB * 2 ** 20)
+
+
+def api_headers(accept: str = "application/vnd.github+json"):
+    return {
+        "Authorization": f"Bearer {config.GITHUB_API_TOKEN}",
+        "Accept": accept,
+    }
+
+
+async def get(url: str, params: dict = None, accept: str = "application/vnd.github+json"):
+    # conditional GET, a 304 answer does not count against the rate limit
+    cache_key = url if not params else url + "?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+    headers = api_headers(accept)
+    cached = etag_cache.get(cache_key)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+
+    response = await http_client.get(url, headers=headers, params=params)
+    if response.status_code == 304 and cached:
+        etag_cache.hits += 1
+        return http_client.HttpResponse(200, cached[2], cached[1], url)
+    etag_cache.misses += 1
+    if response.status_code != 200:
+        raise GithubApiError(response.status_code, response.text[:200])
+
+    etag = response.headers.get("ETag")
+    if etag:
+        etag_cache.put(cache_key, etag, response.content, response.headers)
+    return response
+
+
+def next_page_url(response):
+    match = LINK_NEXT_REGEX.search(response.headers.get("Link", ""))
+    return match.group(1) if match else None
+
+
+async def get_commit_files(repo_full_name: str, sha: str):
+    # a commit lists at most 300 files per page, follow the Link header for the rest
+    url = f"{config.GITHUB_API_ORIGIN}/repos/{repo_full_name}/commits/{sha}"
+    response = await get(url, params={"per_page": 100})
+    files = list(response.json().get("files", []))
+    url = next_page_url(response)
+    while url:
+        response = await get(url)
+        files.extend(response.json().get("files", []))
+        url = next_page_url(response)
+    return files
+
+
+async def compare(repo_full_name: str, base: str, head: str):
+    # net diff of a whole push in one request (plus pages), returns (commits, files)
+    url = f"{config.GITHUB_API_ORIGIN}/repos/{repo_full_name}/compare/{base}...{head}"
+    response = await get(url, params={"per_page": 100})
+    data = response.json()
+    commits = list(data.get("commits", []))
+    files = list(data.get("files", []))
+    url = next_page_url(response)
+    while url:
+        response = await get(url)
+        data = response.json()
+        commits.extend(data.get("commits", []))
+        files.extend(data.get("files", []))
+        url = next_page_url(response)
+    return commits, files
+
+
+async def compare_files(repo_full_name: str, base: str, head: str):
+    # the files of the net diff, None when github cut the list at COMPARE_MAX_FILES
+    _, files = await compare(repo_full_name, base, head)
+    if len(files) >= COMPARE_MAX_FILES:
+        return None
+    return files
+
+
+async def get_file_content(repo_full_name: str, filename: str, sha: str):
+    url = f"{config.GITHUB_API_ORIGIN}/repos/{repo_full_name}/contents/{filename}"
+    response = await get(url, params={"ref": sha}, accept="application/vnd.github.v3.raw")
+    return response.text
+
+
+async def get_tarball_files(repo_full_name: str, sha: str, filenames: list):
+    url = f"{config.GITHUB_API_ORIGIN}/repos/{repo_full_name}/tarball/{sha}"
+    response = await http_client.get(url, headers=api_headers())
+    if response.status_code != 200:
+        raise GithubApiError(response.status_code, response.text[:200])
+
+    # unpacking a large repository takes a while, it must not hold up the event loop
+    return await asyncio.to_thread(read_tarball, response.content, filenames)
+
+
+def read_tarball(content: bytes, filenames: list):
+    wanted = set(filenames)
+    contents = {}
+    with tarfile.open(fileobj=io.BytesIO(content), mode="r:gz") as tar:
+        for member in tar:
+            # members are prefixed with a "<owner>-<repo>-<sha>/" directory
+            path = member.name.split("/", 1)[-1]
+            if member.isfile() and path in wanted:
+                contents[path] = tar.extractfile(member).read().decode("utf-8", errors="replace")
+    return contents
+
+
+async def get_file_contents(repo_full_name: str, sha: str, filenames: list):
+    # many files are cheaper as one tarball download, a few are fetched concurrently
+    if len(filenames) >= config.GITHUB_TARBALL_MIN_FILES:
+        try:
+            return await get_tarball_files(repo_full_name, sha, filenames)
+        except (GithubApiError, tarfile.TarError) as e:
+            logger.warning(f"tarball download of {repo_full_name}@{sha} failed, fetching files one by one: {e}")
+
+    semaphore = asyncio.Semaphore(config.GITHUB_FETCH_CONCURRENCY)
+
+    async def fetch(filename):
+        async with semaphore:
+            try:
+                return filename, await get_file_content(repo_full_name, filename, sha)
+            except GithubApiError as e:
+                logger.error(f"download of {filename} failed: {e}")
+                return filename, None
+
+    results = await asyncio.gather(*[fetch(filename) for filename in filenames])
+    return {filename: content for filename, content in results if content is not None}
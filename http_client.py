@@ -0,0 +1,77 @@
+import json
+import logging
+from urllib.parse import urlparse
+
+import aiohttp
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_session = None
+
+
+async def get_session():
+    # one pooled keep-alive session per process, it must be created inside the running loop
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=config.HTTP_POOL_SIZE,
+                                         limit_per_host=config.HTTP_POOL_SIZE_PER_HOST,
+                                         keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+                                         ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=config.HTTP_TIMEOUT))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class HttpError(aiohttp.ClientError):
+    # a ClientError so the callers catching aiohttp errors keep working, and safe to format without a request
+    def __init__(self, status_code: int, url: str, message: str):
+        super().__init__(f"{status_code} for {url}: {message}")
+        self.status_code = status_code
+        self.url = url
+        self.message = message
+
+
+class HttpResponse(object):
+    def __init__(self, status_code: int, headers, content: bytes, url: str = ""):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HttpError(self.status_code, self.url, self.text[:200])
+
+
+async def request(method: str, url: str, headers: dict = None, json_data=None, params: dict = None):
+    session = await get_session()
+    with metrics.track_external(urlparse(url).netloc) as timer:
+        async with session.request(method, url, headers=headers, json=json_data, params=params) as response:
+            content = await response.read()
+            timer.status = str(response.status)
+            return HttpResponse(response.status, response.headers, content, url)
+
+
+async def get(url: str, headers: dict = None, params: dict = None):
+    return await request("GET", url, headers=headers, params=params)
+
+
+async def post(url: str, json_data=None, headers: dict = None):
+    return await request("POST", url, headers=headers, json_data=json_data)
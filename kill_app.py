@@ -1,8 +1,35 @@
+import time
 import psutil
 import signal
 
+import config
+
+
+def find_supervisor():
+    for proc in psutil.process_iter():
+        try:
+            cmdline = proc.cmdline()
+            if any(arg.endswith("serve.py") for arg in cmdline) and "python" in proc.name():
+                return proc
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+    return None
+
 
 def kill_app():
+    # serve.py drains the review workers of every process before it exits, wait for it
+    supervisor = find_supervisor()
+    if supervisor:
+        supervisor.send_signal(signal.SIGTERM)
+        start = time.monotonic()
+        try:
+            supervisor.wait(config.REVIEW_DRAIN_TIMEOUT + 60)
+            print(f"stopped in {time.monotonic() - start:.1f}s")
+        except psutil.TimeoutExpired:
+            print("serve.py is still draining")
+        return
+
+    # a single uvicorn started by hand
     for proc in psutil.process_iter():
         try:
             if proc.name() == "uvicorn":
@@ -246,6 +246,16 @@ def DidOpenTextDocument(file_path, file_types, file_contents):
         }
     })
 
+def DidCloseTextDocument(file_path):
+    return BuildNotification('textDocument/didClose', {
+        'textDocument': {
+            'uri': FilePathToUri(file_path),
+        }
+    })
+
+def Initialized():
+    return BuildNotification('initialized', {})
+
 def DocumentSymbol( request_id, file_path ):
   return BuildRequest( request_id, 'textDocument/documentSymbol', {
     'textDocument': {
@@ -262,6 +272,13 @@ def BuildRequest(request_id, method, parameters):
     })
 
 
+def BuildResponse(request_id, result):
+    return _BuildMessageData({
+        'id': request_id,
+        'result': result,
+    })
+
+
 def BuildNotification(method, parameters):
     return _BuildMessageData({
         'method': method,
@@ -0,0 +1,146 @@
+import time
+import asyncio
+import logging
+logger = logging.getLogger(__name__)
+
+import metrics
+from .lsp_process import LspProcess
+
+
+class PooledServer:
+    def __init__(self, key, server_path: str, args: list[str]) -> None:
+        self.key = key
+        self.server_path = server_path
+        self.args = args
+        self.lsp_process = None
+        self.start_lock = asyncio.Lock()
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+        self.restarts = 0
+
+    async def ensure_started(self, workspace: str):
+        async with self.start_lock:
+            if self.lsp_process and self.lsp_process.is_alive():
+                return True
+
+            if self.lsp_process:
+                logger.warning(f'lsp server {self.key} died, restarting')
+                await self.lsp_process.stop_server()
+                self.restarts += 1
+
+            language = self.key[0]
+            self.lsp_process = LspProcess()
+            with metrics.track_lsp(language, "spawn") as timer:
+                if not await self.lsp_process.start_server(self.server_path, self.args):
+                    timer.status = "error"
+                    logger.error(f'start_server {self.server_path} failed')
+                    self.lsp_process = None
+                    return False
+
+            with metrics.track_lsp(language, "initialize") as timer:
+                if not await self.lsp_process.initialize(workspace):
+                    timer.status = "error"
+                    logger.error(f'lsp init failed: {self.key}')
+                    await self.stop()
+                    return False
+
+            return True
+
+    async def stop(self):
+        if self.lsp_process:
+            lsp_process, self.lsp_process = self.lsp_process, None
+            await lsp_process.stop_server()
+
+
+class LspServerPool:
+    def __init__(self, idle_timeout: float = 600, max_servers: int = 8) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_servers = max_servers
+        self.servers = {}
+        self.reaper_task = None
+
+    def _get_server(self, language: str, workspace: str, server_path: str, args: list[str]):
+        # no await between the lookup and the insert, concurrent callers for a key share one server,
+        # it is marked in flight right away so that eviction leaves it alone
+        key = (language, workspace)
+        server = self.servers.get(key)
+        if server is None:
+            server = PooledServer(key, server_path, args)
+            self.servers[key] = server
+        server.in_flight += 1
+        server.last_used = time.monotonic()
+        return server
+
+    async def _evict_lru(self):
+        idle = [s for s in self.servers.values() if not s.in_flight]
+        if not idle:
+            return
+        server = min(idle, key=lambda s: s.last_used)
+        logger.info(f'evicting lsp server {server.key}')
+        del self.servers[server.key]
+        await server.stop()
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        expired = [s for s in self.servers.values()
+                   if now - s.last_used > self.idle_timeout and not s.in_flight]
+        for server in expired:
+            logger.info(f'lsp server {server.key} idle for {int(now - server.last_used)}s, stopping')
+            del self.servers[server.key]
+        for server in expired:
+            await server.stop()
+
+    async def get_symbols(self, language: str, workspace: str, server_path: str, args: list[str],
+                          file_path: str, file_content: str):
+        await self.evict_idle()
+        # requests are multiplexed over the server, many files can be in flight at once
+        server = self._get_server(language, workspace, server_path, args)
+        try:
+            if len(self.servers) > self.max_servers:
+                await self._evict_lru()
+            if not await server.ensure_started(workspace):
+                return None
+
+            lsp_process = server.lsp_process
+            with metrics.track_lsp(language, "symbols") as timer:
+                try:
+                    await lsp_process.open_file(file_path, language, file_content)
+                    symbols = await lsp_process.get_symbols(file_path)
+                    await lsp_process.close_file(file_path)
+                except (OSError, ConnectionError) as e:
+                    logger.error(f'lsp server {server.key} io error: {e}')
+                    symbols = None
+                if symbols is None:
+                    timer.status = "error"
+
+            if symbols is None and not lsp_process.is_alive():
+                # drop the broken server, the next request starts a fresh one
+                await server.stop()
+
+            return symbols
+        finally:
+            server.in_flight -= 1
+            server.last_used = time.monotonic()
+
+    def start(self):
+        # idle servers are stopped on a timer too, not only when the next request comes in
+        if self.reaper_task is None or self.reaper_task.done():
+            self.reaper_task = asyncio.create_task(self._reap())
+
+    async def _reap(self):
+        interval = max(1.0, self.idle_timeout / 4)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.error(f'evicting idle lsp servers failed: {e}')
+
+    async def shutdown(self):
+        if self.reaper_task:
+            self.reaper_task.cancel()
+            self.reaper_task = None
+        servers = list(self.servers.values())
+        self.servers = {}
+        for server in servers:
+            await server.stop()
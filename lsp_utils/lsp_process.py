@@ -1,7 +1,6 @@
 import os
-import subprocess
+import asyncio
 import json
-import fcntl
 import logging
 logger = logging.getLogger(__name__)
 
@@ -15,106 +14,209 @@ def GetExecutable( filename ):
     return filename
   return None
 
-def set_non_blocking(process: subprocess.Popen):
-    # get the current stdout flags
-    flags = fcntl.fcntl(process.stdout, fcntl.F_GETFL)
-    # set the stdout flags to non-blocking
-    fcntl.fcntl(process.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
-def read_response(process: subprocess.Popen):
+async def read_message(reader: asyncio.StreamReader):
     headers = {}
     while True:
-        try:
-            headerline = process.stdout.readline().strip()
-        except IOError:
-            continue
+        headerline = await reader.readline()
+        if not headerline:
+            # eof
+            return None
+        headerline = headerline.strip()
         if not headerline:
-            break
+            if headers:
+                break
+            continue
         key, value = lsp.ToUnicode(headerline).split(':', 1)
         headers[key.strip()] = value.strip()
 
-    if headers == {}:
-        return None
-
     if 'Content-Length' not in headers:
         raise RuntimeError("Missing 'Content-Length' header")
     content_length = int(headers['Content-Length'])
 
-    content = process.stdout.read(content_length)
+    content = await reader.readexactly(content_length)
+    return json.loads(content.decode('utf-8'))
 
-    content_str = content.decode('utf-8')
-    response = json.loads(content_str)
 
-    return response
+class LspResponseError(Exception):
+    def __init__(self, error: dict) -> None:
+        super().__init__(f"{error.get('code')}: {error.get('message')}")
+        self.error = error
 
 
-def read_response_of_request(process, request_id):
-    answer = None
-    
-    while answer is None:
-        if process.poll() is not None:
-            logger.error('lsp process has terminated')
-            break
-        response = read_response(process)
-        if response and 'id' in response:
-            response_id = response['id']
-            logger.info(f'lsp res:{response_id}, {response}')
-            if response_id == request_id:
-                answer = response
-                return answer
-
-    return answer
-
 class LspProcess:
-    def __init__(self) -> None:
+    def __init__(self, request_timeout: float = 30) -> None:
         self.req_id = 0
         self.process = None
+        self.request_timeout = request_timeout
+        self.pending = {}
+        self.notification_handlers = {}
+        self.reader_task = None
+        self.stderr_task = None
+        self.stopping = False
 
     def next_request_id(self):
         self.req_id += 1
         return self.req_id
 
-    def start_server(self, server_path: str, args: list[str] = []):
-        self.process = subprocess.Popen(
-            [server_path, *args],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-        
-        # set_non_blocking(self.process)
-
+    async def start_server(self, server_path: str, args: list[str] = []):
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                server_path, *args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            logger.error(f'lsp start {server_path} failed: {e}')
+            return None
+
+        self.reader_task = asyncio.create_task(self._read_loop())
+        self.stderr_task = asyncio.create_task(self._drain_stderr())
         return self.process
 
-    def stop_server(self):
-        self.process.kill()
+    async def stop_server(self):
+        if self.process is None:
+            return
+        self.stopping = True
+        if self.is_alive():
+            try:
+                await self.request('shutdown', None, timeout=1)
+                self.send_notification('exit', None)
+                await asyncio.wait_for(self.process.wait(), timeout=1)
+            except (OSError, ConnectionError, LspResponseError, asyncio.TimeoutError):
+                pass
+        if self.is_alive():
+            self.process.kill()
+        await self.process.wait()
+        for task in (self.reader_task, self.stderr_task):
+            if task:
+                task.cancel()
+        self._fail_pending(ConnectionError('lsp server stopped'))
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    def on_notification(self, method: str, handler):
+        self.notification_handlers[method] = handler
+
+    def _fail_pending(self, error: Exception):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _drain_stderr(self):
+        while True:
+            line = await self.process.stderr.readline()
+            if not line:
+                return
+            logger.debug(f'lsp stderr: {lsp.ToUnicode(line).rstrip()}')
+
+    async def _read_loop(self):
+        try:
+            while True:
+                message = await read_message(self.process.stdout)
+                if message is None:
+                    break
+                self._dispatch(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'lsp read loop failed: {e}')
+        if not self.stopping:
+            logger.error('lsp process has terminated')
+        self._fail_pending(ConnectionError('lsp process has terminated'))
+
+    def _dispatch(self, message: dict):
+        if 'method' not in message:
+            future = self.pending.pop(message.get('id'), None)
+            if future is None or future.done():
+                # late answer of a cancelled or timed out request
+                return
+            if 'error' in message:
+                future.set_exception(LspResponseError(message['error']))
+            else:
+                future.set_result(message.get('result'))
+            return
+
+        method = message['method']
+        if 'id' in message:
+            self._answer_server_request(message)
+            return
+
+        handler = self.notification_handlers.get(method)
+        if handler:
+            handler(message.get('params'))
+        else:
+            logger.debug(f'lsp notification: {method}')
+
+    def _answer_server_request(self, message: dict):
+        # we advertise no workspace capabilities, answer with neutral results so the server does not wait on us
+        method = message['method']
+        params = message.get('params') or {}
+        if method == 'workspace/configuration':
+            result = [None for _ in params.get('items', [])]
+        else:
+            result = None
+        self.send(lsp.BuildResponse(message['id'], result))
+
+    def send(self, packet: bytes):
+        self.process.stdin.write(packet)
+
+    def send_notification(self, method: str, params):
+        self.send(lsp.BuildNotification(method, params))
+
+    async def request(self, method: str, params, timeout: float = None):
+        request_id = self.next_request_id()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
 
-    def send_request(self, request: bytes):
-        self.process.stdin.write(request)
-        self.process.stdin.flush()
+        try:
+            self.send(lsp.BuildRequest(request_id, method, params))
+            await self.process.stdin.drain()
+            return await asyncio.wait_for(future, timeout or self.request_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if self.is_alive():
+                self.send_notification('$/cancelRequest', {'id': request_id})
+            raise
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def send_message(self, packet: bytes):
+        self.send(packet)
+        await self.process.stdin.drain()
+
+    async def initialize(self, root_path: str = None):
+        logger.info(f'lsp init, path: {root_path}')
 
-    def initialize(self, root_path: str = None):
         request_id = self.next_request_id()
-        request = lsp.Initialize(request_id, root_path, {}, {})
-        
-        logger.info(f'lsp init:{request_id}, path: {root_path}')
-        
-        self.send_request(request)
-
-        answer = read_response_of_request(self.process, request_id)
-        return answer is not None
-
-    
-    def open_file(self, file_path: str, file_type: str, file_content: str):
-        request = lsp.DidOpenTextDocument(file_path, file_type, file_content)
-        self.send_request(request)
-        
-    def get_symbols(self, file_path: str):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.send_message(lsp.Initialize(request_id, root_path, {}, {}))
+            await asyncio.wait_for(future, self.request_timeout)
+        except (asyncio.TimeoutError, ConnectionError, LspResponseError) as e:
+            logger.error(f'lsp init failed: {e}')
+            return False
+        finally:
+            self.pending.pop(request_id, None)
+
+        await self.send_message(lsp.Initialized())
+        return True
+
+    async def open_file(self, file_path: str, file_type: str, file_content: str):
+        await self.send_message(lsp.DidOpenTextDocument(file_path, [file_type], file_content))
+
+    async def close_file(self, file_path: str):
+        await self.send_message(lsp.DidCloseTextDocument(file_path))
+
+    async def get_symbols(self, file_path: str, timeout: float = None):
         logger.info(f'lsp get_symbols')
 
-        request_id = self.next_request_id()
-        request = lsp.DocumentSymbol(request_id, file_path)
-        self.send_request(request)
-        
-        answer = read_response_of_request(self.process, request_id)
-        return answer['result'] if answer else None
+        params = {'textDocument': {'uri': lsp.FilePathToUri(file_path)}}
+        try:
+            return await self.request('textDocument/documentSymbol', params, timeout)
+        except (asyncio.TimeoutError, ConnectionError, LspResponseError) as e:
+            logger.error(f'lsp get_symbols failed: {e}')
+            return None
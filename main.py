@@ -1,9 +1,12 @@
-from fastapi import FastAPI, BackgroundTasks, Request
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+import time
+import asyncio
 import hmac
 import hashlib
-import requests
 import json
 import config
+from datetime import datetime
 from config import *
 import os
 import logging
@@ -17,32 +20,53 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-from cr_db import cr_db
+from cr_db import reviewed_commits
 import utils
 
 import chat
 
-from lsp_utils.lsp_process import LspProcess
-import lsp_utils.lsp as lsp
+from lsp_utils.lsp_pool import LspServerPool
+
+import http_client
+import github_api
+from git_mirror import git_mirror, GitError
+from review_cache import review_cache
+from model_router import model_router
+import diff_planner
+import symbol_context
+import triage
+from symbol_extractor import symbol_extractors
+from path_filter import repo_path_filters, default_filter
+from review_queue import review_queue, ReviewWorkerPool, QueueFullError, JOB_COMMIT, JOB_FILE, JOB_BATCH, JOB_PUBLISH, JOB_PUSH, JOB_WEBHOOK
+from coalescer import coalescer, is_null_sha
+import publisher
+import review_store
+import metrics
+import tracing
 
 logger.info(f"TEST_APP: {TEST_APP}")
 
+lsp_pool = LspServerPool(LSP_IDLE_TIMEOUT, LSP_MAX_SERVERS)
 
-def get_file_changes(repo_full_name, sha):
-    commit_url = f"https://api.github.com/repos/{repo_full_name}/commits/{sha}"
-    headers = {
-        "Authorization": f"Bearer {GITHUB_API_TOKEN}",
-        "Accept": "application/vnd.github+json",
-    }
-    response = requests.get(commit_url, headers=headers)
-    commit_data = response.json()
-    return commit_data['files']  # Github includes diff in the commit data
+# prefetched file contents ride along in the job payload, bigger files are downloaded by the job itself
+PREFETCH_MAX_CHARS = 256 * 1024
 
 
-def post_comment(repo_full_name, sha, filename, review, position, line):
+async def get_file_changes(repo_full_name, sha):
+    with metrics.track("get_file_changes"):
+        if git_mirror:
+            try:
+                return await git_mirror.get_commit_file_changes(repo_full_name, sha)
+            except GitError as e:
+                logger.warning(f"git mirror diff of {sha} failed, using the commits api: {e}")
+
+        return await github_api.get_commit_files(repo_full_name, sha)  # Github includes diff in the commit data
+
+
+async def post_comment(repo_full_name, sha, filename, review, position, line):
 
     commemt = f"#### *Auto Review*:\n`{filename}`\n#### *review*:\n{review}"
-    commit_url = f"https://api.github.com/repos/{repo_full_name}/commits/{sha}/comments"
+    commit_url = f"{GITHUB_API_ORIGIN}/repos/{repo_full_name}/commits/{sha}/comments"
     comment_data = {
         "body": commemt,
         "path": filename,
@@ -53,17 +77,58 @@ def post_comment(repo_full_name, sha, filename, review, position, line):
         "Authorization": f"Bearer {GITHUB_API_TOKEN}",
         "Accept": "application/vnd.github+json",
     }
-    response = requests.post(commit_url, json=comment_data, headers=headers)
+    with metrics.track("post_comment") as timer:
+        response = await publisher.send("POST", commit_url, headers, comment_data)
+
+        if not response or response.status_code != 201:
+            timer.status = "error"
+            logger.error(f"Failed to add comment to commit: {response.text if response else 'no response'}")
+            return None
+    return response.json().get("id")
+
+
+async def update_comment(repo_full_name, comment_id, filename, review):
+    commemt = f"#### *Auto Review*:\n`{filename}`\n#### *review*:\n{review}"
+    comment_url = f"{GITHUB_API_ORIGIN}/repos/{repo_full_name}/comments/{comment_id}"
+    headers = {
+        "Authorization": f"Bearer {GITHUB_API_TOKEN}",
+        "Accept": "application/vnd.github+json",
+    }
+    with metrics.track("update_comment") as timer:
+        response = await publisher.send("PATCH", comment_url, headers, {"body": commemt})
 
-    if response.status_code != 201:
-        logger.error(f"Failed to add comment to commit: {response.text}")
+        if not response or response.status_code != 200:
+            timer.status = "error"
+            logger.error(f"Failed to update comment {comment_id}: {response.text if response else 'no response'}")
 
 
-def review_patch_and_comment(repo_full_name, sha, file_change):
+async def stream_review_and_comment(repo_full_name, sha, file_change):
     filename = file_change["filename"]
     patch = file_change["patch"]
+    comment_id = None
+
+    # the comment is created with the first complete section and edited as the rest arrives
+    async def publish(review, final):
+        nonlocal comment_id
+        if TEST_APP:
+            logger.info(f"Review{'' if final else ' (partial)'}: {review}")
+            return
+        if comment_id is None:
+            comment_id = await post_comment(repo_full_name, sha, filename, review, file_change['changes'], patch.count("\n") + 1)
+        else:
+            await update_comment(repo_full_name, comment_id, filename, review)
 
-    review = chat.get_review_for_patch(patch, filename)
+    await chat.stream_review_for_patch(patch, filename, publish, incremental=REVIEW_STREAM_MODE == "incremental")
+
+
+async def review_patch_and_comment(repo_full_name, sha, file_change):
+    filename = file_change["filename"]
+    patch = file_change["patch"]
+
+    if REVIEW_STREAM_MODE != "off":
+        return await stream_review_and_comment(repo_full_name, sha, file_change)
+
+    review = await chat.get_review_for_patch(patch, filename)
     if not review:
         return
 
@@ -71,48 +136,176 @@ def review_patch_and_comment(repo_full_name, sha, file_change):
         logger.info(f"Review: {review}")
         return
 
-    post_comment(repo_full_name, sha, filename, review, file_change['changes'], file_change['patch'].count("\n") + 1)
+    await post_comment(repo_full_name, sha, filename, review, file_change['changes'], file_change['patch'].count("\n") + 1)
 
 
-def review_changes_and_comment(repo_full_name, sha, file_change, line_ranges, symbols, file_content):
-    # todo:
-    for line_range in line_ranges:
-        symbol_paths = utils.get_symbols_intersecting_with_range(symbols, line_range)
-        # print(f"\nrange {line_range} ....")
+async def review_batch_and_comment(repo_full_name, sha, file_changes):
+    reviews = await chat.get_reviews_for_patches([(fc["filename"], fc["patch"]) for fc in file_changes])
 
-        for symbol_path in symbol_paths:
-            # print(f"path:--")
-            for s in symbol_path:
-                print(f"    {s['name']}, {lsp.SYMBOL_KIND_STR_LIST[s['kind']]}")
+    for file_change in file_changes:
+        filename = file_change["filename"]
+        review = reviews.get(filename)
+        if not review:
+            continue
 
+        if TEST_APP:
+            logger.info(f"Review of {filename}: {review}")
+            continue
 
-def process_source_file(repo_full_name, sha, file_change, language_type, language_server_path, args=[]):
+        await post_comment(repo_full_name, sha, filename, review, file_change['changes'], file_change['patch'].count("\n") + 1)
+
+
+async def review_changes_and_comment(repo_full_name, sha, file_change, context):
     filename = file_change["filename"]
-    patch = file_change["patch"]
+    review = await chat.get_review_for_symbols(context, file_change["patch"], filename)
+    if not review:
+        return
 
-    lsp_porcess = LspProcess()
-    if not lsp_porcess.start_server(language_server_path, args):
-        logger.error(f"start_server {language_server_path} failed")
-        return None, None, None
+    if TEST_APP:
+        logger.info(f"Review: {review}")
+        return
+
+    await post_comment(repo_full_name, sha, filename, review, file_change['changes'], file_change['patch'].count("\n") + 1)
+
+
+def get_language_server(filename):
+    # (path, args) of the language server giving the symbols of the file, None when there is none
+    language_type = utils.get_language_type(filename)
+    language_server_path = config.lang_server.get(language_type, None)
+    if not language_server_path:
+        return None
+    args = []
+    if language_type == 'typescript':
+        args = ['--stdio']
+    return language_server_path, args
+
+
+def has_symbol_source(filename):
+    # files without an in-process extractor or a language server are reviewed as a patch
+    if REVIEW_CONTEXT_MODE != "symbols":
+        return False
+    if symbol_extractors.get(utils.get_language_type(filename), filename):
+        return True
+    return bool(get_language_server(filename))
+
+
+def needs_symbol_context(file_change):
+    return (has_symbol_source(file_change["filename"]) and bool(file_change.get("patch"))
+            and file_change.get("status") != "removed")
+
+
+async def prefetch_file_contents(repo_full_name, sha, file_changes):
+    # the files reviewed with their enclosing functions are downloaded for the whole commit at once:
+    # one tarball for a big push, concurrent requests otherwise, a mirror reads them locally anyway
+    if git_mirror:
+        return file_changes
+    filenames = [fc["filename"] for fc in file_changes if needs_symbol_context(fc)]
+    if not filenames:
+        return file_changes
+
+    with metrics.track("download_files"):
+        contents = await github_api.get_file_contents(repo_full_name, sha, filenames)
+    logger.info(f"Prefetched {len(contents)} of {len(filenames)} files of {repo_full_name}@{sha}")
+    prefetched = []
+    for file_change in file_changes:
+        content = contents.get(file_change["filename"])
+        if content is not None and len(content) <= PREFETCH_MAX_CHARS:
+            file_change = dict(file_change, content=content)
+        prefetched.append(file_change)
+    return prefetched
+
+
+async def get_file_content(repo_full_name, sha, file_change):
+    if file_change.get("content") is not None:
+        return file_change["content"]
+    with metrics.track("download_file"):
+        return await utils.download_file(repo_full_name, file_change["filename"], sha)
+
+
+async def get_symbol_context(repo_full_name, sha, file_change):
+    # the enclosing functions of the changed lines, None when the file has to be reviewed as a patch
+    filename = file_change["filename"]
+    if not needs_symbol_context(file_change):
+        return None
+
+    language_type = utils.get_language_type(filename)
+    extractor = symbol_extractors.get(language_type, filename)
+    try:
+        if extractor:
+            symbols, file_content, line_ranges = await parse_source_file(repo_full_name, sha, file_change, extractor)
+        else:
+            language_server_path, args = get_language_server(filename)
+            symbols, file_content, line_ranges = await process_source_file(
+                repo_full_name, sha, file_change, language_type, language_server_path, args)
+    except Exception as e:
+        logger.error(f"Getting the symbols of {filename} failed: {e}")
+        return None
+    if not symbols:
+        return None
+
+    context, stats = symbol_context.build_symbol_context(file_content, file_change["patch"], symbols, line_ranges,
+                                                         REVIEW_SYMBOL_PADDING, REVIEW_SYMBOL_MAX_LINES)
+    if not context or stats["context"] > REVIEW_MAX_PROMPT_TOKENS:
+        logger.info(f"Symbol context of {filename} does not fit one request, reviewing the patch")
+        return None
+
+    for kind, tokens in stats.items():
+        metrics.REVIEW_CONTEXT_TOKENS.inc(tokens, kind=kind)
+    saved = 100 - stats["context"] * 100 // max(1, stats["file"])
+    logger.info(f"Symbol context of {filename}: {stats['context']} tokens, "
+                f"{stats['file']} for the whole file ({saved}% saved), {stats['patch']} for the patch")
+    return context
 
-    root_path = os.path.join(os.path.dirname(__file__), "temp")
 
-    if not lsp_porcess.initialize("."):
-        logger.error("lsp init failed")
-        lsp_porcess.stop_server()
+async def get_file_symbols(workspace, temp_file, file_content, language_type, language_server_path, args=[]):
+    return await lsp_pool.get_symbols(language_type, workspace, language_server_path, args, temp_file, file_content)
+
+
+async def parse_source_file(repo_full_name, sha, file_change, extractor):
+    filename = file_change["filename"]
+    file_content = await get_file_content(repo_full_name, sha, file_change)
+
+    with metrics.track("parse_symbols"):
+        symbols = await asyncio.to_thread(extractor.extract, file_content, filename)
+
+    if not symbols:
         return None, None, None
 
-    file_content = utils.download_file(repo_full_name, filename, sha)
-    temp_file = os.path.join(root_path, os.path.basename(filename))
+    line_ranges = utils.parse_diff(file_change["patch"])
+    return symbols, file_content, line_ranges
+
 
+def remove_temp_file(temp_file, root):
+    # drop the file and its directories up to root (temp/<repo>/<sha>), a directory another file still uses stays
+    os.remove(temp_file)
+    directory = os.path.dirname(temp_file)
+    while os.path.commonpath([directory, root]) == root:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+async def process_source_file(repo_full_name, sha, file_change, language_type, language_server_path, args=[]):
+    filename = file_change["filename"]
+    patch = file_change["patch"]
+
+    # keep the repository layout, files with the same basename must not overwrite each other
+    workspace = os.path.join(os.path.dirname(__file__), "temp", repo_full_name.replace("/", "__"))
+    temp_file = os.path.join(workspace, sha, filename)
+
+    file_content = await get_file_content(repo_full_name, sha, file_change)
+
+    # no await between creating the directories and writing the file, remove_temp_file may prune them
+    os.makedirs(os.path.dirname(temp_file), exist_ok=True)
     with open(temp_file, 'w') as file:
         file.write(file_content)
 
-    lsp_porcess.open_file(temp_file, language_type, file_content)
-    symbols = lsp_porcess.get_symbols(temp_file)
-
-    lsp_porcess.stop_server()
-    os.remove(temp_file)
+    try:
+        symbols = await get_file_symbols(workspace, temp_file, file_content, language_type, language_server_path, args)
+    finally:
+        remove_temp_file(temp_file, os.path.join(workspace, sha))
 
     if not symbols:
         logger.error("get symbols failed")
@@ -122,49 +315,76 @@ def process_source_file(repo_full_name, sha, file_change, language_type, languag
     return symbols, file_content, line_ranges
 
 
-def review_and_comment(repo_full_name, sha, file_change):
+async def review_and_comment(repo_full_name, sha, file_change):
     filename = file_change["filename"]
-    if utils.should_skip_review(filename):
-        logger.info(f"Skipping review for {filename}")
+
+    # renames without changes come without a patch
+    patch = file_change.get("patch")
+    if not patch:
+        logger.info(f"Nothing to review in {filename}")
         return
 
-    language_type = utils.get_language_type(filename)
-    patch = file_change["patch"]
     if TEST_APP:
         logger.info(f"filename:\n {filename}\n")
         logger.info(f"patch:\n {patch}\n")
 
-    # language_server_path = config.lang_server.get(language_type, None)
-
-    language_server_path = None
-    if language_server_path:
-        args = []
-        if language_type == 'typescript':
-            args = ['--stdio']
-        symbols, file_content, line_ranges = process_source_file(
-            repo_full_name, sha, file_change, language_type, language_server_path, args)
-        if not symbols:
-            logger.error("get symbols failed")
-            return review_patch_and_comment(repo_full_name, sha, file_change)
-
-        review_changes_and_comment(repo_full_name, sha, file_change, line_ranges, symbols, file_content)
-    else:
-        return review_patch_and_comment(repo_full_name, sha, file_change)
+    context = await get_symbol_context(repo_full_name, sha, file_change)
+    if context:
+        return await review_changes_and_comment(repo_full_name, sha, file_change, context)
+    return await review_patch_and_comment(repo_full_name, sha, file_change)
+
+
+@app.middleware("http")
+async def trace_and_time(request: Request, call_next):
+    # webhook deliveries bring their own id, use it so the log lines of a delivery can be grepped end to end
+    token = tracing.trace_id.set(request.headers.get("X-Request-Id")
+                                 or request.headers.get("X-GitHub-Delivery")
+                                 or request.headers.get("X-Gitlab-Event-UUID")
+                                 or tracing.new_trace_id())
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-Id"] = tracing.trace_id.get()
+        return response
+    finally:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                             method=request.method,
+                                             path=request.url.path if status != 404 else "unmatched",
+                                             status=str(status))
+        tracing.trace_id.reset(token)
 
 
 @app.post("/github-webhook")
-async def github_webhook(request: Request, background_tasks: BackgroundTasks):
+async def github_webhook(request: Request):
 
     # Verify signature
     signature = request.headers.get("X-Hub-Signature-256")
     body = await request.body()
     expected_signature = "sha256=" + hmac.new(GITHUB_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
     if not hmac.compare_digest(expected_signature, signature):
-        logger.error(f"Invalid signature")
+        logger.error("Invalid signature")
         return {"message": "Invalid signature"}
 
-    # Process webhook
-    data = await request.json()
+    # only enqueue here, everything else runs in the workers so github gets its answer right away
+    data = json.loads(body)
+    delivery_id = request.headers.get("X-GitHub-Delivery") or hashlib.sha256(body).hexdigest()
+    try:
+        await asyncio.to_thread(review_queue.enqueue, JOB_WEBHOOK, {"source": "github", "data": data},
+                                dedup_key=f"github:delivery:{delivery_id}", priority=1)
+    except QueueFullError as e:
+        logger.error(f"Rejecting webhook: {e}")
+        return JSONResponse(status_code=503, content={"message": "Review queue is full"})
+
+    return JSONResponse(status_code=202, content={"message": "Webhook received"})
+
+
+async def process_github_webhook_job(payload):
+    data = payload["data"]
+    repo_full_name = data['repository']['full_name']
+    commit_ids = []
+    authors = {}
     for commit in data.get('commits', []):
         message = commit['message']
         commit_id = commit['id']
@@ -172,37 +392,237 @@ async def github_webhook(request: Request, background_tasks: BackgroundTasks):
             logger.info(f"Skipping commit with '/no-cr' in: {message}, id: {commit_id}")
             continue
 
-        if cr_db.get_reviewed_commit(commit_id, "github"):
-            logger.info(f"Skipping commit already reviewed: {commit_id}")
+        commit_ids.append(commit_id)
+        author = commit.get('author') or {}
+        authors[commit_id] = author.get('username') or author.get('name')
+
+    claimed = await reviewed_commits.claim(commit_ids, repo_full_name, "github")
+    if len(claimed) < len(commit_ids):
+        logger.info(f"Skipping {len(commit_ids) - len(claimed)} commit(s) already reviewed")
+    commit_ids = claimed
+    commits = [{"sha": commit_id, "author": authors.get(commit_id)} for commit_id in commit_ids]
+    target = {"source": "github", "repo": repo_full_name}
+
+    try:
+        if commit_ids and can_coalesce(data):
+            # the net diff of the branch would review the skipped commits too
+            split = len(commit_ids) < len(data.get('commits', []))
+            await enqueue_push("github", f"github:{repo_full_name}:{data['ref']}",
+                               dict(target, author=(data.get('pusher') or {}).get('name')), data, commits, split)
+        else:
+            await enqueue_commits(target, commits)
+    except Exception:
+        await reviewed_commits.release(commit_ids, repo_full_name, "github")
+        raise
+    await reviewed_commits.confirm(commit_ids, repo_full_name, "github")
+
+
+def can_coalesce(data):
+    # new and deleted branches have no range to diff
+    return (PUSH_COALESCE
+            and data.get('ref')
+            and not is_null_sha(data.get('before'))
+            and not is_null_sha(data.get('after')))
+
+
+async def enqueue_push(source, branch_key, target, data, commits, split):
+    # the push job waits out the debounce window, a newer push on the branch supersedes it
+    branch = await coalescer.on_push(branch_key, data['before'], data['after'], bool(data.get('forced')),
+                                     commits, split)
+    payload = dict(target, branch_key=branch_key, generation=branch["generation"])
+    await asyncio.to_thread(review_queue.enqueue, JOB_PUSH, payload,
+                            dedup_key=f"{branch_key}:{branch['generation']}", force=True, delay=PUSH_DEBOUNCE_SECONDS)
+
+
+async def enqueue_commits(target, commits):
+    key = target.get("repo") or target.get("project_id")
+    for commit in commits:
+        await asyncio.to_thread(review_queue.enqueue, JOB_COMMIT,
+                                dict(target, sha=commit["sha"], author=commit.get("author")),
+                                dedup_key=f"{target['source']}:{key}:{commit['sha']}", force=True)
+
+
+async def process_push_job(payload):
+    branch = await coalescer.claim(payload["branch_key"], payload["generation"])
+    if not branch:
+        logger.info(f"Push {payload['branch_key']}#{payload['generation']} was superseded by a newer push")
+        return
+
+    base, head = branch["base"], branch["head"]
+    target = {key: payload[key] for key in ("source", "repo", "project_id") if key in payload}
+    if branch.get("split"):
+        logger.info(f"Reviewing {base[:8]}..{head[:8]} of {payload['branch_key']} per commit, it skips commits")
+        return await enqueue_commits(target, branch.get("commits", []))
+
+    extra = {"branch_key": payload["branch_key"], "epoch": branch["epoch"], "author": payload.get("author")}
+    if payload["source"] == "gitlab":
+        diffs = await get_gitlab_compare(payload["project_id"], base, head)
+        logger.info(f"Reviewing net diff {base[:8]}..{head[:8]} of {payload['branch_key']}: {len(diffs)} files")
+        return await plan_gitlab_jobs(payload["project_id"], head, diffs, extra)
+
+    if git_mirror:
+        try:
+            file_changes = await git_mirror.get_diff(payload["repo"], base, head)
+        except GitError as e:
+            logger.warning(f"git mirror diff of {base}..{head} failed, using the compare api: {e}")
+            file_changes = await github_api.compare_files(payload["repo"], base, head)
+    else:
+        file_changes = await github_api.compare_files(payload["repo"], base, head)
+    if file_changes is None:
+        logger.info(f"Net diff {base[:8]}..{head[:8]} of {payload['branch_key']} is too large, reviewing per commit")
+        return await enqueue_commits(target, branch.get("commits", []))
+    logger.info(f"Reviewing net diff {base[:8]}..{head[:8]} of {payload['branch_key']}: {len(file_changes)} files")
+    await plan_github_jobs(payload["repo"], head, file_changes, extra)
+
+
+async def process_github_commit_job(payload):
+    repo_full_name = payload["repo"]
+    sha = payload["sha"]
+    file_changes = await get_file_changes(repo_full_name, sha)
+    await plan_github_jobs(repo_full_name, sha, file_changes, {"author": payload.get("author")})
+
+
+def filter_file_changes(file_changes, path_filter, get_path):
+    # files matching the skip rules and files without a usable diff never get a job
+    kept = []
+    for file_change in file_changes:
+        reason = utils.unreviewable_reason(file_change)
+        if reason is None and path_filter.matches(get_path(file_change)):
+            reason = "path"
+        if reason:
+            metrics.FILES_SKIPPED.inc(reason=reason)
+            continue
+        kept.append(file_change)
+    if len(kept) < len(file_changes):
+        logger.info(f"Skipping {len(file_changes) - len(kept)} of {len(file_changes)} files")
+    return kept
+
+
+def triage_file_changes(file_changes, describe):
+    # describe(file_change) -> (filename, patch, status), only the diffs triage keeps go on to the model
+    if not TRIAGE_ENABLED:
+        return file_changes
+    kept = []
+    for file_change in file_changes:
+        filename, patch, status = describe(file_change)
+        decision, reason = triage.classify(patch, filename, status)
+        metrics.TRIAGE_DECISIONS.inc(decision=decision, reason=reason)
+        if decision in TRIAGE_SKIP:
+            metrics.TRIAGE_SAVED_CALLS.inc()
+            metrics.TRIAGE_SAVED_TOKENS.inc(triage.saved_tokens(patch))
+            logger.info(f"Not reviewing {filename}: {decision} change ({reason})")
             continue
+        kept.append(file_change)
+    return kept
+
+
+def drop_empty_diffs(file_changes, get_patch):
+    # renames and deletions triage kept, or that never went through triage, have nothing to send to the model
+    kept = [file_change for file_change in file_changes if (get_patch(file_change) or "").strip()]
+    if len(kept) < len(file_changes):
+        metrics.FILES_SKIPPED.inc(len(file_changes) - len(kept), reason="empty")
+    return kept
+
+
+async def plan_github_jobs(repo_full_name, sha, file_changes, extra={}):
+    path_filter = await repo_path_filters.get(repo_full_name, sha)
+    file_changes = filter_file_changes(file_changes, path_filter, lambda fc: fc["filename"])
+    file_changes = triage_file_changes(file_changes,
+                                       lambda fc: (fc["filename"], fc.get("patch"), fc.get("status", "modified")))
+    file_changes = drop_empty_diffs(file_changes, lambda fc: fc.get("patch"))
+
+    try:
+        file_changes = await prefetch_file_contents(repo_full_name, sha, file_changes)
+    except Exception as e:
+        logger.warning(f"Prefetching the files of {repo_full_name}@{sha} failed, the jobs download them: {e}")
+
+    # tiny diffs are packed into shared requests, everything else gets a job of its own
+    jobs = []
+    small_changes = []
+    for file_change in file_changes:
+        # files reviewed with their enclosing functions need a request of their own
+        if (not has_symbol_source(file_change["filename"])
+                and diff_planner.is_packable(file_change.get("patch"), REVIEW_PACK_MAX_FILE_TOKENS)):
+            small_changes.append(file_change)
+            continue
+        jobs.append((JOB_FILE,
+                     dict(extra, source="github", repo=repo_full_name, sha=sha, file_change=file_change),
+                     f"github:{repo_full_name}:{sha}:{file_change['filename']}"))
+
+    batches = diff_planner.pack_files(small_changes, lambda fc: fc["patch"], REVIEW_MAX_PROMPT_TOKENS, REVIEW_PACK_MAX_FILES)
+    for batch in batches:
+        jobs.append((JOB_BATCH,
+                     dict(extra, source="github", repo=repo_full_name, sha=sha, file_changes=batch),
+                     f"github:{repo_full_name}:{sha}:batch:{batch[0]['filename']}"))
+
+    await enqueue_review_jobs(f"github:{repo_full_name}:{sha}", {"source": "github", "repo": repo_full_name, "sha": sha}, jobs)
+
 
-        file_changes = get_file_changes(data['repository']['full_name'], commit_id)
-        for file_change in file_changes:
-            background_tasks.add_task(review_and_comment, data['repository']['full_name'], commit_id, file_change)
+async def enqueue_review_jobs(commit_key, target, jobs):
+    publish_per_commit = REVIEW_PUBLISH_MODE == "commit" and jobs
+    if publish_per_commit:
+        # every job reports its reviews as one part, the last part to arrive publishes the commit
+        await asyncio.to_thread(publisher.publisher.start, commit_key, target, len(jobs))
+        for part, (_, payload, _) in enumerate(jobs):
+            payload["publish_key"] = commit_key
+            payload["publish_part"] = part
 
-        cr_db.add_reviewed_commit(commit_id, data['repository']['full_name'], "github")
+    for kind, payload, dedup_key in jobs:
+        await asyncio.to_thread(review_queue.enqueue, kind, payload, dedup_key=dedup_key, force=True)
 
-    # Return success message
-    return {"message": "Webhook received and processed successfully"}
+    if publish_per_commit:
+        # publishes whatever is there if some jobs never finish
+        await asyncio.to_thread(review_queue.enqueue, JOB_PUBLISH, {"publish_key": commit_key},
+                                dedup_key=f"{commit_key}:publish", force=True, delay=REVIEW_PUBLISH_TIMEOUT)
 
 
-def get_gitlab_diff(project_id, commit_id):
+async def get_gitlab_diff(project_id, commit_id):
     commit_url = f"{GITLAB_API_ORIGIN}/api/v4/projects/{project_id}/repository/commits/{commit_id}/diff"
     headers = {
         "Authorization": f"Bearer {GITLAB_API_TOKEN}"
     }
-    response = requests.get(commit_url, headers=headers)
+    response = await http_client.get(commit_url, headers=headers)
     diffs = response.json()
     return diffs
 
 
-def review_and_comment_gitlab(project_id, commit_id, diff):
+async def get_gitlab_compare(project_id, base, head):
+    compare_url = f"{GITLAB_API_ORIGIN}/api/v4/projects/{project_id}/repository/compare"
+    headers = {
+        "Authorization": f"Bearer {GITLAB_API_TOKEN}"
+    }
+    response = await http_client.get(compare_url, headers=headers, params={"from": base, "to": head})
+    return response.json().get("diffs", [])
+
+
+async def review_and_comment_gitlab(project_id, commit_id, diff):
     filename = diff["old_path"]
 
-    review = chat.get_review_for_patch(diff["diff"], filename)
+    if REVIEW_STREAM_MODE != "off":
+        # gitlab commit comments can not be edited, the streamed review is posted once complete
+        async def publish(review, final):
+            if final:
+                await post_gitlab_comment(project_id, commit_id, filename, review)
+
+        await chat.stream_review_for_patch(diff["diff"], filename, publish, incremental=False)
+        return
+
+    review = await chat.get_review_for_patch(diff["diff"], filename)
     if not review:
         return
 
+    await post_gitlab_comment(project_id, commit_id, filename, review)
+
+
+async def review_batch_and_comment_gitlab(project_id, commit_id, diffs):
+    reviews = await chat.get_reviews_for_patches([(diff["old_path"], diff["diff"]) for diff in diffs])
+    for diff in diffs:
+        review = reviews.get(diff["old_path"])
+        if review:
+            await post_gitlab_comment(project_id, commit_id, diff["old_path"], review)
+
+
+async def post_gitlab_comment(project_id, commit_id, filename, review):
     comment = f"*Auto Review*:\n\n`{filename}`\n\n*review*:\n\n{review}"
     commit_url = f"{GITLAB_API_ORIGIN}/api/v4/projects/{project_id}/repository/commits/{commit_id}/comments"
     comment_data = {
@@ -211,19 +631,21 @@ def review_and_comment_gitlab(project_id, commit_id, diff):
     headers = {
         "Authorization": f"Bearer {GITLAB_API_TOKEN}"
     }
-    response = requests.post(commit_url, json=comment_data, headers=headers)
+    with metrics.track("post_comment") as timer:
+        response = await publisher.send("POST", commit_url, headers, comment_data)
 
-    if response.status_code != 201:
-        logger.error(f"Failed to add comment to commit: {response.text}")
+        if not response or response.status_code != 201:
+            timer.status = "error"
+            logger.error(f"Failed to add comment to commit: {response.text if response else 'no response'}")
 
 
 @app.post("/gitlab-webhook")
-async def gitlab_webhook(request: Request, background_tasks: BackgroundTasks):
+async def gitlab_webhook(request: Request):
 
     # Verify signature
     signature = request.headers.get("X-Gitlab-Token")
     if not signature or signature != GITLAB_WEBHOOK_SECRET:
-        logger.error(f"Invalid signature")
+        logger.error("Invalid signature")
         return {"message": "Invalid signature"}
 
     body = await request.body()
@@ -232,18 +654,258 @@ async def gitlab_webhook(request: Request, background_tasks: BackgroundTasks):
     #     logger.error(f"Invalid signature")
     #     return {"message": "Invalid signature"}
 
-    # Process webhook
-    data = await request.json()
+    data = json.loads(body)
+    delivery_id = request.headers.get("X-Gitlab-Event-UUID") or hashlib.sha256(body).hexdigest()
+    try:
+        await asyncio.to_thread(review_queue.enqueue, JOB_WEBHOOK, {"source": "gitlab", "data": data},
+                                dedup_key=f"gitlab:delivery:{delivery_id}", priority=1)
+    except QueueFullError as e:
+        logger.error(f"Rejecting webhook: {e}")
+        return JSONResponse(status_code=503, content={"message": "Review queue is full"})
+
+    return JSONResponse(status_code=202, content={"message": "Webhook received"})
+
+
+async def process_gitlab_webhook_job(payload):
+    data = payload["data"]
+    project_id = data['project']['id']
+    commit_ids = []
+    authors = {}
     for commit in data.get('commits', []):
-        commit_id = commit['id']
-        diffs = get_gitlab_diff(data['project']['id'], commit['id'])
-        if cr_db.get_reviewed_commit(commit_id, "gitlab"):
-            logger.info(f"Skipping commit already reviewed: {commit_id}")
+        commit_ids.append(commit['id'])
+        authors[commit['id']] = (commit.get('author') or {}).get('name')
+
+    claimed = await reviewed_commits.claim(commit_ids, project_id, "gitlab")
+    if len(claimed) < len(commit_ids):
+        logger.info(f"Skipping {len(commit_ids) - len(claimed)} commit(s) already reviewed")
+    commit_ids = claimed
+    commits = [{"sha": commit_id, "author": authors.get(commit_id)} for commit_id in commit_ids]
+    target = {"source": "gitlab", "project_id": project_id}
+
+    try:
+        if commit_ids and can_coalesce(data):
+            split = len(commit_ids) < len(data.get('commits', []))
+            await enqueue_push("gitlab", f"gitlab:{project_id}:{data['ref']}",
+                               dict(target, author=data.get('user_username')), data, commits, split)
+        else:
+            await enqueue_commits(target, commits)
+    except Exception:
+        await reviewed_commits.release(commit_ids, project_id, "gitlab")
+        raise
+    await reviewed_commits.confirm(commit_ids, project_id, "gitlab")
+
+
+async def process_gitlab_commit_job(payload):
+    project_id = payload["project_id"]
+    sha = payload["sha"]
+    diffs = await get_gitlab_diff(project_id, sha)
+    await plan_gitlab_jobs(project_id, sha, diffs, {"author": payload.get("author")})
+
+
+def gitlab_status(diff):
+    if diff.get("deleted_file"):
+        return "removed"
+    if diff.get("renamed_file"):
+        return "renamed"
+    if diff.get("new_file"):
+        return "added"
+    return "modified"
+
+
+async def plan_gitlab_jobs(project_id, sha, diffs, extra={}):
+    # the repository filter file is only read from github, gitlab projects use the global rules
+    diffs = filter_file_changes(diffs, default_filter, lambda diff: diff["new_path"])
+    diffs = triage_file_changes(diffs, lambda diff: (diff["new_path"], diff.get("diff"), gitlab_status(diff)))
+    diffs = drop_empty_diffs(diffs, lambda diff: diff.get("diff"))
+
+    jobs = []
+    small_diffs = []
+    for diff in diffs:
+        if diff_planner.is_packable(diff.get("diff"), REVIEW_PACK_MAX_FILE_TOKENS):
+            small_diffs.append(diff)
             continue
-        for diff in diffs:
-            background_tasks.add_task(review_and_comment_gitlab, data['project']['id'], commit["id"], diff)
+        jobs.append((JOB_FILE,
+                     dict(extra, source="gitlab", project_id=project_id, sha=sha, diff=diff),
+                     f"gitlab:{project_id}:{sha}:{diff['old_path']}:{diff['new_path']}"))
+
+    batches = diff_planner.pack_files(small_diffs, lambda diff: diff["diff"], REVIEW_MAX_PROMPT_TOKENS, REVIEW_PACK_MAX_FILES)
+    for batch in batches:
+        jobs.append((JOB_BATCH,
+                     dict(extra, source="gitlab", project_id=project_id, sha=sha, diffs=batch),
+                     f"gitlab:{project_id}:{sha}:batch:{batch[0]['old_path']}"))
+
+    await enqueue_review_jobs(f"gitlab:{project_id}:{sha}", {"source": "gitlab", "project_id": project_id, "sha": sha}, jobs)
+
+
+async def process_webhook_job(payload):
+    if payload["source"] == "gitlab":
+        return await process_gitlab_webhook_job(payload)
+    return await process_github_webhook_job(payload)
+
+
+async def process_commit_job(payload):
+    if payload["source"] == "gitlab":
+        return await process_gitlab_commit_job(payload)
+    return await process_github_commit_job(payload)
+
+
+async def collect_reviews(payload):
+    reviews = {}
+    if payload["source"] == "gitlab":
+        if "diffs" in payload:
+            reviews = await chat.get_reviews_for_patches([(diff["old_path"], diff["diff"]) for diff in payload["diffs"]])
+        else:
+            diff = payload["diff"]
+            reviews[diff["old_path"]] = await chat.get_review_for_patch(diff["diff"], diff["old_path"])
+    else:
+        if "file_changes" in payload:
+            reviews = await chat.get_reviews_for_patches([(fc["filename"], fc["patch"]) for fc in payload["file_changes"]])
+        else:
+            file_change = payload["file_change"]
+            context = await get_symbol_context(payload["repo"], payload["sha"], file_change)
+            if context:
+                reviews[file_change["filename"]] = await chat.get_review_for_symbols(context, file_change["patch"], file_change["filename"])
+            else:
+                reviews[file_change["filename"]] = await chat.get_review_for_patch(file_change["patch"], file_change["filename"])
+
+    return [{"filename": filename, "review": review} for filename, review in reviews.items() if review]
+
+
+async def process_file_job(payload):
+    # reviews of a branch history that was force-pushed away are skipped or cancelled
+    with review_store.reviewing(payload), metrics.track("review_and_comment"):
+        return await coalescer.run(payload, review_file_job(payload))
+
+
+async def review_file_job(payload):
+    if "publish_key" in payload:
+        reviews = await collect_reviews(payload)
+        return await publisher.publisher.complete_part(payload["publish_key"], payload["publish_part"], reviews)
+
+    if payload["source"] == "gitlab":
+        return await review_and_comment_gitlab(payload["project_id"], payload["sha"], payload["diff"])
+    return await review_and_comment(payload["repo"], payload["sha"], payload["file_change"])
+
+
+async def process_batch_job(payload):
+    with review_store.reviewing(payload), metrics.track("review_and_comment"):
+        return await coalescer.run(payload, review_batch_job(payload))
+
+
+async def review_batch_job(payload):
+    if "publish_key" in payload:
+        reviews = await collect_reviews(payload)
+        return await publisher.publisher.complete_part(payload["publish_key"], payload["publish_part"], reviews)
+
+    if payload["source"] == "gitlab":
+        return await review_batch_and_comment_gitlab(payload["project_id"], payload["sha"], payload["diffs"])
+    return await review_batch_and_comment(payload["repo"], payload["sha"], payload["file_changes"])
+
+
+async def process_publish_job(payload):
+    await publisher.publisher.publish(payload["publish_key"])
+
+
+job_handlers = {
+    JOB_WEBHOOK: process_webhook_job,
+    JOB_COMMIT: process_commit_job,
+    JOB_FILE: process_file_job,
+    JOB_BATCH: process_batch_job,
+    JOB_PUBLISH: process_publish_job,
+    JOB_PUSH: process_push_job,
+}
+worker_pool = ReviewWorkerPool(review_queue, job_handlers, REVIEW_WORKERS)
+# a deep backlog moves reviews to the faster models
+model_router.count_backlog = review_queue.cached_pending_count
+
+
+def lsp_servers_by_language(attribute=None):
+    counts = {}
+    for server in list(lsp_pool.servers.values()):
+        language = server.key[0]
+        counts[language] = counts.get(language, 0) + (getattr(server, attribute) if attribute else 1)
+    return counts
+
+
+metrics.gauge("reviewbot_github_etag_cache_hits", "Conditional github requests answered from the ETag cache",
+              callback=lambda: github_api.etag_cache.hits)
+metrics.gauge("reviewbot_github_etag_cache_bytes", "Size of the bodies kept in the github ETag cache",
+              callback=lambda: github_api.etag_cache.size)
+metrics.gauge("reviewbot_review_cache_hits", "Reviews answered from the review cache of this process", ("tier",),
+              callback=lambda: {"memory": review_cache.memory_hits, "mongo": review_cache.mongo_hits})
+metrics.gauge("reviewbot_review_cache_misses", "Review cache lookups that had to ask the model",
+              callback=lambda: review_cache.misses)
+metrics.gauge("reviewbot_queue_pending", "Jobs waiting or running in the review queue",
+              callback=review_queue.cached_pending_count)
+metrics.gauge("reviewbot_openai_in_flight", "Model requests admitted by the rate limiter of each model", ("model",),
+              callback=lambda: model_router.limiter_values("in_flight"))
+metrics.gauge("reviewbot_openai_waiting", "Model requests waiting for the rate limiter of each model", ("model",),
+              callback=lambda: model_router.limiter_values("waiters"))
+metrics.gauge("reviewbot_lsp_servers", "Running language servers", ("language",),
+              callback=lsp_servers_by_language)
+metrics.gauge("reviewbot_lsp_in_flight", "Symbol requests in flight per language server", ("language",),
+              callback=lambda: lsp_servers_by_language("in_flight"))
+metrics.gauge("reviewbot_lsp_restarts", "Crash restarts of the running language servers", ("language",),
+              callback=lambda: lsp_servers_by_language("restarts"))
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # the queue depth callback may hit mongo, keep it off the loop
+    body = await asyncio.to_thread(metrics.registry.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/review-cache/stats")
+async def review_cache_stats():
+    return review_cache.stats()
+
+
+@app.get("/reviews")
+async def list_reviews(repo: str = None, author: str = None, source: str = None, sha: str = None,
+                       since: datetime = None, until: datetime = None,
+                       min_score: float = None, max_score: float = None,
+                       cursor: str = None, limit: int = 50):
+    # newest first, pass next_cursor back as cursor for the following page
+    try:
+        reviews, next_cursor = await review_store.review_store.query(
+            cursor=cursor, limit=limit, repo=repo, author=author, source=source, sha=sha,
+            since=since, until=until, min_score=min_score, max_score=max_score)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"message": "Invalid cursor"})
+    return {"reviews": reviews, "next_cursor": next_cursor}
+
+
+@app.get("/github-cache/stats")
+async def github_cache_stats():
+    return github_api.etag_cache.stats()
+
+
+@app.get("/reviewed-commits/stats")
+async def reviewed_commits_stats():
+    return reviewed_commits.stats()
+
+
+@app.get("/rate-limiter/stats")
+async def rate_limiter_stats():
+    return {name: values["limiter"] for name, values in model_router.stats()["models"].items()}
 
-        cr_db.add_reviewed_commit(commit_id, data['project']['id'], "gitlab")
 
-    # Return success message
-    return {"message": "Webhook received and processed successfully"}
+@app.get("/model-router/stats")
+async def model_router_stats():
+    return model_router.stats()
+
+
+@app.on_event("startup")
+async def start_workers():
+    # api processes only accept webhooks, the worker processes review
+    if APP_ROLE != "api":
+        lsp_pool.start()
+        await worker_pool.start()
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    await worker_pool.stop(REVIEW_DRAIN_TIMEOUT)
+    await http_client.close_session()
+    await lsp_pool.shutdown()
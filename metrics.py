@@ -0,0 +1,227 @@
+import time
+import bisect
+import asyncio
+import threading
+
+# seconds, from a cached webhook answer up to a slow model completion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames: tuple, values: tuple, extra: str = ""):
+    parts = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, "", value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labelnames, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # callback() returns the value, or {label values: value} for a labelled gauge, at scrape time
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [(self.name, key if isinstance(key, tuple) else (key,), "", v) for key, v in value.items()]
+        return [(self.name, (), "", value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", key, f'le="{format_value(float(bound))}"', cumulative))
+                samples.append((f"{self.name}_bucket", key, 'le="+Inf"', count))
+                samples.append((f"{self.name}_sum", key, "", total))
+                samples.append((f"{self.name}_count", key, "", count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = (), callback=None):
+    return registry.register(Gauge(name, documentation, labelnames, callback))
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+class Timer(object):
+    # times a block into a histogram, an exception marks the sample as an error unless status was set
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.status = None
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.status:
+            status = self.status
+        elif exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, asyncio.CancelledError):
+            status = "cancelled"
+        else:
+            status = "error"
+        self.histogram.observe(time.perf_counter() - self.start, status=status, **self.labels)
+        return False
+
+
+HTTP_REQUEST_SECONDS = histogram("reviewbot_http_request_seconds",
+                                 "Latency of the requests served by the app",
+                                 ("method", "path", "status"))
+STAGE_SECONDS = histogram("reviewbot_stage_seconds",
+                          "Latency of the review pipeline stages",
+                          ("stage", "status"))
+JOB_SECONDS = histogram("reviewbot_job_seconds",
+                        "Latency of the queued jobs by kind",
+                        ("kind", "status"))
+EXTERNAL_REQUEST_SECONDS = histogram("reviewbot_external_request_seconds",
+                                     "Latency of the requests to github, gitlab and openai",
+                                     ("service", "status"))
+LSP_SECONDS = histogram("reviewbot_lsp_seconds",
+                        "Latency of the language server spawn, initialize and symbol requests",
+                        ("language", "stage", "status"))
+OPENAI_TOKENS = counter("reviewbot_openai_tokens_total",
+                        "Tokens sent to and received from the model, rate() gives tokens per second",
+                        ("model", "kind"))
+REVIEW_CONTEXT_TOKENS = counter("reviewbot_review_context_tokens_total",
+                                "Estimated tokens of the symbol context reviews, against the whole files and the raw patches",
+                                ("kind",))
+FILES_SKIPPED = counter("reviewbot_files_skipped_total",
+                        "Files dropped before review by the path rules or for a binary, truncated or empty diff",
+                        ("reason",))
+TRIAGE_DECISIONS = counter("reviewbot_triage_decisions_total",
+                           "Files classified by the local triage before review", ("decision", "reason"))
+TRIAGE_SAVED_CALLS = counter("reviewbot_triage_saved_calls_total",
+                             "Files triage kept away from the model, packed files would have shared a request")
+TRIAGE_SAVED_TOKENS = counter("reviewbot_triage_saved_tokens_total",
+                              "Estimated prompt tokens of the diffs triage kept away from the model")
+MODEL_REQUEST_SECONDS = histogram("reviewbot_model_request_seconds",
+                                  "Latency of every model request by model, status is ok, error, rate_limited or cancelled",
+                                  ("model", "status"))
+MODEL_COST = counter("reviewbot_model_cost_usd_total", "Spend on the model by the configured per 1k token prices",
+                     ("model",))
+MODEL_ROUTES = counter("reviewbot_model_routes_total",
+                       "Requests routed to a model first, reason is the diff size, path, language, load or fallback",
+                       ("model", "reason"))
+JOBS_IN_FLIGHT = gauge("reviewbot_jobs_in_flight", "Jobs being handled by the workers of this process", ("kind",))
+
+
+def track(stage: str):
+    return Timer(STAGE_SECONDS, {"stage": stage})
+
+
+def track_external(service: str):
+    return Timer(EXTERNAL_REQUEST_SECONDS, {"service": service})
+
+
+def track_lsp(language: str, stage: str):
+    return Timer(LSP_SECONDS, {"language": language, "stage": stage})
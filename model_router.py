@@ -0,0 +1,227 @@
+import re
+import time
+import asyncio
+import logging
+
+import config
+import metrics
+import utils
+from rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# the account limits are split between the processes that review, serve.py runs the api processes as reviewers
+# when there are no worker processes
+if config.APP_ROLE == "worker":
+    rate_share = max(1, config.WORKER_PROCESSES)
+elif config.APP_ROLE == "all" and config.WORKER_PROCESSES == 0 and config.REVIEW_QUEUE_BACKEND != "memory":
+    rate_share = max(1, config.API_PROCESSES)
+else:
+    rate_share = 1
+
+# weight of the newest request in the average latency of a model
+LATENCY_SMOOTHING = 0.2
+
+
+class ModelTier(object):
+    # one model with its own rate limiter (openai limits are per model), health and spend
+    def __init__(self, name: str, prompt_cost: float, completion_cost: float, context_tokens: int):
+        self.name = name
+        # usd per 1k tokens
+        self.prompt_cost = prompt_cost
+        self.completion_cost = completion_cost
+        # 0 is unknown, every prompt fits
+        self.context_tokens = context_tokens
+        self.limiter = RateLimiter(config.OPENAI_RPM, config.OPENAI_TPM, config.OPENAI_MAX_CONCURRENCY, share=rate_share)
+
+        self.failures = 0
+        self.open_until = 0.0
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.cost = 0.0
+
+    def fits(self, tokens: int):
+        return not self.context_tokens or tokens <= self.context_tokens
+
+    def healthy(self, now: float):
+        return self.open_until <= now
+
+    def cost_of(self, prompt_tokens: int, completion_tokens: int):
+        return (prompt_tokens * self.prompt_cost + completion_tokens * self.completion_cost) / 1000
+
+    def stats(self):
+        return {"requests": self.requests,
+                "errors": self.errors,
+                "average_latency_seconds": round(self.latency, 3) if self.latency is not None else None,
+                "cost_usd": round(self.cost, 4),
+                "degraded_for_seconds": round(max(0.0, self.open_until - time.monotonic()), 1),
+                "limiter": self.limiter.stats()}
+
+
+def parse_tiers(text: str):
+    # name:prompt cost:completion cost:context tokens, comma separated, the costs and the context are optional
+    tiers = []
+    for item in text.split(","):
+        fields = [field.strip() for field in item.split(":")]
+        if not fields[0]:
+            continue
+        try:
+            prompt_cost = float(fields[1]) if len(fields) > 1 and fields[1] else 0.0
+            completion_cost = float(fields[2]) if len(fields) > 2 and fields[2] else prompt_cost
+            context_tokens = int(fields[3]) if len(fields) > 3 and fields[3] else 0
+        except ValueError:
+            logger.error(f"Invalid model tier {item.strip()!r}, expected name:prompt cost:completion cost:context tokens")
+            continue
+        tiers.append(ModelTier(fields[0], prompt_cost, completion_cost, context_tokens))
+    return tiers
+
+
+class ModelRouter(object):
+    """Picks the models a request is sent to, the tiers are ordered from the deepest to the fastest.
+
+    Large diffs, sensitive paths and the deep languages start at the deepest tier, small diffs at the fastest,
+    everything else in the middle. Queue pressure moves the start towards the fastest tier, all the way under
+    burst load, sensitive paths by one tier at most. The tiers after the start are the fallbacks, a model that
+    keeps failing or turned slow is tried last until its cooldown is over.
+    """
+
+    def __init__(self, tiers: list, small_tokens: int, large_tokens: int, sensitive_paths: list,
+                 deep_languages: set, burst_pending: int, burst_waiting: int,
+                 failure_threshold: int, cooldown: float, slow_seconds: float):
+        if not tiers:
+            raise ValueError("no model tiers configured")
+        self.tiers = tiers
+        self.small_tokens = small_tokens
+        self.large_tokens = large_tokens
+        self.sensitive_regex = re.compile("|".join(re.escape(word) for word in sensitive_paths),
+                                          re.IGNORECASE) if sensitive_paths else None
+        self.deep_languages = deep_languages
+        self.burst_pending = burst_pending
+        self.burst_waiting = burst_waiting
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_seconds = slow_seconds
+
+        # count_backlog() returns the number of queued jobs, main sets it, the count is refreshed off the loop
+        self.count_backlog = None
+        self.backlog = 0
+        self.backlog_checked = 0.0
+        self.backlog_interval = 5.0
+
+    def sensitive(self, filename: str):
+        return self.sensitive_regex is not None and self.sensitive_regex.search(filename) is not None
+
+    def pressure(self):
+        # 1.0 is burst load, from 0.5 the router steps one tier faster
+        waiting = sum(len(tier.limiter.waiters) for tier in self.tiers)
+        pressure = waiting / self.burst_waiting if self.burst_waiting else 0.0
+        if self.burst_pending:
+            pressure = max(pressure, self.backlog / self.burst_pending)
+        return pressure
+
+    async def refresh_backlog(self):
+        now = time.monotonic()
+        if self.count_backlog is None or now - self.backlog_checked < self.backlog_interval:
+            return
+        self.backlog_checked = now
+        try:
+            # counting the queue is a database call
+            self.backlog = await asyncio.to_thread(self.count_backlog)
+        except Exception as e:
+            logger.warning(f"Counting the review queue for the model router failed: {e}")
+
+    def start(self, tokens: int, filenames: list):
+        # (tier index, reason, whether load may not move it to the fastest tier)
+        last = len(self.tiers) - 1
+        if any(self.sensitive(filename) for filename in filenames):
+            return 0, "sensitive path", True
+        if self.deep_languages and any(utils.get_language_type(filename) in self.deep_languages for filename in filenames):
+            return 0, "language", False
+        if tokens >= self.large_tokens:
+            return 0, "large diff", False
+        if tokens <= self.small_tokens:
+            return last, "small diff", False
+        return (last + 1) // 2, "default", False
+
+    def route(self, prompt_tokens: int, request_tokens: int, filenames: list = (), count: bool = True):
+        """Returns the tiers to try in order.
+
+        prompt_tokens is the size of the diff the router looks at, request_tokens the whole request with the system
+        prompt and the expected answer that has to fit the context of a model. count=False leaves the route out of
+        reviewbot_model_routes_total, the caller only looks up the cache.
+        """
+        last = len(self.tiers) - 1
+        index, reason, protected = self.start(prompt_tokens, filenames)
+
+        pressure = self.pressure()
+        if pressure >= 1 and not protected:
+            shifted = last
+        elif pressure >= 0.5:
+            shifted = min(last, index + 1)
+        else:
+            shifted = index
+        if shifted != index:
+            reason = "load"
+
+        # towards the faster tiers first, the deeper ones are the last resort
+        order = [self.tiers[i] for i in list(range(shifted, last + 1)) + list(range(shifted - 1, -1, -1))]
+        order = [tier for tier in order if tier.fits(request_tokens)] or order
+        now = time.monotonic()
+        candidates = [tier for tier in order if tier.healthy(now)]
+        if not candidates or candidates[0] is not order[0]:
+            reason = "fallback"
+        candidates += [tier for tier in order if not tier.healthy(now)]
+
+        if count:
+            metrics.MODEL_ROUTES.inc(model=candidates[0].name, reason=reason)
+        return candidates
+
+    def record(self, tier: ModelTier, status: str, latency: float, prompt_tokens: int = 0, completion_tokens: int = 0):
+        # one request to the model, status is ok, error, rate_limited or cancelled
+        metrics.MODEL_REQUEST_SECONDS.observe(latency, model=tier.name, status=status)
+        if status == "cancelled":
+            return
+        tier.requests += 1
+        if status == "ok":
+            cost = tier.cost_of(prompt_tokens, completion_tokens)
+            tier.cost += cost
+            metrics.MODEL_COST.inc(cost, model=tier.name)
+            tier.failures = 0
+            tier.latency = latency if tier.latency is None else \
+                tier.latency + (latency - tier.latency) * LATENCY_SMOOTHING
+            if self.slow_seconds and tier.latency > self.slow_seconds:
+                self.degrade(tier, f"average latency {tier.latency:.1f}s")
+            return
+
+        tier.errors += 1
+        tier.failures += 1
+        if tier.failures >= self.failure_threshold:
+            self.degrade(tier, f"{tier.failures} failed requests in a row")
+
+    def degrade(self, tier: ModelTier, why: str):
+        if len(self.tiers) > 1:
+            logger.warning(f"Model {tier.name} is degraded ({why}), other models go first for {self.cooldown:.0f}s")
+        tier.open_until = time.monotonic() + self.cooldown
+        tier.failures = 0
+        # the average starts over after the cooldown
+        tier.latency = None
+
+    def limiter_values(self, attribute: str):
+        # {model: value} for the labelled gauges, waiters is counted
+        values = {}
+        for tier in self.tiers:
+            value = getattr(tier.limiter, attribute)
+            values[tier.name] = len(value) if isinstance(value, list) else value
+        return values
+
+    def stats(self):
+        return {"pressure": round(self.pressure(), 3),
+                "backlog": self.backlog,
+                "models": {tier.name: tier.stats() for tier in self.tiers}}
+
+
+model_router = ModelRouter(parse_tiers(config.MODEL_TIERS), config.ROUTER_SMALL_TOKENS, config.ROUTER_LARGE_TOKENS,
+                           config.ROUTER_SENSITIVE_PATHS, config.ROUTER_DEEP_LANGUAGES,
+                           config.ROUTER_BURST_PENDING, config.ROUTER_BURST_WAITING,
+                           config.ROUTER_FAILURE_THRESHOLD, config.ROUTER_COOLDOWN, config.ROUTER_SLOW_SECONDS)
@@ -0,0 +1,196 @@
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# gitignore style: a pattern without a slash matches a file or directory name at any depth, a trailing slash only
+# matches directories, any other slash anchors the pattern at the repository root, ! re-includes, the last match wins
+DEFAULT_RULES = [
+    # docs, data and config
+    "*.txt", "*.json", "*.xml", "*.csv", "*.md", "*.log", "*.ini", "*.yml", "*.cmake",
+    # compiled
+    "*.pyc", "*.class",
+    # assets
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.eot", "*.ttf", "*.woff", "*.woff2",
+    # well known files
+    "README.md", "LICENSE", ".gitignore", "package-lock.json", "yarn.lock", "Makefile", "Dockerfile",
+    # tool and build output folders
+    "__pycache__/", ".git/", ".vscode/", "node_modules/", "dist/", "build/",
+]
+
+WILDCARD_CHARS = set("*?[")
+
+
+def parse_rules(text: str):
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            rules.append(line)
+    return rules
+
+
+def glob_to_regex(glob: str):
+    parts = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif glob[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif glob[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif glob[i] == "[" and "]" in glob[i + 1:]:
+            end = glob.index("]", i + 1)
+            body = glob[i + 1:end]
+            parts.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+            i = end + 1
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return "".join(parts)
+
+
+class RuleBlock(object):
+    # consecutive rules of the same polarity, literal names go to sets, suffixes and globs to one regex
+    def __init__(self, negated: bool):
+        self.negated = negated
+        self.names = set()
+        self.dir_names = set()
+        self.suffixes = []
+        self.patterns = []
+        self.regex = None
+
+    def add(self, rule: str):
+        directory_only = rule.endswith("/")
+        rule = rule.rstrip("/")
+        if not rule:
+            return
+        anchored = "/" in rule
+        rule = rule.lstrip("/")
+        wildcards = WILDCARD_CHARS.intersection(rule)
+
+        if not anchored and not wildcards:
+            (self.dir_names if directory_only else self.names).add(rule)
+        elif not anchored and not directory_only and rule.startswith("*") and not WILDCARD_CHARS.intersection(rule[1:]):
+            self.suffixes.append(rule[1:])
+        else:
+            prefix = "^" if anchored else "(?:^|/)"
+            self.patterns.append(prefix + glob_to_regex(rule) + ("/" if directory_only else "(?:/|$)"))
+
+    def compile(self):
+        patterns = list(self.patterns)
+        if self.suffixes:
+            # a literal alternation is much cheaper than testing every path component in python
+            suffixes = "|".join(re.escape(suffix) for suffix in sorted(set(self.suffixes), key=len, reverse=True))
+            patterns.append(f"(?:{suffixes})(?:/|$)")
+        if patterns:
+            self.regex = re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+
+    def matches(self, path: str, parts: list):
+        # parts are the directory names followed by the file name
+        if self.names and not self.names.isdisjoint(parts):
+            return True
+        if self.dir_names and not self.dir_names.isdisjoint(parts[:-1]):
+            return True
+        return self.regex is not None and self.regex.search(path) is not None
+
+
+class PathFilter(object):
+    """Compiled skip rules, matches(path) is True for a file that should not be reviewed."""
+
+    def __init__(self, rules: list):
+        self.rules = list(rules)
+        self.blocks = []
+        for rule in self.rules:
+            negated = rule.startswith("!")
+            if negated:
+                rule = rule[1:]
+            if not self.blocks or self.blocks[-1].negated != negated:
+                self.blocks.append(RuleBlock(negated))
+            self.blocks[-1].add(rule)
+        for block in self.blocks:
+            block.compile()
+        # the last matching rule decides, so the blocks are tried from the end
+        self.blocks.reverse()
+
+    def matches(self, path: str):
+        path = path.lstrip("/")
+        parts = path.split("/")
+        for block in self.blocks:
+            if block.matches(path, parts):
+                return not block.negated
+        return False
+
+    def split(self, paths: list):
+        # (kept, skipped)
+        kept, skipped = [], []
+        for path in paths:
+            (skipped if self.matches(path) else kept).append(path)
+        return kept, skipped
+
+
+global_rules = DEFAULT_RULES + [rule.strip() for rule in config.REVIEW_SKIP_RULES.split(",") if rule.strip()]
+default_filter = PathFilter(global_rules)
+
+
+class RepoPathFilters(object):
+    # the global rules followed by the rules of the repository's filter file, cached per repository
+    def __init__(self, ttl: float, max_entries: int, filename: str):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.loading = {}
+
+    async def load(self, repo_full_name: str, sha: str):
+        import utils
+        from github_api import GithubApiError
+        try:
+            text = await utils.download_file(repo_full_name, self.filename, sha)
+        except GithubApiError as e:
+            if e.status_code != 404:
+                raise
+            text = ""
+        rules = parse_rules(text)
+        if rules:
+            logger.info(f"{repo_full_name} adds {len(rules)} review filter rules from {self.filename}")
+        return PathFilter(global_rules + rules) if rules else default_filter
+
+    async def get(self, repo_full_name: str, sha: str):
+        entry = self.entries.get(repo_full_name)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(repo_full_name)
+            return entry[1]
+
+        # the jobs of one push share a single download
+        task = self.loading.get(repo_full_name)
+        if task is None:
+            task = asyncio.ensure_future(self.load(repo_full_name, sha))
+            self.loading[repo_full_name] = task
+            task.add_done_callback(lambda _: self.loading.pop(repo_full_name, None))
+        try:
+            path_filter = await asyncio.shield(task)
+        except Exception as e:
+            logger.error(f"Loading {self.filename} of {repo_full_name} failed, using the global rules: {e}")
+            return default_filter
+
+        self.entries[repo_full_name] = (time.monotonic() + self.ttl, path_filter)
+        self.entries.move_to_end(repo_full_name)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return path_filter
+
+
+repo_path_filters = RepoPathFilters(config.REVIEW_FILTER_TTL, config.REVIEW_FILTER_CACHE_SIZE, config.REVIEW_FILTER_FILE)
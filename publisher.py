@@ -0,0 +1,324 @@
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import aiohttp
+from pymongo import ReturnDocument
+
+import config
+import http_client
+import github_api
+from rate_limiter import backoff_delay, parse_duration
+
+logger = logging.getLogger(__name__)
+
+# github allows 65536 characters per comment, keep room for the header
+MAX_COMMENT_LENGTH = 60000
+RETRY_STATUS = {403, 429, 500, 502, 503, 504}
+
+STATUS_PENDING = "pending"
+STATUS_PUBLISHING = "publishing"
+STATUS_PUBLISHED = "published"
+
+# like the created_at index of the mongo store, published commits are dropped from memory sooner
+COMMIT_TTL = 7 * 24 * 3600
+PUBLISHED_TTL = 3600
+# comment listing pages read per publish, 100 comments each
+MAX_COMMENT_PAGES = 50
+
+
+class Pacer(object):
+    # spaces out content-creating requests to one host to stay under secondary rate limits
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.next_at = 0.0
+        self.lock = None
+
+    async def wait(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            delay = self.next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_at = time.monotonic() + self.min_interval
+
+    def pause(self, seconds: float):
+        self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+
+pacers = {}
+
+
+def get_pacer(url: str):
+    host = urlparse(url).netloc
+    pacer = pacers.get(host)
+    if pacer is None:
+        pacer = pacers[host] = Pacer(config.PUBLISH_MIN_INTERVAL)
+    return pacer
+
+
+def get_retry_after(response):
+    retry_after = parse_duration(response.headers.get("Retry-After"))
+    if retry_after is not None:
+        return retry_after
+    if response.headers.get("x-ratelimit-remaining") == "0":
+        reset = response.headers.get("x-ratelimit-reset")
+        if reset:
+            return max(0.0, float(reset) - time.time())
+    return None
+
+
+async def send(method: str, url: str, headers: dict, json_data=None):
+    pacer = get_pacer(url)
+    response = None
+    for attempt in range(config.PUBLISH_MAX_RETRIES + 1):
+        await pacer.wait()
+        try:
+            response = await http_client.request(method, url, headers=headers, json_data=json_data)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = backoff_delay(attempt)
+            logger.warning(f"{method} {url} failed, retry {attempt + 1} in {delay:.1f}s: {e}")
+        else:
+            if response.status_code not in RETRY_STATUS:
+                return response
+            # a 403 is only worth retrying when it is a (secondary) rate limit
+            if response.status_code == 403 and "rate limit" not in response.text.lower():
+                return response
+            delay = get_retry_after(response) or backoff_delay(attempt)
+            logger.warning(f"{method} {url} returned {response.status_code}, retry {attempt + 1} in {delay:.1f}s")
+        pacer.pause(delay)
+    return response
+
+
+def idempotency_marker(key: str):
+    return f"<!-- reviewbot:{key} -->"
+
+
+def split_comment(sections: list, header: str):
+    bodies = []
+    current = header
+    for section in sections:
+        if len(current) + len(section) > MAX_COMMENT_LENGTH and current != header:
+            bodies.append(current)
+            current = header
+        current += section[:MAX_COMMENT_LENGTH - len(header)]
+    bodies.append(current)
+    return bodies
+
+
+class MongoPublishStore(object):
+    def __init__(self, db):
+        self.commits = db["commit_reviews"]
+        self.commits.create_index([("created_at", 1)], expireAfterSeconds=COMMIT_TTL)
+
+    def start(self, key: str, target: dict, expected: int):
+        self.commits.update_one(
+            {"_id": key},
+            {"$setOnInsert": {"target": target,
+                              "expected": expected,
+                              "reviews": {},
+                              "status": STATUS_PENDING,
+                              "created_at": datetime.utcnow()}},
+            upsert=True)
+
+    def complete_part(self, key: str, part: int, reviews: list):
+        doc = self.commits.find_one_and_update(
+            {"_id": key},
+            {"$set": {f"reviews.{part}": reviews}},
+            return_document=ReturnDocument.AFTER)
+        return doc is not None and len(doc["reviews"]) >= doc["expected"]
+
+    def claim(self, key: str, stale_after: float):
+        now = datetime.utcnow()
+        return self.commits.find_one_and_update(
+            {"_id": key,
+             "$or": [{"status": STATUS_PENDING},
+                     {"status": STATUS_PUBLISHING, "claimed_at": {"$lt": now - timedelta(seconds=stale_after)}}]},
+            {"$set": {"status": STATUS_PUBLISHING, "claimed_at": now}},
+            return_document=ReturnDocument.AFTER)
+
+    def finish(self, key: str, published: bool):
+        self.commits.update_one({"_id": key},
+                                {"$set": {"status": STATUS_PUBLISHED if published else STATUS_PENDING}})
+
+
+class MemoryPublishStore(object):
+    def __init__(self):
+        self.commits = {}
+        self.lock = threading.Lock()
+        self.pruned_at = time.monotonic()
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self.pruned_at < 60:
+            return
+        self.pruned_at = now
+        expired = [key for key, doc in self.commits.items()
+                   if now - doc["created_at"] > COMMIT_TTL
+                   or (doc["status"] == STATUS_PUBLISHED and now - doc["finished_at"] > PUBLISHED_TTL)]
+        for key in expired:
+            del self.commits[key]
+
+    def start(self, key: str, target: dict, expected: int):
+        with self.lock:
+            self._prune()
+            self.commits.setdefault(key, {"_id": key,
+                                          "target": target,
+                                          "expected": expected,
+                                          "reviews": {},
+                                          "status": STATUS_PENDING,
+                                          "claimed_at": None,
+                                          "created_at": time.monotonic(),
+                                          "finished_at": None})
+
+    def complete_part(self, key: str, part: int, reviews: list):
+        with self.lock:
+            doc = self.commits.get(key)
+            if doc is None:
+                return False
+            doc["reviews"][str(part)] = reviews
+            return len(doc["reviews"]) >= doc["expected"]
+
+    def claim(self, key: str, stale_after: float):
+        now = datetime.utcnow()
+        with self.lock:
+            doc = self.commits.get(key)
+            if doc is None:
+                return None
+            stale = doc["status"] == STATUS_PUBLISHING and doc["claimed_at"] < now - timedelta(seconds=stale_after)
+            if doc["status"] != STATUS_PENDING and not stale:
+                return None
+            doc["status"] = STATUS_PUBLISHING
+            doc["claimed_at"] = now
+            return dict(doc)
+
+    def finish(self, key: str, published: bool):
+        with self.lock:
+            if key in self.commits:
+                self.commits[key]["status"] = STATUS_PUBLISHED if published else STATUS_PENDING
+                self.commits[key]["finished_at"] = time.monotonic()
+
+
+class CommitPublisher(object):
+    # collects every file review of a commit and posts them with as few api calls as possible
+    def __init__(self, store):
+        self.store = store
+
+    def start(self, key: str, target: dict, expected: int):
+        self.store.start(key, target, expected)
+
+    async def complete_part(self, key: str, part: int, reviews: list):
+        done = await asyncio.to_thread(self.store.complete_part, key, part, reviews)
+        if done:
+            await self.publish(key)
+
+    async def publish(self, key: str):
+        doc = await asyncio.to_thread(self.store.claim, key, config.REVIEW_QUEUE_VISIBILITY_TIMEOUT)
+        if not doc:
+            return
+
+        try:
+            parts = sorted(doc["reviews"].items(), key=lambda item: int(item[0]))
+            reviews = [review for _, part_reviews in parts for review in part_reviews]
+            missing = doc["expected"] - len(parts)
+            if reviews:
+                target = doc["target"]
+                if target["source"] == "gitlab":
+                    await self.publish_gitlab(key, target, reviews, missing)
+                else:
+                    await self.publish_github(key, target, reviews, missing)
+        except Exception:
+            await asyncio.to_thread(self.store.finish, key, False)
+            raise
+
+        await asyncio.to_thread(self.store.finish, key, True)
+
+    def build_sections(self, reviews: list, missing: int, file_header):
+        sections = [file_header(review["filename"]) + review["review"] + "\n\n" for review in reviews]
+        if missing:
+            sections.append(f"_{missing} review job(s) did not finish in time and are not included._\n")
+        return sections
+
+    async def publish_github(self, key: str, target: dict, reviews: list, missing: int):
+        repo_full_name = target["repo"]
+        sha = target["sha"]
+        sections = self.build_sections(reviews, missing, lambda filename: f"#### `{filename}`\n")
+        bodies = split_comment(sections, "#### *Auto Review*:\n")
+
+        if config.TEST_APP:
+            for body in bodies:
+                logger.info(f"Review of {sha}: {body}")
+            return
+
+        headers = {
+            "Authorization": f"Bearer {config.GITHUB_API_TOKEN}",
+            "Accept": "application/vnd.github+json",
+        }
+        comments_url = f"{config.GITHUB_API_ORIGIN}/repos/{repo_full_name}/commits/{sha}/comments"
+        existing = await self.existing_bodies(comments_url, headers, "body")
+
+        for i, body in enumerate(bodies):
+            marker = idempotency_marker(f"{key}:{i}")
+            if any(marker in text for text in existing):
+                logger.info(f"Comment {key}:{i} already published")
+                continue
+            response = await send("POST", comments_url, headers, {"body": f"{body}\n{marker}"})
+            if not response or response.status_code != 201:
+                raise RuntimeError(f"Failed to add comment to commit: {response.text if response else 'no response'}")
+
+    async def publish_gitlab(self, key: str, target: dict, reviews: list, missing: int):
+        project_id = target["project_id"]
+        sha = target["sha"]
+        sections = self.build_sections(reviews, missing, lambda filename: f"`{filename}`\n\n")
+        bodies = split_comment(sections, "*Auto Review*:\n\n")
+
+        if config.TEST_APP:
+            for body in bodies:
+                logger.info(f"Review of {sha}: {body}")
+            return
+
+        headers = {
+            "Authorization": f"Bearer {config.GITLAB_API_TOKEN}"
+        }
+        comments_url = f"{config.GITLAB_API_ORIGIN}/api/v4/projects/{project_id}/repository/commits/{sha}/comments"
+        existing = await self.existing_bodies(comments_url, headers, "note")
+
+        for i, body in enumerate(bodies):
+            marker = idempotency_marker(f"{key}:{i}")
+            if any(marker in text for text in existing):
+                logger.info(f"Comment {key}:{i} already published")
+                continue
+            response = await send("POST", comments_url, headers, {"note": f"{body}\n{marker}"})
+            if not response or response.status_code != 201:
+                raise RuntimeError(f"Failed to add comment to commit: {response.text if response else 'no response'}")
+
+    async def existing_bodies(self, comments_url: str, headers: dict, field: str):
+        # one listing per publish makes retries idempotent, the marker tells which parts already went out,
+        # github and gitlab both link the next page in the Link header
+        bodies = []
+        url, params = comments_url, {"per_page": 100}
+        for _ in range(MAX_COMMENT_PAGES):
+            response = await http_client.get(url, headers=headers, params=params)
+            if response.status_code != 200:
+                break
+            bodies.extend(comment.get(field) or "" for comment in response.json())
+            url, params = github_api.next_page_url(response), None
+            if not url:
+                break
+        return bodies
+
+
+def create_publisher():
+    if config.REVIEW_QUEUE_BACKEND == "memory":
+        store = MemoryPublishStore()
+    else:
+        from cr_db import cr_db
+        store = MongoPublishStore(cr_db.db)
+    return CommitPublisher(store)
+
+
+publisher = create_publisher()
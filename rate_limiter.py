@@ -0,0 +1,188 @@
+import re
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+DURATION_REGEX = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str):
+    # openai reset headers look like "1s", "6m0s" or "20ms"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = DURATION_REGEX.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0):
+    # full jitter exponential backoff
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket(object):
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.capacity / 60.0
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float):
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate if self.rate else float("inf")
+
+    def set_limit(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = min(self.level, per_minute)
+
+
+class RateLimiter(object):
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_concurrency: int,
+                 priority_tokens_per_second: float = 1000.0, share: int = 1):
+        # share > 1 when several processes spend the same account, each one keeps 1/share of the budget
+        self.share = share
+        self.requests = TokenBucket(requests_per_minute / share)
+        self.tokens = TokenBucket(tokens_per_minute / share)
+        self.max_concurrency = max(1, max_concurrency // share)
+        # a request of n tokens is ordered as if it arrived n / priority_tokens_per_second seconds later,
+        # small requests overtake big ones but nothing waits forever
+        self.priority_tokens_per_second = priority_tokens_per_second
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.waiters = []
+        self.seq = itertools.count()
+        self.wakeup = None
+        self.pump_task = None
+
+        self.admitted = 0
+        self.rate_limited = 0
+
+    def _clamp(self, tokens: int):
+        return max(1, min(tokens, self.tokens.capacity))
+
+    def _wait_time(self, tokens: int):
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    async def acquire(self, tokens: int, priority: float = None):
+        tokens = self._clamp(tokens)
+        if priority is None:
+            priority = time.monotonic() + tokens / self.priority_tokens_per_second
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), tokens, future))
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # admitted and cancelled in the same tick, give the slot back
+                self.release(tokens, 0)
+            raise
+
+    def release(self, estimated_tokens: int, used_tokens: int = 0):
+        self.in_flight -= 1
+        if used_tokens:
+            # charge the real usage, the estimate was taken at admission
+            self.tokens.level -= used_tokens - self._clamp(estimated_tokens)
+        self._schedule()
+
+    def _schedule(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.create_task(self._pump())
+        else:
+            self.wakeup.set()
+
+    async def _pump(self):
+        while self.waiters:
+            priority, _, tokens, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+
+            wait = self._wait_time(tokens)
+            if wait <= 0 and self.in_flight < self.max_concurrency:
+                heapq.heappop(self.waiters)
+                self.requests.level -= 1
+                self.tokens.level -= tokens
+                self.in_flight += 1
+                self.admitted += 1
+                future.set_result(None)
+                continue
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait if wait > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        try:
+            now = time.monotonic()
+            if limit_requests:
+                self.requests.set_limit(float(limit_requests) / self.share)
+            if limit_tokens:
+                self.tokens.set_limit(float(limit_tokens) / self.share)
+            # the server view wins when it has less budget left than we think
+            if remaining_requests:
+                self.requests.refill(now)
+                self.requests.level = min(self.requests.level, float(remaining_requests) / self.share)
+            if remaining_tokens:
+                self.tokens.refill(now)
+                self.tokens.level = min(self.tokens.level, float(remaining_tokens) / self.share)
+        except ValueError as e:
+            logger.warning(f"Invalid rate limit headers: {e}")
+
+    def on_rate_limited(self, headers, attempt: int):
+        self.rate_limited += 1
+        self.update_from_headers(headers)
+        delay = None
+        if headers:
+            delay = parse_duration(headers.get("retry-after")) or max(
+                parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0) or None
+        if delay is None:
+            delay = backoff_delay(attempt)
+        else:
+            delay += random.uniform(0, delay * 0.1)
+        # stop admitting anything until the quota window resets
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self._schedule()
+        return delay
+
+    def stats(self):
+        return {"waiting": len(self.waiters),
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rate_limited": self.rate_limited,
+                "requests_available": round(self.requests.level, 1),
+                "tokens_available": round(self.tokens.level, 1)}
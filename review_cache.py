@@ -0,0 +1,124 @@
+import re
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import config
+
+logger = logging.getLogger(__name__)
+
+HUNK_HEADER_REGEX = re.compile(r'^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@.*$')
+
+
+def normalize_patch(patch: str):
+    # line numbers, index lines and trailing whitespace differ between cherry-picks,
+    # rebases and mirrors of the same change, they do not change what the model sees as code
+    lines = []
+    for line in patch.replace('\r\n', '\n').split('\n'):
+        if line.startswith('index ') or line.startswith('\\ No newline'):
+            continue
+        if HUNK_HEADER_REGEX.match(line):
+            line = '@@'
+        lines.append(line.rstrip())
+    return '\n'.join(lines).strip('\n')
+
+
+def make_cache_key(patch: str, model: str, prompt_version: str):
+    digest = hashlib.sha256()
+    digest.update(model.encode())
+    digest.update(b'\0')
+    digest.update(prompt_version.encode())
+    digest.update(b'\0')
+    digest.update(normalize_patch(patch).encode())
+    return digest.hexdigest()
+
+
+class ReviewCache(object):
+    def __init__(self, db=None, max_entries: int = 2048, ttl: float = 30 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.collection = None
+        if db is not None:
+            self.collection = db["review_cache"]
+            self.collection.create_index([("expire_at", 1)], expireAfterSeconds=0)
+
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+        self.saved_latency = 0.0
+        self.saved_tokens = 0
+
+    def _remember(self, key: str, entry: dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _record_hit(self, entry: dict):
+        self.saved_latency += entry.get("latency", 0)
+        self.saved_tokens += entry.get("tokens", 0)
+
+    async def get(self, key: str):
+        # the whole entry, the model that wrote the review comes with it
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            self._record_hit(entry)
+            return entry
+
+        if self.collection is not None:
+            try:
+                entry = await asyncio.to_thread(self.collection.find_one, {"_id": key})
+            except Exception as e:
+                logger.error(f"review cache lookup failed: {e}")
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+                self.mongo_hits += 1
+                self._record_hit(entry)
+                return entry
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, review: str, model: str, latency: float, tokens: int):
+        now = datetime.utcnow()
+        entry = {"_id": key,
+                 "review": review,
+                 "model": model,
+                 "latency": latency,
+                 "tokens": tokens,
+                 "created_at": now,
+                 "expire_at": now + timedelta(seconds=self.ttl)}
+        self._remember(key, entry)
+
+        if self.collection is not None:
+            try:
+                await asyncio.to_thread(self.collection.replace_one, {"_id": key}, entry, upsert=True)
+            except Exception as e:
+                logger.error(f"review cache store failed: {e}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.mongo_hits + self.misses
+        return {"memory_hits": self.memory_hits,
+                "mongo_hits": self.mongo_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.mongo_hits) / lookups if lookups else 0.0,
+                "saved_latency_seconds": round(self.saved_latency, 3),
+                "saved_tokens": self.saved_tokens,
+                "entries": len(self.entries)}
+
+
+def create_review_cache():
+    db = None
+    if config.REVIEW_CACHE_MONGO:
+        from cr_db import cr_db
+        db = cr_db.db
+    return ReviewCache(db, max_entries=config.REVIEW_CACHE_SIZE, ttl=config.REVIEW_CACHE_TTL)
+
+
+review_cache = create_review_cache()
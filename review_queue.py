@@ -0,0 +1,385 @@
+import time
+import asyncio
+import threading
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import config
+import metrics
+from tracing import trace_id, new_trace_id
+
+logger = logging.getLogger(__name__)
+
+JOB_COMMIT = "commit"
+JOB_FILE = "file"
+JOB_BATCH = "batch"
+JOB_PUBLISH = "publish"
+JOB_PUSH = "push"
+JOB_WEBHOOK = "webhook"
+
+STATUS_READY = "ready"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_DEAD = "dead"
+
+# finished jobs keep their dedup key this long, like the done_at index of the mongo store
+FINISHED_TTL = 24 * 3600
+# a job deferred by a full queue comes back after this many seconds, the attempt is not counted
+DEFER_DELAY = 30
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def new_job(kind: str, payload: dict, dedup_key: str = None, priority: int = 0, delay: float = 0):
+    now = datetime.utcnow()
+    return {
+        "_id": uuid.uuid4().hex,
+        "kind": kind,
+        "payload": payload,
+        "dedup_key": dedup_key or uuid.uuid4().hex,
+        "priority": priority,
+        "status": STATUS_READY,
+        "attempts": 0,
+        "lease_id": None,
+        "visible_at": now + timedelta(seconds=delay),
+        "created_at": now,
+        "update_at": now,
+    }
+
+
+class MongoJobStore(object):
+    def __init__(self, db):
+        self.jobs = db["review_jobs"]
+        self.jobs.create_index([("dedup_key", 1)], unique=True)
+        self.jobs.create_index([("status", 1), ("visible_at", 1), ("priority", -1)])
+        # finished jobs are kept for a day so that redelivered webhooks do not enqueue them again
+        self.jobs.create_index([("done_at", 1)], expireAfterSeconds=24 * 3600)
+
+    def put(self, job: dict):
+        try:
+            self.jobs.insert_one(job)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def lease(self, visibility_timeout: float):
+        now = datetime.utcnow()
+        lease_id = uuid.uuid4().hex
+        return self.jobs.find_one_and_update(
+            {"status": {"$in": [STATUS_READY, STATUS_LEASED]}, "visible_at": {"$lte": now}},
+            {"$set": {"status": STATUS_LEASED,
+                      "lease_id": lease_id,
+                      "visible_at": now + timedelta(seconds=visibility_timeout),
+                      "update_at": now},
+             "$inc": {"attempts": 1}},
+            sort=[("priority", -1), ("visible_at", 1)],
+            return_document=ReturnDocument.AFTER)
+
+    def touch(self, job: dict, visibility_timeout: float):
+        now = datetime.utcnow()
+        result = self.jobs.update_one(
+            {"_id": job["_id"], "lease_id": job["lease_id"]},
+            {"$set": {"visible_at": now + timedelta(seconds=visibility_timeout), "update_at": now}})
+        return result.modified_count == 1
+
+    def ack(self, job: dict):
+        now = datetime.utcnow()
+        self.jobs.update_one(
+            {"_id": job["_id"], "lease_id": job["lease_id"]},
+            {"$set": {"status": STATUS_DONE, "done_at": now, "update_at": now}})
+
+    def nack(self, job: dict, delay: float, dead: bool = False):
+        now = datetime.utcnow()
+        update = {"status": STATUS_DEAD if dead else STATUS_READY,
+                  "visible_at": now + timedelta(seconds=delay),
+                  "update_at": now}
+        if dead:
+            # dead jobs expire through the done_at index like finished ones
+            update["done_at"] = now
+        self.jobs.update_one({"_id": job["_id"], "lease_id": job["lease_id"]}, {"$set": update})
+
+    def release(self, job: dict, delay: float = 0):
+        # hand an unfinished job back without counting the attempt
+        now = datetime.utcnow()
+        self.jobs.update_one({"_id": job["_id"], "lease_id": job["lease_id"]},
+                             {"$set": {"status": STATUS_READY, "visible_at": now + timedelta(seconds=delay),
+                                       "update_at": now},
+                              "$inc": {"attempts": -1}})
+
+    def pending_count(self):
+        return self.jobs.count_documents({"status": {"$in": [STATUS_READY, STATUS_LEASED]}})
+
+
+class MemoryJobStore(object):
+    # local stand-in with the same semantics as MongoJobStore, state is lost on restart
+    def __init__(self):
+        self.jobs = {}
+        # dedup keys of the stored jobs, and of the finished ones with the time they finished, oldest first
+        self.dedup_keys = set()
+        self.finished = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _prune_finished(self):
+        expired = time.monotonic() - FINISHED_TTL
+        while self.finished and next(iter(self.finished.values())) < expired:
+            self.finished.popitem(last=False)
+
+    def _finish(self, job_id: str):
+        job = self.jobs.pop(job_id)
+        self.dedup_keys.discard(job["dedup_key"])
+        self.finished[job["dedup_key"]] = time.monotonic()
+
+    def put(self, job: dict):
+        with self.lock:
+            self._prune_finished()
+            if job["dedup_key"] in self.dedup_keys or job["dedup_key"] in self.finished:
+                return False
+            self.dedup_keys.add(job["dedup_key"])
+            self.jobs[job["_id"]] = dict(job)
+            return True
+
+    def lease(self, visibility_timeout: float):
+        now = datetime.utcnow()
+        with self.lock:
+            ready = [job for job in self.jobs.values()
+                     if job["status"] in (STATUS_READY, STATUS_LEASED) and job["visible_at"] <= now]
+            if not ready:
+                return None
+            job = min(ready, key=lambda j: (-j["priority"], j["visible_at"]))
+            job["status"] = STATUS_LEASED
+            job["lease_id"] = uuid.uuid4().hex
+            job["visible_at"] = now + timedelta(seconds=visibility_timeout)
+            job["attempts"] += 1
+            return dict(job)
+
+    def _owned(self, job: dict):
+        stored = self.jobs.get(job["_id"])
+        if stored and stored["lease_id"] == job["lease_id"]:
+            return stored
+        return None
+
+    def touch(self, job: dict, visibility_timeout: float):
+        with self.lock:
+            stored = self._owned(job)
+            if stored:
+                stored["visible_at"] = datetime.utcnow() + timedelta(seconds=visibility_timeout)
+            return stored is not None
+
+    def ack(self, job: dict):
+        with self.lock:
+            if self._owned(job):
+                self._finish(job["_id"])
+
+    def nack(self, job: dict, delay: float, dead: bool = False):
+        with self.lock:
+            stored = self._owned(job)
+            if not stored:
+                return
+            if dead:
+                self._finish(job["_id"])
+                return
+            stored["status"] = STATUS_READY
+            stored["visible_at"] = datetime.utcnow() + timedelta(seconds=delay)
+
+    def release(self, job: dict, delay: float = 0):
+        with self.lock:
+            stored = self._owned(job)
+            if stored:
+                stored["status"] = STATUS_READY
+                stored["visible_at"] = datetime.utcnow() + timedelta(seconds=delay)
+                stored["attempts"] -= 1
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.jobs)
+
+
+class ReviewQueue(object):
+    def __init__(self, store, max_pending: int, visibility_timeout: float, max_attempts: int):
+        self.store = store
+        self.max_pending = max_pending
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.pending_cache = (0, 0.0)
+
+    def enqueue(self, kind: str, payload: dict, dedup_key: str = None, priority: int = 0, force: bool = False,
+                delay: float = 0):
+        # back-pressure: refuse new work instead of letting the backlog grow without bound,
+        # fan-out from already accepted work passes force=True
+        if not force and self.max_pending and self.cached_pending_count() >= self.max_pending:
+            raise QueueFullError(f"review queue is full ({self.max_pending} pending jobs)")
+        # work queued outside of a request (polling, fan-out from a job without an id) gets its own trace id
+        if not payload.get("trace_id"):
+            payload = dict(payload, trace_id=trace_id.get() or new_trace_id())
+        added = self.store.put(new_job(kind, payload, dedup_key, priority, delay))
+        if not added:
+            logger.info(f"Skipping duplicate job: {dedup_key}")
+        return added
+
+    def lease(self):
+        return self.store.lease(self.visibility_timeout)
+
+    def touch(self, job: dict):
+        return self.store.touch(job, self.visibility_timeout)
+
+    def ack(self, job: dict):
+        self.store.ack(job)
+
+    def retry(self, job: dict):
+        if job["attempts"] >= self.max_attempts:
+            logger.error(f"Job {job['_id']} ({job['dedup_key']}) failed {job['attempts']} times, giving up")
+            self.store.nack(job, 0, dead=True)
+            return
+        delay = min(2 ** job["attempts"], 300)
+        self.store.nack(job, delay)
+
+    def release(self, job: dict):
+        self.store.release(job)
+
+    def defer(self, job: dict, delay: float = DEFER_DELAY):
+        # back later without using up an attempt, the job did not fail
+        self.store.release(job, delay)
+
+    def pending_count(self):
+        return self.store.pending_count()
+
+    def cached_pending_count(self, max_age: float = 1.0):
+        # counting the collection on every webhook would dominate the handler latency
+        count, counted_at = self.pending_cache
+        now = time.monotonic()
+        if now - counted_at > max_age:
+            count = self.store.pending_count()
+            self.pending_cache = (count, now)
+        return count
+
+
+class ReviewWorkerPool(object):
+    def __init__(self, queue: ReviewQueue, handlers: dict, concurrency: int, poll_interval: float = 1.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.tasks = []
+        self.stopping = False
+        self.stop_event = None
+        self.running = 0
+
+    async def start(self):
+        self.stopping = False
+        self.stop_event = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        logger.info(f"review worker pool started with {self.concurrency} workers")
+
+    async def stop(self, drain_timeout: float = 0):
+        # stop leasing, let the running jobs finish for up to drain_timeout seconds,
+        # whatever is still running then is cancelled and handed back to the queue for another process
+        self.stopping = True
+        if self.stop_event:
+            self.stop_event.set()
+        if drain_timeout and self.tasks:
+            if self.running:
+                logger.info(f"draining {self.running} running jobs, waiting up to {drain_timeout:.0f}s")
+            await asyncio.wait(self.tasks, timeout=drain_timeout)
+            if self.running:
+                logger.warning(f"{self.running} jobs still running after {drain_timeout:.0f}s, releasing them")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _heartbeat(self, job: dict):
+        interval = max(self.queue.visibility_timeout / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.queue.touch, job)
+            except Exception as e:
+                logger.error(f"failed to extend the lease of job {job['dedup_key']}: {e}")
+
+    async def _settle(self, index: int, action, job: dict):
+        # a store error must not end the worker, the lease runs out and the job is leased again
+        try:
+            await asyncio.to_thread(action, job)
+        except Exception as e:
+            logger.error(f"worker {index} failed to {action.__name__} job {job['dedup_key']}: {e}")
+
+    async def _worker(self, index: int):
+        while not self.stopping:
+            try:
+                job = await asyncio.to_thread(self.queue.lease)
+            except Exception as e:
+                logger.error(f"worker {index} failed to lease job: {e}")
+                job = None
+
+            if job and self.stopping:
+                await self._settle(index, self.queue.release, job)
+                break
+
+            if not job:
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_job(index, job)
+
+    async def _run_job(self, index: int, job: dict):
+        handler = self.handlers.get(job["kind"])
+        if not handler:
+            logger.error(f"No handler for job kind {job['kind']}")
+            await self._settle(index, self.queue.retry, job)
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        # jobs queued before trace ids were stamped on the payload have none
+        token = trace_id.set(job["payload"].get("trace_id") or new_trace_id())
+        metrics.JOBS_IN_FLIGHT.inc(kind=job["kind"])
+        self.running += 1
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            await handler(job["payload"])
+        except QueueFullError as e:
+            status = "deferred"
+            logger.warning(f"worker {index} deferring job {job['dedup_key']}: {e}")
+            await self._settle(index, self.queue.defer, job)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            await self._settle(index, self.queue.release, job)
+            raise
+        except Exception as e:
+            status = "error"
+            logger.exception(f"worker {index} job {job['dedup_key']} failed: {e}")
+            await self._settle(index, self.queue.retry, job)
+        else:
+            await self._settle(index, self.queue.ack, job)
+        finally:
+            heartbeat.cancel()
+            self.running -= 1
+            metrics.JOBS_IN_FLIGHT.dec(kind=job["kind"])
+            metrics.JOB_SECONDS.observe(time.perf_counter() - start, kind=job["kind"], status=status)
+            trace_id.reset(token)
+
+
+def create_review_queue():
+    if config.REVIEW_QUEUE_BACKEND == "memory":
+        store = MemoryJobStore()
+    else:
+        from cr_db import cr_db
+        store = MongoJobStore(cr_db.db)
+
+    return ReviewQueue(store,
+                       max_pending=config.REVIEW_QUEUE_MAX_PENDING,
+                       visibility_timeout=config.REVIEW_QUEUE_VISIBILITY_TIMEOUT,
+                       max_attempts=config.REVIEW_QUEUE_MAX_ATTEMPTS)
+
+
+review_queue = create_review_queue()
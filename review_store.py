@@ -0,0 +1,192 @@
+import re
+import uuid
+import asyncio
+import hashlib
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from pymongo import DESCENDING
+
+import config
+from review_cache import normalize_patch
+
+logger = logging.getLogger(__name__)
+
+CODE_SCORE_REGEX = re.compile(r'Code Score[^0-9\n]{0,20}(\d+(?:\.\d+)?)', re.IGNORECASE)
+MAX_PAGE_SIZE = 500
+
+# the commit a worker is reviewing right now, set around every review job
+review_target = contextvars.ContextVar("review_target", default=None)
+
+
+def parse_code_score(review: str):
+    # split patches have one score per part, keep the mean
+    scores = [float(score) for score in CODE_SCORE_REGEX.findall(review or "")]
+    scores = [score for score in scores if 0 <= score <= 10]
+    if not scores:
+        return None
+    return round(sum(scores) / len(scores), 2)
+
+
+def patch_hash(patch: str):
+    return hashlib.sha256(normalize_patch(patch).encode()).hexdigest()
+
+
+@contextmanager
+def reviewing(payload: dict):
+    target = {"source": payload.get("source", "github"),
+              "repo": str(payload.get("repo") or payload.get("project_id")),
+              "sha": payload.get("sha"),
+              "author": payload.get("author"),
+              "branch_key": payload.get("branch_key")}
+    token = review_target.set(target)
+    try:
+        yield target
+    finally:
+        review_target.reset(token)
+
+
+def as_utc(value: datetime):
+    # stored times are naive utc
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def build_query(repo: str = None, author: str = None, source: str = None, sha: str = None,
+                since: datetime = None, until: datetime = None, min_score: float = None, max_score: float = None):
+    query = {}
+    for field, value in (("repo", repo), ("author", author), ("source", source), ("sha", sha)):
+        if value is not None:
+            query[field] = value
+    since, until = as_utc(since), as_utc(until)
+    if since or until:
+        query["created_at"] = {}
+        if since:
+            query["created_at"]["$gte"] = since
+        if until:
+            query["created_at"]["$lt"] = until
+    if min_score is not None or max_score is not None:
+        query["code_score"] = {}
+        if min_score is not None:
+            query["code_score"]["$gte"] = min_score
+        if max_score is not None:
+            query["code_score"]["$lte"] = max_score
+    return query
+
+
+def encode_cursor(doc: dict):
+    return f"{doc['created_at'].isoformat()}|{doc['_id']}"
+
+
+def decode_cursor(cursor: str):
+    created_at, _id = cursor.split("|", 1)
+    return as_utc(datetime.fromisoformat(created_at)), _id
+
+
+class MongoReviewStore(object):
+    def __init__(self, db):
+        self.reviews = db["reviews"]
+        # newest first within a repo, an author or everything, _id breaks ties for the page cursor
+        self.reviews.create_index([("repo", 1), ("created_at", DESCENDING), ("_id", DESCENDING)])
+        self.reviews.create_index([("author", 1), ("created_at", DESCENDING), ("_id", DESCENDING)])
+        self.reviews.create_index([("repo", 1), ("author", 1), ("created_at", DESCENDING), ("_id", DESCENDING)])
+        self.reviews.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+        self.reviews.create_index([("repo", 1), ("sha", 1)])
+        self.reviews.create_index([("patch_hash", 1)])
+
+    def insert(self, doc: dict):
+        self.reviews.insert_one(doc)
+
+    def find(self, query: dict, cursor: str, limit: int):
+        if cursor:
+            created_at, _id = decode_cursor(cursor)
+            query = {"$and": [query, {"$or": [{"created_at": {"$lt": created_at}},
+                                              {"created_at": created_at, "_id": {"$lt": _id}}]}]}
+        return list(self.reviews.find(query)
+                    .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+                    .limit(limit))
+
+
+class MemoryReviewStore(object):
+    def __init__(self):
+        self.reviews = []
+        self.lock = threading.Lock()
+
+    def insert(self, doc: dict):
+        with self.lock:
+            self.reviews.append(doc)
+
+    def matches(self, doc: dict, query: dict):
+        for field, condition in query.items():
+            value = doc.get(field)
+            if isinstance(condition, dict):
+                if value is None:
+                    return False
+                if "$gte" in condition and value < condition["$gte"]:
+                    return False
+                if "$lt" in condition and value >= condition["$lt"]:
+                    return False
+                if "$lte" in condition and value > condition["$lte"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def find(self, query: dict, cursor: str, limit: int):
+        with self.lock:
+            docs = [doc for doc in self.reviews if self.matches(doc, query)]
+        docs.sort(key=lambda doc: (doc["created_at"], doc["_id"]), reverse=True)
+        if cursor:
+            after = decode_cursor(cursor)
+            docs = [doc for doc in docs if (doc["created_at"], doc["_id"]) < after]
+        return docs[:limit]
+
+
+class ReviewStore(object):
+    # one document per reviewed file, written when the review comes back from the model
+    def __init__(self, store):
+        self.store = store
+
+    async def record(self, filename: str, patch: str, review: str, model: str, tokens: int, latency: float,
+                     cached: bool = False):
+        target = review_target.get()
+        if target is None or not review:
+            return
+
+        now = datetime.utcnow()
+        doc = dict(target,
+                   _id=uuid.uuid4().hex,
+                   filename=filename,
+                   review=review,
+                   code_score=parse_code_score(review),
+                   model=model,
+                   tokens=tokens,
+                   latency=round(latency, 3),
+                   cached=cached,
+                   patch_hash=patch_hash(patch),
+                   created_at=now)
+        try:
+            await asyncio.to_thread(self.store.insert, doc)
+        except Exception as e:
+            # losing a history row must not fail the review itself
+            logger.error(f"storing review of {filename} failed: {e}")
+
+    async def query(self, cursor: str = None, limit: int = 50, **filters):
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        docs = await asyncio.to_thread(self.store.find, build_query(**filters), cursor, limit)
+        next_cursor = encode_cursor(docs[-1]) if len(docs) == limit else None
+        return docs, next_cursor
+
+
+def create_review_store():
+    if config.REVIEW_QUEUE_BACKEND == "memory":
+        return ReviewStore(MemoryReviewStore())
+    from cr_db import cr_db
+    return ReviewStore(MongoReviewStore(cr_db.db))
+
+
+review_store = create_review_store()
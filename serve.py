@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+
+import config
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [serve] - %(message)s")
+logger = logging.getLogger(__name__)
+
+ENV_FILE = "./env/.env.cr.local"
+# a child that ran this long before exiting starts the restart backoff over
+STABLE_SECONDS = 60
+
+
+def uvicorn_command(port: int, workers: int = 1):
+    command = [sys.executable, "-m", "uvicorn", "main:app",
+               "--host", config.APP_HOST, "--port", str(port),
+               "--env-file", ENV_FILE, "--log-config", "log.ini"]
+    if workers > 1:
+        command += ["--workers", str(workers)]
+    return command
+
+
+def plan_processes():
+    # (name, command, role)
+    multi_process = config.API_PROCESSES > 1 or config.WORKER_PROCESSES > 0
+    if multi_process and config.REVIEW_QUEUE_BACKEND == "memory":
+        logger.warning("the memory queue can not be shared between processes, running a single process")
+        multi_process = False
+
+    if not multi_process:
+        return [("app", uvicorn_command(config.APP_PORT), "all")]
+
+    # without worker processes the api processes review too, someone has to consume the queue
+    api_role = "api" if config.WORKER_PROCESSES > 0 else "all"
+    processes = [("api", uvicorn_command(config.APP_PORT, config.API_PROCESSES), api_role)]
+    for i in range(config.WORKER_PROCESSES):
+        processes.append((f"worker-{i}", uvicorn_command(config.WORKER_BASE_PORT + i), "worker"))
+    return processes
+
+
+class Supervisor(object):
+    # keeps the api and worker processes running, a SIGTERM or SIGINT drains them and exits
+    def __init__(self, processes: list):
+        self.processes = processes
+        self.children = {}
+        self.started = {}
+        self.restarts = {}
+        # name -> monotonic time of the pending restart
+        self.restart_at = {}
+        self.stopping = False
+
+    def spawn(self, name: str, command: list, role: str):
+        env = dict(os.environ, APP_ROLE=role)
+        self.children[name] = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.started[name] = time.monotonic()
+        logger.info(f"started {name} (pid {self.children[name].pid})")
+
+    def restart_delay(self, name: str):
+        # back off when a child keeps dying, one that ran stably crashed for a new reason
+        if time.monotonic() - self.started.get(name, 0) >= STABLE_SECONDS:
+            self.restarts[name] = 0
+        restarts = self.restarts.get(name, 0)
+        self.restarts[name] = restarts + 1
+        return min(2 ** restarts, 30)
+
+    def on_signal(self, signum, frame):
+        if not self.stopping:
+            logger.info(f"received signal {signum}, draining")
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_signal)
+        signal.signal(signal.SIGINT, self.on_signal)
+        for name, command, role in self.processes:
+            self.spawn(name, command, role)
+
+        specs = {name: (command, role) for name, command, role in self.processes}
+        while not self.stopping:
+            time.sleep(1)
+            for name, child in list(self.children.items()):
+                if child.poll() is None or name in self.restart_at:
+                    continue
+                # a crashed child is restarted, the others are still watched while it waits
+                delay = self.restart_delay(name)
+                logger.error(f"{name} exited with {child.returncode}, restart {self.restarts[name]} in {delay}s")
+                self.restart_at[name] = time.monotonic() + delay
+            for name, at in list(self.restart_at.items()):
+                if at <= time.monotonic() and not self.stopping:
+                    del self.restart_at[name]
+                    self.spawn(name, *specs[name])
+
+        self.stop()
+
+    def stop(self):
+        # uvicorn finishes open requests, then the shutdown hook drains the review workers
+        for child in self.children.values():
+            if child.poll() is None:
+                child.send_signal(signal.SIGTERM)
+
+        deadline = time.monotonic() + config.REVIEW_DRAIN_TIMEOUT + 30
+        for name, child in self.children.items():
+            try:
+                child.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.error(f"{name} did not exit in time, killing it")
+                child.kill()
+                child.wait()
+        logger.info("all processes stopped")
+
+
+if __name__ == "__main__":
+    Supervisor(plan_processes()).run()
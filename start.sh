@@ -1,3 +1,3 @@
 # bash -i
 conda activate py3.11
-uvicorn main:app --port 8010 --host 127.0.0.1 --env-file ./env/.env.cr.local --log-config log.ini > /dev/null 2>&1 &
\ No newline at end of file
+python serve.py > /dev/null 2>&1 &
\ No newline at end of file
@@ -0,0 +1,103 @@
+import diff_parser
+from diff_planner import estimate_tokens
+from symbol_index import SymbolIndex, TERMINAL_KINDS
+
+
+def get_line_changes(patch: str):
+    # 1-based new file line numbers of the added lines, and the removed lines keyed by the new line they preceded
+    added = set()
+    removed = {}
+    for hunk in diff_parser.iter_hunks(patch):
+        next_new_line = hunk.new_start
+        for kind, _, new_line, _, text in hunk.lines():
+            if kind == diff_parser.ADDED:
+                added.add(new_line)
+            elif kind == diff_parser.REMOVED:
+                # a hunk removing lines only has new start N - 1 in front of them, they sit before line N
+                removed.setdefault(next_new_line if hunk.new_count else hunk.new_start + 1, []).append(text)
+            if new_line is not None:
+                next_new_line = new_line + 1
+    return added, removed
+
+
+def to_lsp_range(line_range):
+    # parse_diff gives [start, start + count] with 1-based lines, symbols use 0-based inclusive lines
+    start, end = line_range
+    return [start - 1, max(start - 1, end - 2)]
+
+
+def symbol_name(symbol_path: list):
+    return ".".join(symbol["name"] for symbol in symbol_path)
+
+
+def collect_regions(symbols: list, line_ranges: list, padding: int, max_lines: int):
+    # [start, end, names] with 0-based inclusive lines, one per enclosing symbol of a hunk
+    regions = []
+    index = SymbolIndex(symbols)
+    ranges = [to_lsp_range(line_range) for line_range in line_ranges]
+    for (start, end), paths in zip(ranges, index.query_all(ranges)):
+        for path in paths:
+            symbol_path = index.path_symbols(path)
+            symbol_range = symbol_path[-1]["range"]
+            symbol_start, symbol_end = symbol_range["start"]["line"], symbol_range["end"]["line"]
+            if symbol_path[-1]["kind"] in TERMINAL_KINDS and symbol_end - symbol_start < max_lines:
+                regions.append([symbol_start, symbol_end, [symbol_name(symbol_path)]])
+            else:
+                # containers without a changed member, and functions too long to send whole, keep the hunk
+                regions.append([max(symbol_start, start - padding), min(symbol_end, end + padding),
+                                [symbol_name(symbol_path)]])
+    return regions
+
+
+def merge_regions(regions: list):
+    merged = []
+    for start, end, names in sorted(regions, key=lambda region: region[:2]):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2].extend(name for name in names if name not in merged[-1][2])
+        else:
+            merged.append([start, end, list(names)])
+    return merged
+
+
+def render_context(lines: list, regions: list, added: set, removed: dict):
+    parts = []
+    for start, end, names in regions:
+        body = []
+        end = min(end, len(lines) - 1)
+        for index in range(start, end + 1):
+            line_no = index + 1
+            body.extend(f"-{line}" for line in removed.get(line_no, []))
+            body.append(f"{'+' if line_no in added else ' '}{lines[index]}")
+        if end == len(lines) - 1:
+            body.extend(f"-{line}" for line in removed.get(len(lines) + 1, []))
+        title = ", ".join(name for name in names if name) or "module level"
+        parts.append(f"@@ lines {start + 1}-{end + 1} @@ {title}\n" + "\n".join(body))
+    return "\n".join(parts) + "\n"
+
+
+def build_symbol_context(file_content: str, patch: str, symbols: list, line_ranges: list,
+                         padding: int = 3, max_lines: int = 200):
+    # the enclosing functions of the changed lines, with the changes marked like a diff
+    lines = file_content.splitlines()
+    added, removed = get_line_changes(patch)
+    regions = collect_regions(symbols, line_ranges, padding, max_lines)
+
+    # changed lines outside of any symbol keep a few lines around them
+    covered = set()
+    for start, end, _ in regions:
+        covered.update(range(start + 1, end + 2))
+    for line_no in sorted(added | set(removed)):
+        if line_no not in covered:
+            index = min(line_no, len(lines)) - 1
+            regions.append([max(0, index - padding), index + padding, [""]])
+            covered.update(range(index - padding + 1, index + padding + 2))
+
+    if not regions:
+        return None, None
+
+    context = render_context(lines, merge_regions(regions), added, removed)
+    stats = {"context": estimate_tokens(context),
+             "file": estimate_tokens(file_content),
+             "patch": estimate_tokens(patch)}
+    return context, stats
@@ -0,0 +1,254 @@
+import ast
+import logging
+
+import config
+import lsp_utils.lsp as lsp
+
+logger = logging.getLogger(__name__)
+
+try:
+    from tree_sitter_languages import get_parser
+except ImportError:
+    get_parser = None
+
+# DocumentSymbol dicts shaped like the textDocument/documentSymbol answer of a language server, lines are 0-based
+
+
+def make_range(start_line: int, start_character: int, end_line: int, end_character: int):
+    return {"start": {"line": start_line, "character": start_character},
+            "end": {"line": end_line, "character": end_character}}
+
+
+def make_symbol(name: str, kind: int, symbol_range: dict, selection_range: dict = None, children: list = None):
+    return {"name": name,
+            "kind": kind,
+            "range": symbol_range,
+            "selectionRange": selection_range or symbol_range,
+            "children": children if children is not None else []}
+
+
+class PythonAstExtractor(object):
+    name = "ast"
+
+    def node_kind(self, node, in_class: bool):
+        if isinstance(node, ast.ClassDef):
+            return lsp.SymbolKind.Class
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if not in_class:
+                return lsp.SymbolKind.Function
+            return lsp.SymbolKind.Constructor if node.name == "__init__" else lsp.SymbolKind.Method
+        return None
+
+    def assigned_names(self, node):
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.AnnAssign):
+            targets = [node.target]
+        else:
+            return []
+        return [target.id for target in targets if isinstance(target, ast.Name)]
+
+    def extract(self, content: str, filename: str = ""):
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError) as e:
+            logger.info(f"Can not parse {filename}: {e}")
+            return None
+
+        symbols = []
+        # (statements, children list to fill, inside a class body, inside a function body)
+        stack = [(tree.body, symbols, False, False)]
+        while stack:
+            body, children, in_class, in_function = stack.pop()
+            for node in body:
+                kind = self.node_kind(node, in_class)
+                if kind is not None:
+                    # decorators belong to the definition
+                    start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+                    symbol = make_symbol(node.name, kind,
+                                         make_range(start - 1, 0, node.end_lineno - 1, node.end_col_offset),
+                                         make_range(node.lineno - 1, node.col_offset, node.lineno - 1, node.col_offset))
+                    children.append(symbol)
+                    stack.append((node.body, symbol["children"], kind == lsp.SymbolKind.Class,
+                                  kind != lsp.SymbolKind.Class))
+                    continue
+
+                if in_function:
+                    continue
+                for name in self.assigned_names(node):
+                    if in_class:
+                        kind = lsp.SymbolKind.Field
+                    else:
+                        kind = lsp.SymbolKind.Constant if name.isupper() else lsp.SymbolKind.Variable
+                    children.append(make_symbol(name, kind, make_range(node.lineno - 1, node.col_offset,
+                                                                       node.end_lineno - 1, node.end_col_offset)))
+
+                # definitions under if / try / with blocks at module or class level
+                for field in ("body", "orelse", "finalbody", "handlers"):
+                    nested = getattr(node, field, None)
+                    if isinstance(nested, list) and nested and isinstance(nested[0], (ast.stmt, ast.excepthandler)):
+                        stack.append((nested, children, in_class, in_function))
+
+        sort_symbols(symbols)
+        return symbols
+
+
+# tree-sitter node types reported as symbols, per grammar
+TREE_SITTER_KINDS = {
+    "javascript": {
+        "class_declaration": lsp.SymbolKind.Class,
+        "function_declaration": lsp.SymbolKind.Function,
+        "generator_function_declaration": lsp.SymbolKind.Function,
+        "method_definition": lsp.SymbolKind.Method,
+        "variable_declarator": lsp.SymbolKind.Variable,
+    },
+    "typescript": {
+        "class_declaration": lsp.SymbolKind.Class,
+        "abstract_class_declaration": lsp.SymbolKind.Class,
+        "interface_declaration": lsp.SymbolKind.Interface,
+        "enum_declaration": lsp.SymbolKind.Enum,
+        "function_declaration": lsp.SymbolKind.Function,
+        "generator_function_declaration": lsp.SymbolKind.Function,
+        "method_definition": lsp.SymbolKind.Method,
+        "variable_declarator": lsp.SymbolKind.Variable,
+    },
+    "java": {
+        "class_declaration": lsp.SymbolKind.Class,
+        "interface_declaration": lsp.SymbolKind.Interface,
+        "enum_declaration": lsp.SymbolKind.Enum,
+        "method_declaration": lsp.SymbolKind.Method,
+        "constructor_declaration": lsp.SymbolKind.Constructor,
+        "field_declaration": lsp.SymbolKind.Field,
+    },
+    "cpp": {
+        "namespace_definition": lsp.SymbolKind.Namespace,
+        "class_specifier": lsp.SymbolKind.Class,
+        "struct_specifier": lsp.SymbolKind.Struct,
+        "enum_specifier": lsp.SymbolKind.Enum,
+        "function_definition": lsp.SymbolKind.Function,
+    },
+    "php": {
+        "class_declaration": lsp.SymbolKind.Class,
+        "interface_declaration": lsp.SymbolKind.Interface,
+        "trait_declaration": lsp.SymbolKind.Class,
+        "function_definition": lsp.SymbolKind.Function,
+        "method_declaration": lsp.SymbolKind.Method,
+    },
+}
+TREE_SITTER_KINDS["tsx"] = TREE_SITTER_KINDS["typescript"]
+
+FUNCTION_VALUE_TYPES = ("arrow_function", "function", "function_expression", "generator_function")
+NAME_TYPES = ("identifier", "field_identifier", "property_identifier", "type_identifier", "name",
+              "qualified_identifier", "destructor_name", "operator_name", "namespace_identifier")
+
+
+class TreeSitterExtractor(object):
+    name = "tree-sitter"
+
+    def __init__(self, grammar: str):
+        self.grammar = grammar
+        self.kinds = TREE_SITTER_KINDS[grammar]
+        self.parser = get_parser(grammar)
+
+    def node_name(self, node):
+        # the name field, or the identifier at the end of a declarator chain (c++ functions, java fields)
+        current = node
+        for _ in range(8):
+            name = current.child_by_field_name("name")
+            if name is not None and name.type in NAME_TYPES:
+                return name.text.decode(errors="replace")
+            declarator = current.child_by_field_name("declarator")
+            if declarator is None:
+                break
+            if declarator.type in NAME_TYPES:
+                return declarator.text.decode(errors="replace")
+            current = declarator
+        return None
+
+    def node_kind(self, node):
+        kind = self.kinds.get(node.type)
+        if kind == lsp.SymbolKind.Variable:
+            value = node.child_by_field_name("value")
+            if value is not None and value.type in FUNCTION_VALUE_TYPES:
+                return lsp.SymbolKind.Function
+            # only named top level or class level values, not every local
+            if node.parent is None or node.parent.parent is None or node.parent.parent.type not in ("program", "export_statement"):
+                return None
+        return kind
+
+    def extract(self, content: str, filename: str = ""):
+        tree = self.parser.parse(content.encode())
+        symbols = []
+        stack = [(tree.root_node, symbols)]
+        while stack:
+            node, children = stack.pop()
+            for child in node.children:
+                kind = self.node_kind(child)
+                name = self.node_name(child) if kind is not None else None
+                if not name:
+                    stack.append((child, children))
+                    continue
+                symbol = make_symbol(name, kind,
+                                     make_range(child.start_point[0], child.start_point[1],
+                                                child.end_point[0], child.end_point[1]))
+                children.append(symbol)
+                stack.append((child, symbol["children"]))
+
+        sort_symbols(symbols)
+        return symbols
+
+
+def sort_symbols(symbols: list):
+    # the walks above are depth first with a stack, put every level back in source order
+    stack = [symbols]
+    while stack:
+        level = stack.pop()
+        level.sort(key=lambda symbol: (symbol["range"]["start"]["line"], symbol["range"]["start"]["character"]))
+        stack.extend(symbol["children"] for symbol in level if symbol["children"])
+
+
+def parse_backends(value: str):
+    # "python:ast,javascript:tree-sitter" -> {"python": "ast", "javascript": "tree-sitter"}
+    backends = {}
+    for item in value.split(","):
+        language, _, backend = item.strip().partition(":")
+        if language and backend:
+            backends[language.strip()] = backend.strip()
+    return backends
+
+
+class SymbolExtractors(object):
+    # in-process extractors by language, languages without one use the language server of config.lang_server
+    def __init__(self, backends: dict):
+        self.backends = backends
+        self.extractors = {}
+
+    def get(self, language: str, filename: str = ""):
+        backend = self.backends.get(language, "lsp")
+        grammar = "tsx" if language == "typescript" and filename.endswith(".tsx") else language
+        key = (backend, grammar)
+        if key not in self.extractors:
+            self.extractors[key] = self.create(backend, grammar)
+        return self.extractors[key]
+
+    def create(self, backend: str, grammar: str):
+        if backend == "ast" and grammar == "python":
+            return PythonAstExtractor()
+        if backend == "tree-sitter":
+            if get_parser is None:
+                logger.warning(f"tree-sitter backend set for {grammar} but tree_sitter_languages is not installed")
+                return None
+            if grammar not in TREE_SITTER_KINDS:
+                logger.warning(f"no tree-sitter symbol mapping for {grammar}")
+                return None
+            try:
+                return TreeSitterExtractor(grammar)
+            except Exception as e:
+                logger.warning(f"loading the tree-sitter grammar of {grammar} failed: {e}")
+                return None
+        if backend != "lsp":
+            logger.warning(f"unknown symbol backend {backend} for {grammar}")
+        return None
+
+
+symbol_extractors = SymbolExtractors(parse_backends(config.SYMBOL_BACKENDS))
@@ -0,0 +1,91 @@
+import heapq
+
+import lsp_utils.lsp as lsp
+
+# same kinds utils.get_symbols_intersecting_with_range stops at
+TERMINAL_KINDS = frozenset([lsp.SymbolKind.Function, lsp.SymbolKind.Method, lsp.SymbolKind.Constructor,
+                            lsp.SymbolKind.Constant, lsp.SymbolKind.Variable, lsp.SymbolKind.Enum, lsp.SymbolKind.Struct])
+
+
+class SymbolIndex(object):
+    """Flattened symbol tree answering which symbol paths intersect line ranges.
+
+    Gives the same paths as utils.get_symbols_intersecting_with_range, but the tree is walked once and all the
+    ranges of a diff are answered in one sweep. A path is a tuple of symbol ids in pre-order, path_symbols turns
+    it back into the symbol dicts.
+    """
+
+    def __init__(self, symbols: list):
+        # per id, in pre-order of the tree
+        self.symbols = []
+        self.starts = []
+        self.ends = []
+        self.parents = []
+        self.paths = []
+        self.terminal = []
+        # whether the range lies inside the ranges of all the ancestors, so that overlapping it implies they overlap
+        self.contained = []
+
+        stack = [(symbol, -1) for symbol in reversed(symbols)]
+        while stack:
+            symbol, parent = stack.pop()
+            if 'range' not in symbol:
+                continue
+            symbol_id = len(self.symbols)
+            start, end = symbol["range"]["start"]["line"], symbol["range"]["end"]["line"]
+            terminal = symbol['kind'] in TERMINAL_KINDS
+            self.symbols.append(symbol)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.parents.append(parent)
+            self.paths.append((self.paths[parent] if parent >= 0 else ()) + (symbol_id,))
+            self.terminal.append(terminal)
+            self.contained.append(parent < 0 or (self.contained[parent]
+                                                 and self.starts[parent] <= start and end <= self.ends[parent]))
+            if not terminal:
+                stack.extend((child, symbol_id) for child in reversed(symbol.get("children") or []))
+
+        self.by_start = sorted(range(len(self.symbols)), key=lambda symbol_id: self.starts[symbol_id])
+
+    def reachable(self, symbol_id: int, start: int, end: int):
+        # the recursive walk only reaches a symbol when every ancestor overlaps the range too
+        if self.contained[symbol_id]:
+            return True
+        parent = self.parents[symbol_id]
+        while parent >= 0:
+            if self.starts[parent] > end or self.ends[parent] < start:
+                return False
+            parent = self.parents[parent]
+        return True
+
+    def paths_for(self, hits: list, start: int, end: int):
+        hits = [symbol_id for symbol_id in hits if self.reachable(symbol_id, start, end)]
+        # a container is only reported when none of its children intersects the range
+        has_child = set(self.parents[symbol_id] for symbol_id in hits)
+        return [self.paths[symbol_id] for symbol_id in sorted(hits)
+                if self.terminal[symbol_id] or symbol_id not in has_child]
+
+    def query_all(self, line_ranges: list):
+        # [start, end] ranges with inclusive ends, returns the list of paths for every range in the given order
+        results = [None] * len(line_ranges)
+        order = sorted(range(len(line_ranges)), key=lambda i: line_ranges[i][0])
+        active = []
+        position = 0
+        for i in order:
+            start, end = line_ranges[i]
+            while position < len(self.by_start) and self.starts[self.by_start[position]] <= end:
+                symbol_id = self.by_start[position]
+                heapq.heappush(active, (self.ends[symbol_id], symbol_id))
+                position += 1
+            # ranges come by start, a symbol ending before this one can not overlap any later range
+            while active and active[0][0] < start:
+                heapq.heappop(active)
+            hits = [symbol_id for _, symbol_id in active if self.starts[symbol_id] <= end]
+            results[i] = self.paths_for(hits, start, end)
+        return results
+
+    def query(self, line_range):
+        return self.query_all([line_range])[0]
+
+    def path_symbols(self, path: tuple):
+        return [self.symbols[symbol_id] for symbol_id in path]
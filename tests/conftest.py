@@ -0,0 +1,21 @@
+import os
+import sys
+import tempfile
+
+import mongomock
+import pymongo
+
+# the modules read the settings and connect to mongo at import time: tests use the memory queue and mongomock
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("API_KEY", "test")
+os.environ.setdefault("REVIEW_QUEUE_BACKEND", "memory")
+os.environ.setdefault("REVIEW_CACHE_MONGO", "false")
+os.environ.setdefault("GIT_MIRROR_ENABLED", "false")
+pymongo.MongoClient = mongomock.MongoClient
+
+# main logs to log/logfile.log under the working directory, like bench/offline.py the tests run in a scratch one
+workdir = tempfile.mkdtemp(prefix="reviewbot-tests-")
+os.makedirs(os.path.join(workdir, "log"))
+os.chdir(workdir)
@@ -0,0 +1,159 @@
+import asyncio
+
+import openai
+import pytest
+from openai.openai_response import OpenAIResponse
+
+import chat
+import http_client
+from model_router import ModelRouter, ModelTier
+
+
+def make_router(*names):
+    return ModelRouter([ModelTier(name, 0.001, 0.002, 0) for name in names], small_tokens=100, large_tokens=1000,
+                       sensitive_paths=["auth"], deep_languages=set(), burst_pending=0, burst_waiting=0,
+                       failure_threshold=3, cooldown=60, slow_seconds=0)
+
+
+class FakeRequestor(object):
+    # answers like openai.api_requestor.APIRequestor.arequest, plain requests fail for the models in fail,
+    # streams give the deltas and then fail when stream_failure is set
+    calls = []
+    fail = set()
+    deltas = ["**Code Score**: 7\n", "**Quality**: no issue\n", "**Logic**: "]
+    stream_failure = None
+
+    async def arequest(self, method, url, params=None, stream=False, request_timeout=None):
+        FakeRequestor.calls.append(params["model"])
+        if stream:
+            return self.stream(), True, "key"
+        if params["model"] in FakeRequestor.fail:
+            raise openai.error.ServiceUnavailableError("overloaded")
+        data = {"choices": [{"message": {"content": f"review by {params['model']}"}}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}}
+        headers = {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "10"}
+        return OpenAIResponse(data, headers), False, "key"
+
+    async def stream(self):
+        for delta in FakeRequestor.deltas:
+            yield OpenAIResponse({"choices": [{"delta": {"content": delta}}]}, {"x-ratelimit-limit-requests": "60"})
+        if FakeRequestor.stream_failure:
+            raise FakeRequestor.stream_failure
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    FakeRequestor.calls, FakeRequestor.fail, FakeRequestor.stream_failure = [], set(), None
+    monkeypatch.setattr(chat, "APIRequestor", FakeRequestor)
+    monkeypatch.setattr(chat, "backoff_delay", lambda attempt: 0)
+    return FakeRequestor
+
+
+def complete(prompt, filenames=()):
+    async def run():
+        try:
+            return await chat.get_chat_completion(prompt, filenames)
+        finally:
+            await http_client.close_session()
+    return asyncio.run(run())
+
+
+def test_completion_reads_the_rate_limit_headers(fake_openai, monkeypatch):
+    router = make_router("model-a")
+    monkeypatch.setattr(chat, "model_router", router)
+    response, model = complete("commmit patch is:\n+x = 1\n")
+
+    assert model == "model-a"
+    assert response["choices"][0]["message"]["content"] == "review by model-a"
+    limiter = router.tiers[0].limiter
+    assert limiter.requests.capacity == 60
+    assert limiter.requests.level <= 10
+    assert router.tiers[0].requests == 1 and router.tiers[0].cost > 0
+
+
+def test_completion_falls_back_to_the_next_model(fake_openai, monkeypatch):
+    router = make_router("deep", "fast")
+    monkeypatch.setattr(chat, "model_router", router)
+    fake_openai.fail = {"deep"}
+    response, model = complete("x" * 8000)
+
+    assert model == "fast"
+    assert fake_openai.calls[0] == "deep" and fake_openai.calls[-1] == "fast"
+    assert router.tiers[0].errors >= 1
+
+
+def stream_review(patch, filename="src/app.py"):
+    published = []
+
+    async def publish(review, final):
+        published.append((review, final))
+
+    async def run():
+        try:
+            return await chat.stream_review_for_patch(patch, filename, publish)
+        finally:
+            await http_client.close_session()
+    return asyncio.run(run()), published
+
+
+def test_stream_review_reads_the_rate_limit_headers(fake_openai, monkeypatch):
+    router = make_router("model-a")
+    monkeypatch.setattr(chat, "model_router", router)
+    review, published = stream_review("@@ -1 +1 @@\n-a = 1\n+a = 2\n")
+
+    assert review == "".join(FakeRequestor.deltas)
+    assert published[-1] == (review, True)
+    assert router.tiers[0].limiter.requests.capacity == 60
+
+
+def test_failed_stream_is_not_cached_and_falls_back(fake_openai, monkeypatch):
+    router = make_router("model-a")
+    monkeypatch.setattr(chat, "model_router", router)
+    fake_openai.stream_failure = openai.error.APIConnectionError("connection reset")
+    patch = "@@ -1 +1 @@\n-b = 1\n+b = 2\n"
+    review, published = stream_review(patch)
+
+    # the partial sections went out as they came, the final review is the one of the fallback request
+    assert review == "review by model-a"
+    assert published[0] == ("**Code Score**: 7", False)
+    assert published[-1] == ("review by model-a", True)
+    cached = asyncio.run(chat.review_cache.get(chat.make_cache_key(patch, "model-a", chat.PROMPT_VERSION)))
+    assert cached["review"] == "review by model-a"
+
+
+def test_failed_stream_without_fallback_is_marked_incomplete(fake_openai, monkeypatch):
+    router = make_router("model-a")
+    monkeypatch.setattr(chat, "model_router", router)
+    fake_openai.stream_failure = openai.error.APIConnectionError("connection reset")
+    fake_openai.fail = {"model-a"}
+    patch = "@@ -1 +1 @@\n-c = 1\n+c = 2\n"
+    review, published = stream_review(patch)
+
+    assert review is None
+    assert published[-1] == ("**Code Score**: 7\n**Quality**: no issue" + chat.INCOMPLETE_REVIEW_NOTE, True)
+    assert asyncio.run(chat.review_cache.get(chat.make_cache_key(patch, "model-a", chat.PROMPT_VERSION))) is None
+
+
+def review_chunk(patch, filename="src/app.py"):
+    async def run():
+        try:
+            return await chat.get_review_for_chunk(patch, filename)
+        finally:
+            await http_client.close_session()
+    return asyncio.run(run())
+
+
+def test_cached_reviews_belong_to_the_routed_model(fake_openai, monkeypatch):
+    patch = "@@ -1 +1 @@\n-d = 1\n+d = 2\n"
+    monkeypatch.setattr(chat, "model_router", make_router("model-a"))
+    assert review_chunk(patch)[3:] == (False, "model-a")
+
+    # another model is routed, the review of model-a is not its answer
+    monkeypatch.setattr(chat, "model_router", make_router("model-b"))
+    review, _, _, cached, model = review_chunk(patch)
+    assert (review, cached, model) == ("review by model-b", False, "model-b")
+
+    monkeypatch.setattr(chat, "model_router", make_router("model-a"))
+    review, tokens, _, cached, model = review_chunk(patch)
+    assert (review, tokens, cached, model) == ("review by model-a", 0, True, "model-a")
+    assert fake_openai.calls == ["model-a", "model-b"]
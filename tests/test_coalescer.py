@@ -0,0 +1,81 @@
+import asyncio
+
+import mongomock
+import pytest
+
+import coalescer
+
+A = {"sha": "a", "author": "x"}
+B = {"sha": "b", "author": "y"}
+
+
+@pytest.fixture(params=["memory", "mongo"])
+def store(request):
+    if request.param == "memory":
+        return coalescer.MemoryBranchStore()
+    return coalescer.MongoBranchStore(mongomock.MongoClient()["test"])
+
+
+def test_the_pending_range_keeps_the_commits_and_the_split(store):
+    store.on_push("k", "0a", "1a", False, [A], True)
+    doc = store.on_push("k", "1a", "2b", False, [B], False)
+    assert (doc["base"], doc["head"]) == ("0a", "2b")
+    assert doc["commits"] == [A, B] and doc["split"]
+
+    store.claim("k", doc["generation"])
+    doc = store.on_push("k", "2b", "3c", False, [B], False)
+    # a new range starts over
+    assert doc["base"] == "2b" and doc["commits"] == [B] and not doc["split"]
+
+
+def test_a_superseded_review_returns_none():
+    push = coalescer.PushCoalescer(coalescer.MemoryBranchStore())
+
+    async def review():
+        await asyncio.sleep(10)
+
+    async def run():
+        doc = await push.on_push("k", "0a", "1a", False, [A], False)
+        task = asyncio.create_task(push.run({"branch_key": "k", "epoch": doc["epoch"]}, review()))
+        await asyncio.sleep(0.05)
+        await push.on_push("k", "1a", "2b", True, [B], False)
+        return await task
+
+    assert asyncio.run(run()) is None
+    assert not push.superseded
+
+
+def test_a_shutdown_cancellation_is_raised():
+    push = coalescer.PushCoalescer(coalescer.MemoryBranchStore())
+
+    async def review():
+        await asyncio.sleep(10)
+
+    async def run():
+        doc = await push.on_push("k", "0a", "1a", False, [A], False)
+        task = asyncio.create_task(push.run({"branch_key": "k", "epoch": doc["epoch"]}, review()))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run())
+
+
+def test_a_force_push_in_another_process_cancels_the_review():
+    store = coalescer.MemoryBranchStore()
+    worker = coalescer.PushCoalescer(store, poll_interval=0.01)
+    other = coalescer.PushCoalescer(store, poll_interval=0.01)
+
+    async def review():
+        await asyncio.sleep(10)
+
+    async def run():
+        doc = await other.on_push("k", "0a", "1a", False, [A], False)
+        task = asyncio.create_task(worker.run({"branch_key": "k", "epoch": doc["epoch"]}, review()))
+        await asyncio.sleep(0.05)
+        await other.on_push("k", "1a", "2b", True, [B], False)
+        return await asyncio.wait_for(task, 1)
+
+    assert asyncio.run(run()) is None
+    assert not worker.watchers and not worker.tasks
@@ -0,0 +1,39 @@
+import asyncio
+
+import mongomock
+import pytest
+
+import cr_db
+
+
+@pytest.fixture(params=["memory", "mongo"])
+def store(request):
+    if request.param == "memory":
+        return cr_db.MemoryReviewedCommitStore()
+    collection = mongomock.MongoClient()["test"]["reviewed_commits"]
+    collection.create_index([("commit_id", 1), ("source", 1), ("repo", 1)], unique=True)
+    return cr_db.MongoReviewedCommitStore(collection)
+
+
+def claim(commits, commit_ids, repo):
+    return asyncio.run(commits.claim(commit_ids, repo, "github"))
+
+
+def test_a_commit_is_claimed_once_per_repo(store):
+    commits = cr_db.ReviewedCommits(store, 10, 100, lease=60)
+    assert claim(commits, ["a", "b"], "o/one") == ["a", "b"]
+    assert claim(commits, ["a", "b", "c"], "o/one") == ["c"]
+    # a fork pushes the same commits
+    assert claim(commits, ["a"], "o/two") == ["a"]
+    # a new process only has the store
+    assert claim(cr_db.ReviewedCommits(store, 10, 100, lease=60), ["b"], "o/one") == []
+    assert store.find(["a", "b"], "o/two", "github", 60) == {"a"}
+
+
+def test_an_unconfirmed_claim_runs_out(store):
+    claim(cr_db.ReviewedCommits(store, 10, 100, lease=60), ["a", "b"], "o/r")
+    asyncio.run(cr_db.ReviewedCommits(store, 10, 100, lease=60).confirm(["a"], "o/r", "github"))
+
+    # the worker that claimed b crashed before enqueueing its job
+    commits = cr_db.ReviewedCommits(store, 10, 100, lease=0)
+    assert claim(commits, ["a", "b"], "o/r") == ["b"]
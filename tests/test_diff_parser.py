@@ -0,0 +1,82 @@
+import re
+
+import utils
+import diff_parser
+from diff_parser import ADDED, REMOVED, CONTEXT, NO_NEWLINE
+
+PATCH = ("@@ -1,3 +1,4 @@ def f():\n"
+         " a = 1\n"
+         "-b = 2\n"
+         "+b = 3\n"
+         "+c = 4\n"
+         " d = 5\n"
+         "@@ -10,2 +11,2 @@ class K:\n"
+         " x = 1\n"
+         "-y = 2\n"
+         "+y = 3\n")
+
+
+def old_parse_diff(patch):
+    # utils.parse_diff before diff_parser, it only knew headers with both counts
+    return [[int(match.group(1)), int(match.group(1)) + int(match.group(2))]
+            for match in re.finditer(r'@@ -\d+,\d+ \+(\d+),(\d+) @@', patch)]
+
+
+def test_hunk_headers_and_ranges():
+    hunks = diff_parser.parse_hunks(PATCH)
+    assert [(hunk.old_start, hunk.old_count, hunk.new_start, hunk.new_count) for hunk in hunks] == \
+        [(1, 3, 1, 4), (10, 2, 11, 2)]
+    assert [hunk.section for hunk in hunks] == ["def f():", "class K:"]
+    assert [hunk.new_range for hunk in hunks] == old_parse_diff(PATCH) == utils.parse_diff(PATCH)
+    assert hunks[1].old_range == [10, 12]
+
+
+def test_lines_carry_numbers_and_github_positions():
+    first, second = diff_parser.parse_hunks(PATCH)
+    assert list(first.lines()) == [(CONTEXT, 1, 1, 1, "a = 1"),
+                                   (REMOVED, 2, None, 2, "b = 2"),
+                                   (ADDED, None, 2, 3, "b = 3"),
+                                   (ADDED, None, 3, 4, "c = 4"),
+                                   (CONTEXT, 3, 4, 5, "d = 5")]
+    # the second header is position 6, its lines continue from there
+    assert second.position == 6
+    assert list(second.lines()) == [(CONTEXT, 10, 11, 7, "x = 1"),
+                                    (REMOVED, 11, None, 8, "y = 2"),
+                                    (ADDED, None, 12, 9, "y = 3")]
+    assert first.added_lines() == [2, 3] and second.added_lines() == [12]
+
+
+def test_single_line_headers_count_one_line():
+    patch = "@@ -1 +1 @@\n-a\n+b\n"
+    hunk, = diff_parser.parse_hunks(patch)
+    assert (hunk.old_start, hunk.old_count, hunk.new_start, hunk.new_count) == (1, 1, 1, 1)
+    assert [kind for kind, *_ in hunk.lines()] == [REMOVED, ADDED]
+    # the old parser did not see this hunk at all
+    assert old_parse_diff(patch) == [] and utils.parse_diff(patch) == [[1, 2]]
+
+
+def test_no_newline_marker_and_empty_context_lines():
+    patch = "@@ -1,3 +1,3 @@\n a\n\n-b\n\\ No newline at end of file\n+c\n\\ No newline at end of file\n"
+    hunk, = diff_parser.parse_hunks(patch)
+    # github drops the space of an empty context line
+    assert list(hunk.kinds) == [CONTEXT, CONTEXT, REMOVED, NO_NEWLINE, ADDED, NO_NEWLINE]
+    assert [line[1:3] for line in hunk.lines()] == [(1, 1), (2, 2), (3, None), (None, None), (None, 3), (None, None)]
+
+
+def test_text_after_the_counted_lines_is_not_part_of_the_hunk():
+    patch = ("@@ -1 +1 @@\n-a\n+b\n"
+             "diff --git a/other.py b/other.py\n--- a/other.py\n+++ b/other.py\n"
+             "@@ -5,0 +6 @@\n+new\n")
+    first, second = diff_parser.parse_hunks(patch)
+    assert [line[4] for line in first.lines()] == ["a", "b"]
+    assert (second.new_start, second.new_count, second.old_count) == (6, 1, 0)
+    assert list(second.lines()) == [(ADDED, None, 6, second.position + 1, "new")]
+
+
+def test_split_patch_hunks_puts_the_patch_back_together():
+    patch = "diff --git a/f.py b/f.py\n--- a/f.py\n+++ b/f.py\n" + PATCH
+    preamble, hunks = utils.split_patch_hunks(patch)
+    assert preamble.startswith("diff --git") and len(hunks) == 2
+    assert hunks[1].startswith("@@ -10,2 +11,2 @@")
+    assert preamble + "".join(hunks) == patch
+    assert utils.split_patch_hunks("Binary files differ") == ("Binary files differ", [])
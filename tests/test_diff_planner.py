@@ -0,0 +1,64 @@
+from diff_planner import (build_batch_prompt, estimate_tokens, is_packable, pack_files, split_batch_answer,
+                          split_patch)
+
+
+def make_hunk(start: int, count: int):
+    lines = "".join(f"+    value_{start + i} = compute({i})\n" for i in range(count))
+    return f"@@ -{start},0 +{start},{count} @@\n" + lines
+
+
+def test_small_patch_is_one_chunk():
+    patch = make_hunk(1, 3)
+    assert split_patch(patch, estimate_tokens(patch)) == [patch]
+
+
+def test_split_at_hunk_boundaries():
+    preamble = "diff --git a/app.py b/app.py\n"
+    hunks = [make_hunk(start, 10) for start in (1, 100, 200, 300)]
+    patch = preamble + "".join(hunks)
+    # every piece is estimated on its own
+    max_tokens = sum(estimate_tokens(piece) for piece in (preamble, hunks[0], hunks[1]))
+
+    chunks = split_patch(patch, max_tokens)
+    assert chunks == [preamble + hunks[0] + hunks[1], hunks[2] + hunks[3]]
+    assert all(estimate_tokens(chunk) <= max_tokens for chunk in chunks)
+
+
+def test_oversized_hunk_is_cut_on_lines():
+    hunk = make_hunk(1, 40)
+    max_tokens = estimate_tokens(hunk) // 3
+
+    chunks = split_patch(hunk, max_tokens)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= max_tokens for chunk in chunks)
+    assert chunks[0].startswith("@@ -1,0 +1,40 @@\n")
+    assert all(chunk.startswith("@@ -1,0 +1,40 @@ (continued)\n") for chunk in chunks[1:])
+    # no line is lost or repeated
+    body = [line for chunk in chunks for line in chunk.splitlines()[1:]]
+    assert body == hunk.splitlines()[1:]
+
+
+def test_pack_files_within_budget_and_file_limit():
+    patches = {"a.py": "x" * 400, "b.py": "x" * 400, "c.py": "x" * 40, "d.py": "x" * 40, "e.py": "x" * 40}
+    batches = pack_files(list(patches), patches.get, max_tokens=estimate_tokens("x" * 400) * 2, max_files=3)
+    assert batches == [["a.py", "b.py"], ["c.py", "d.py", "e.py"]]
+
+    batches = pack_files(list(patches), patches.get, max_tokens=10_000, max_files=2)
+    assert batches == [["a.py", "b.py"], ["c.py", "d.py"], ["e.py"]]
+
+
+def test_is_packable():
+    assert is_packable("+x\n", 10)
+    assert not is_packable("", 10)
+    assert not is_packable(None, 10)
+    assert not is_packable("x" * 100, 10)
+
+
+def test_batch_answer_roundtrip():
+    prompt = build_batch_prompt([("src/a.py", "+a\n"), ("src/b.py", "+b\n")])
+    assert prompt.startswith("### FILE: src/a.py\n+a\n")
+    assert "### FILE: src/b.py\n+b\n" in prompt
+
+    answer = "Intro\n### FILE: src/a.py\nLooks fine.\n\n## FILE: `src/b.py`\nRename b.\n# FILE: other.py\nIgnored\n"
+    assert split_batch_answer(answer, ["src/a.py", "src/b.py"]) == {"src/a.py": "Looks fine.",
+                                                                    "src/b.py": "Rename b."}
@@ -0,0 +1,91 @@
+import base64
+import asyncio
+import subprocess
+
+import config
+import git_mirror
+
+
+GIT = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+
+
+def git_output(work, *args):
+    return subprocess.run(GIT + ["-C", str(work), *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+def make_origin(tmp_path):
+    # o/r.git under a local origin, with a directory next to a file
+    work = tmp_path / "work"
+    (work / "sub").mkdir(parents=True)
+    (work / "a.txt").write_text("first\n")
+    (work / "sub" / "b.txt").write_text("second\n")
+    git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+    subprocess.run(git + ["init", "-q", str(work)], check=True)
+    subprocess.run(git + ["-C", str(work), "add", "."], check=True)
+    subprocess.run(git + ["-C", str(work), "commit", "-q", "-m", "init"], check=True)
+    sha = subprocess.run(["git", "-C", str(work), "rev-parse", "HEAD"],
+                         check=True, capture_output=True, text=True).stdout.strip()
+    (tmp_path / "origin" / "o").mkdir(parents=True)
+    subprocess.run(["git", "clone", "-q", "--bare", str(work), str(tmp_path / "origin" / "o" / "r.git")], check=True)
+    return sha
+
+
+def test_read_files_skips_the_body_of_a_tree(tmp_path, monkeypatch):
+    sha = make_origin(tmp_path)
+    monkeypatch.setattr(config, "GITHUB_GIT_ORIGIN", str(tmp_path / "origin"))
+    cache = git_mirror.GitMirrorCache(str(tmp_path / "mirrors"), 1024 ** 3)
+
+    contents = asyncio.run(cache.read_files("o/r", sha, ["sub", "a.txt", "gone.txt", "sub/b.txt"]))
+    assert contents == {"a.txt": "first\n", "sub/b.txt": "second\n"}
+
+
+def test_the_mirror_in_use_is_not_evicted(tmp_path, monkeypatch):
+    sha = make_origin(tmp_path)
+    monkeypatch.setattr(config, "GITHUB_GIT_ORIGIN", str(tmp_path / "origin"))
+    # every mirror is over the budget
+    cache = git_mirror.GitMirrorCache(str(tmp_path / "mirrors"), 0)
+
+    assert asyncio.run(cache.read_file("o/r", sha, "a.txt")) == "first\n"
+    assert not cache.in_use
+
+
+def test_get_diff_starts_at_the_merge_base(tmp_path, monkeypatch):
+    sha = make_origin(tmp_path)
+    work = tmp_path / "work"
+    # the old head changed a.txt, the rebased head only changes sub/b.txt
+    git_output(work, "checkout", "-q", "-b", "old")
+    (work / "a.txt").write_text("changed\n")
+    git_output(work, "commit", "-q", "-am", "old")
+    old = git_output(work, "rev-parse", "HEAD")
+    git_output(work, "checkout", "-q", "-b", "new", sha)
+    (work / "sub" / "b.txt").write_text("rebased\n")
+    git_output(work, "commit", "-q", "-am", "new")
+    new = git_output(work, "rev-parse", "HEAD")
+    git_output(work, "push", "-q", str(tmp_path / "origin" / "o" / "r.git"), "old", "new")
+
+    monkeypatch.setattr(config, "GITHUB_GIT_ORIGIN", str(tmp_path / "origin"))
+    cache = git_mirror.GitMirrorCache(str(tmp_path / "mirrors"), 1024 ** 3)
+    file_changes = asyncio.run(cache.get_diff("o/r", old, new))
+    assert [file_change["filename"] for file_change in file_changes] == ["sub/b.txt"]
+
+
+def test_the_token_is_not_on_the_command_line(tmp_path, monkeypatch):
+    sha = make_origin(tmp_path)
+    monkeypatch.setattr(config, "GITHUB_GIT_ORIGIN", str(tmp_path / "origin"))
+    monkeypatch.setattr(config, "GITHUB_API_TOKEN", "secret-token")
+    calls = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def spy(*args, **kwargs):
+        calls.append((args, kwargs["env"]))
+        return await create_subprocess_exec(*args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spy)
+    cache = git_mirror.GitMirrorCache(str(tmp_path / "mirrors"), 1024 ** 3)
+    assert asyncio.run(cache.read_file("o/r", sha, "a.txt")) == "first\n"
+
+    token = base64.b64encode(b"x-access-token:secret-token").decode()
+    assert not any(token in " ".join(args) for args, _ in calls)
+    clone_env = next(env for args, env in calls if "clone" in args)
+    assert clone_env["GIT_CONFIG_KEY_0"] == "http.extraHeader"
+    assert clone_env["GIT_CONFIG_VALUE_0"] == f"Authorization: Basic {token}"
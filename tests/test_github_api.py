@@ -0,0 +1,54 @@
+import io
+import asyncio
+import tarfile
+import threading
+
+import github_api
+import http_client
+from github_api import ETagCache
+
+
+def test_etag_cache_is_bounded_by_size():
+    cache = ETagCache(max_entries=100, max_bytes=10)
+    cache.put("a", "1", b"12345", {})
+    cache.put("b", "2", b"12345", {})
+    cache.put("c", "3", b"123", {})
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.size == 8
+
+    # replacing an entry counts its new size only, a body over the budget is not kept
+    cache.put("c", "4", b"1", {})
+    cache.put("d", "5", b"12345678901", {})
+    assert cache.size == 6
+    assert cache.get("d") is None
+    assert cache.stats()["entries"] == 2
+
+
+def make_tarball(files: dict):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for path, text in files.items():
+            data = text.encode()
+            info = tarfile.TarInfo(f"o-r-sha/{path}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_the_tarball_is_read_off_the_event_loop(monkeypatch):
+    threads = []
+    read_tarball = github_api.read_tarball
+
+    def spy(content, filenames):
+        threads.append(threading.current_thread())
+        return read_tarball(content, filenames)
+
+    async def get(url, headers=None, params=None):
+        return http_client.HttpResponse(200, {}, make_tarball({"src/a.py": "a = 1\n", "src/b.py": "b = 2\n"}), url)
+
+    monkeypatch.setattr(http_client, "get", get)
+    monkeypatch.setattr(github_api, "read_tarball", spy)
+    contents = asyncio.run(github_api.get_tarball_files("o/r", "sha", ["src/a.py", "missing.py"]))
+
+    assert contents == {"src/a.py": "a = 1\n"}
+    assert threads and threads[0] is not threading.main_thread()
@@ -0,0 +1,17 @@
+import aiohttp
+import pytest
+
+from http_client import HttpResponse, HttpError
+
+
+def test_raise_for_status_error_formats():
+    response = HttpResponse(502, {}, b"bad gateway", "https://api.github.com/repos/a/b")
+    with pytest.raises(aiohttp.ClientError) as info:
+        response.raise_for_status()
+    assert isinstance(info.value, HttpError)
+    assert info.value.status_code == 502
+    assert str(info.value) == "502 for https://api.github.com/repos/a/b: bad gateway"
+
+
+def test_raise_for_status_ok():
+    HttpResponse(200, {}, b"{}").raise_for_status()
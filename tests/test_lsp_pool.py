@@ -0,0 +1,78 @@
+import asyncio
+
+import lsp_utils.lsp_pool as lsp_pool
+from lsp_utils.lsp_pool import LspServerPool
+
+
+class FakeLspProcess(object):
+    started = []
+    stopped = []
+
+    def __init__(self):
+        self.alive = False
+
+    async def start_server(self, server_path, args):
+        await asyncio.sleep(0.01)
+        self.alive = True
+        FakeLspProcess.started.append(self)
+        return True
+
+    async def initialize(self, workspace):
+        return True
+
+    def is_alive(self):
+        return self.alive
+
+    async def open_file(self, file_path, language, content):
+        await asyncio.sleep(0)
+
+    async def get_symbols(self, file_path):
+        return []
+
+    async def close_file(self, file_path):
+        pass
+
+    async def stop_server(self):
+        await asyncio.sleep(0.01)
+        self.alive = False
+        FakeLspProcess.stopped.append(self)
+
+
+def test_concurrent_callers_share_one_server(monkeypatch):
+    monkeypatch.setattr(lsp_pool, "LspProcess", FakeLspProcess)
+    FakeLspProcess.started, FakeLspProcess.stopped = [], []
+
+    async def run():
+        pool = LspServerPool(idle_timeout=600, max_servers=1)
+        # fill the pool so that the next key has to evict first
+        await pool.get_symbols("python", "/a", "pyls", [], "x.py", "")
+        results = await asyncio.gather(*[pool.get_symbols("python", "/b", "pyls", [], "x.py", "")
+                                         for _ in range(5)])
+        servers = dict(pool.servers)
+        await pool.shutdown()
+        return results, servers
+
+    results, servers = asyncio.run(run())
+    assert results == [[]] * 5
+    assert list(servers) == [("python", "/b")]
+    # one process for /a, one for /b, nothing left running
+    assert len(FakeLspProcess.started) == 2
+    assert all(not process.alive for process in FakeLspProcess.started)
+
+
+def test_idle_servers_stop_without_requests(monkeypatch):
+    monkeypatch.setattr(lsp_pool, "LspProcess", FakeLspProcess)
+    FakeLspProcess.started, FakeLspProcess.stopped = [], []
+
+    async def run():
+        pool = LspServerPool(idle_timeout=0.01, max_servers=4)
+        await pool.get_symbols("python", "/a", "pyls", [], "x.py", "")
+        pool.start()
+        # the timer runs every second at the least
+        await asyncio.sleep(1.2)
+        servers = dict(pool.servers)
+        await pool.shutdown()
+        return servers
+
+    assert asyncio.run(run()) == {}
+    assert len(FakeLspProcess.stopped) == 1
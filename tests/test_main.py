@@ -0,0 +1,154 @@
+import asyncio
+
+import main
+import utils
+import github_api
+
+PATCH = "@@ -1,2 +1,2 @@\n def f():\n-    return 1\n+    return 2\n"
+
+
+def test_symbol_context_uses_the_prefetched_contents(monkeypatch):
+    monkeypatch.setattr(main, "REVIEW_CONTEXT_MODE", "symbols")
+    requested = []
+
+    async def get_file_contents(repo_full_name, sha, filenames):
+        requested.append(list(filenames))
+        return {filename: "def f():\n    return 2\n" for filename in filenames}
+
+    async def download_file(repo_full_name, filename, commit_id):
+        raise AssertionError("the job downloaded a prefetched file")
+
+    monkeypatch.setattr(github_api, "get_file_contents", get_file_contents)
+    monkeypatch.setattr(utils, "download_file", download_file)
+    file_changes = [{"filename": "src/a.py", "patch": PATCH, "status": "modified"},
+                    {"filename": "docs/b.txt", "patch": PATCH, "status": "modified"}]
+
+    async def run():
+        prefetched = await main.prefetch_file_contents("o/r", "sha", file_changes)
+        return prefetched, await main.get_symbol_context("o/r", "sha", prefetched[0])
+
+    prefetched, context = asyncio.run(run())
+    assert requested == [["src/a.py"]]
+    assert "content" in prefetched[0] and "content" not in prefetched[1]
+    assert "+    return 2" in context
+
+
+def test_remove_temp_file_prunes_empty_directories(tmp_path):
+    root = tmp_path / "temp" / "o__r" / "sha"
+    (root / "src" / "pkg").mkdir(parents=True)
+    (root / "src" / "other.py").write_text("")
+    (root / "src" / "pkg" / "a.py").write_text("")
+    main.remove_temp_file(str(root / "src" / "pkg" / "a.py"), str(root))
+    # src still holds the other file
+    assert not (root / "src" / "pkg").exists() and (root / "src").exists()
+
+    main.remove_temp_file(str(root / "src" / "other.py"), str(root))
+    assert not root.exists() and (tmp_path / "temp" / "o__r").exists()
+
+
+def test_a_push_over_the_compare_limit_is_reviewed_per_commit(monkeypatch):
+    enqueued = []
+
+    async def compare(repo_full_name, base, head):
+        return [], [{"filename": f"f{i}.py"} for i in range(github_api.COMPARE_MAX_FILES)]
+
+    async def claim(key, generation):
+        return {"base": "0a", "head": "2b", "epoch": 0, "split": False,
+                "commits": [{"sha": "1a", "author": "x"}, {"sha": "2b", "author": "y"}]}
+
+    monkeypatch.setattr(main, "git_mirror", None)
+    monkeypatch.setattr(github_api, "compare", compare)
+    monkeypatch.setattr(main.coalescer, "claim", claim)
+    monkeypatch.setattr(main.review_queue, "enqueue",
+                        lambda job_type, payload, **kwargs: enqueued.append((job_type, payload)))
+
+    asyncio.run(main.process_push_job({"source": "github", "repo": "o/r", "branch_key": "k", "generation": 1}))
+    assert enqueued == [(main.JOB_COMMIT, {"source": "github", "repo": "o/r", "sha": "1a", "author": "x"}),
+                        (main.JOB_COMMIT, {"source": "github", "repo": "o/r", "sha": "2b", "author": "y"})]
+
+
+def test_a_push_with_a_no_cr_commit_is_not_reviewed_as_one_diff(monkeypatch):
+    pushes = []
+
+    async def enqueue_push(source, branch_key, target, data, commits, split):
+        pushes.append((commits, split))
+
+    async def claim(commit_ids, repo_full_name, source):
+        return commit_ids
+
+    monkeypatch.setattr(main, "enqueue_push", enqueue_push)
+    monkeypatch.setattr(main.reviewed_commits, "claim", claim)
+    data = {"repository": {"full_name": "o/r"}, "ref": "refs/heads/main", "before": "0a", "after": "2b",
+            "commits": [{"id": "1a", "message": "wip /no-cr", "author": {"username": "x"}},
+                        {"id": "2b", "message": "fix", "author": {"username": "y"}}]}
+
+    asyncio.run(main.process_github_webhook_job({"data": data}))
+    assert pushes == [([{"sha": "2b", "author": "y"}], True)]
+
+
+def test_a_file_the_repository_re_includes_is_reviewed(monkeypatch):
+    # planning applied the .reviewbot of the repository, "!docs/*.md" brought the file back
+    async def get_symbol_context(repo_full_name, sha, file_change):
+        return None
+
+    async def get_review_for_patch(patch, filename):
+        return f"review of {filename}"
+
+    monkeypatch.setattr(main, "get_symbol_context", get_symbol_context)
+    monkeypatch.setattr(main.chat, "get_review_for_patch", get_review_for_patch)
+    payload = {"source": "github", "repo": "o/r", "sha": "sha",
+               "file_change": {"filename": "docs/guide.md", "patch": PATCH}}
+
+    assert asyncio.run(main.collect_reviews(payload)) == [{"filename": "docs/guide.md",
+                                                          "review": "review of docs/guide.md"}]
+
+
+def plan(monkeypatch, file_changes):
+    planned = []
+
+    async def get_filter(repo_full_name, sha):
+        return main.default_filter
+
+    async def enqueue_review_jobs(commit_key, target, jobs):
+        planned.extend(jobs)
+
+    monkeypatch.setattr(main.repo_path_filters, "get", get_filter)
+    monkeypatch.setattr(main, "enqueue_review_jobs", enqueue_review_jobs)
+    asyncio.run(main.plan_github_jobs("o/r", "sha", file_changes))
+    return planned
+
+
+def test_a_rename_without_a_patch_gets_no_job(monkeypatch):
+    # without triage nothing else drops it, the job would fail on the missing patch
+    monkeypatch.setattr(main, "TRIAGE_ENABLED", False)
+    jobs = plan(monkeypatch, [{"filename": "src/new.py", "previous_filename": "src/old.py",
+                               "status": "renamed", "changes": 0},
+                              {"filename": "src/a.py", "patch": PATCH, "status": "modified"}])
+
+    files = [fc["filename"] for _, payload, _ in jobs for fc in payload.get("file_changes", [payload.get("file_change")])]
+    assert files == ["src/a.py"]
+
+
+def test_an_empty_gitlab_diff_gets_no_job(monkeypatch):
+    planned = []
+
+    async def enqueue_review_jobs(commit_key, target, jobs):
+        planned.extend(jobs)
+
+    monkeypatch.setattr(main, "TRIAGE_ENABLED", False)
+    monkeypatch.setattr(main, "enqueue_review_jobs", enqueue_review_jobs)
+    diffs = [{"old_path": "a.py", "new_path": "b.py", "renamed_file": True, "diff": ""},
+             {"old_path": "c.py", "new_path": "c.py", "diff": PATCH}]
+    asyncio.run(main.plan_gitlab_jobs(1, "sha", diffs))
+
+    assert [diff["new_path"] for _, payload, _ in planned for diff in payload["diffs"]] == ["c.py"]
+
+
+def test_review_cache_counters_are_exported(monkeypatch):
+    monkeypatch.setattr(main.review_cache, "memory_hits", 3)
+    monkeypatch.setattr(main.review_cache, "mongo_hits", 1)
+    monkeypatch.setattr(main.review_cache, "misses", 2)
+    body = asyncio.run(main.prometheus_metrics()).body.decode()
+    assert 'reviewbot_review_cache_hits{tier="memory"} 3' in body
+    assert 'reviewbot_review_cache_hits{tier="mongo"} 1' in body
+    assert "reviewbot_review_cache_misses 2" in body
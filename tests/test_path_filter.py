@@ -0,0 +1,89 @@
+import asyncio
+
+import utils
+import path_filter
+from github_api import GithubApiError
+from path_filter import PathFilter, RepoPathFilters, parse_rules
+
+
+def test_names_match_at_any_depth():
+    rules = PathFilter(["Makefile", "*.png", "node_modules/"])
+    assert rules.matches("Makefile")
+    assert rules.matches("tools/Makefile")
+    assert rules.matches("web/img/logo.png")
+    assert rules.matches("web/node_modules/left-pad/index.js")
+    assert not rules.matches("Makefile.py")
+    assert not rules.matches("logo.png.py")
+    # a directory rule does not match a file of that name
+    assert not rules.matches("src/node_modules")
+
+
+def test_slash_anchors_at_the_root():
+    rules = PathFilter(["/build", "docs/*.py", "gen/"])
+    assert rules.matches("build/main.py")
+    assert not rules.matches("src/build/main.py")
+    assert rules.matches("docs/conf.py")
+    assert not rules.matches("src/docs/conf.py")
+    # * stays within one directory
+    assert not rules.matches("docs/api/conf.py")
+    assert rules.matches("src/gen/parser.py")
+
+
+def test_double_star_and_wildcards():
+    rules = PathFilter(["**/migrations/*.py", "a/**/z.py", "test_?.py", "*.[ch]"])
+    assert rules.matches("migrations/0001.py")
+    assert rules.matches("app/users/migrations/0001.py")
+    assert rules.matches("a/z.py")
+    assert rules.matches("a/b/c/z.py")
+    assert rules.matches("test_1.py")
+    assert not rules.matches("test_10.py")
+    assert rules.matches("lib/x.c")
+    assert not rules.matches("lib/x.cpp")
+
+
+def test_negation_and_last_match_wins():
+    rules = PathFilter(["*.json", "!package.json", "config/package.json"])
+    assert rules.matches("data/items.json")
+    assert not rules.matches("package.json")
+    assert not rules.matches("web/package.json")
+    assert rules.matches("config/package.json")
+    assert PathFilter(["!*.py", "*"]).matches("main.py")
+
+
+def test_parse_rules_and_split():
+    rules = parse_rules("# generated code\n\n  gen/  \n*.pb.py\n!keep.pb.py\n")
+    assert rules == ["gen/", "*.pb.py", "!keep.pb.py"]
+    kept, skipped = PathFilter(rules).split(["gen/a.py", "api.pb.py", "keep.pb.py", "main.py"])
+    assert kept == ["keep.pb.py", "main.py"]
+    assert skipped == ["gen/a.py", "api.pb.py"]
+
+
+def test_default_rules():
+    assert path_filter.default_filter.matches("README.md")
+    assert path_filter.default_filter.matches("src/__pycache__/main.cpython-311.pyc")
+    assert not path_filter.default_filter.matches("src/main.py")
+
+
+def test_repo_rules_are_cached_and_downloaded_once(monkeypatch):
+    downloads = []
+
+    async def download_file(repo_full_name, filename, commit_id):
+        downloads.append(repo_full_name)
+        await asyncio.sleep(0)
+        if repo_full_name == "org/plain":
+            raise GithubApiError(404, "Not Found")
+        return "gen/\n"
+
+    monkeypatch.setattr(utils, "download_file", download_file)
+    filters = RepoPathFilters(ttl=60, max_entries=10, filename=".reviewignore")
+
+    async def run():
+        first, second = await asyncio.gather(filters.get("org/repo", "sha"), filters.get("org/repo", "sha"))
+        assert first is second
+        assert first.matches("gen/a.py")
+        assert await filters.get("org/repo", "sha") is first
+        # without a filter file the global rules apply
+        assert await filters.get("org/plain", "sha") is path_filter.default_filter
+
+    asyncio.run(run())
+    assert downloads == ["org/repo", "org/plain"]
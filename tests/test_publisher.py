@@ -0,0 +1,40 @@
+import json
+import asyncio
+
+import http_client
+import publisher
+from publisher import CommitPublisher, MemoryPublishStore
+
+
+def test_existing_bodies_follows_the_link_header(monkeypatch):
+    pages = {
+        "https://api/comments": ([{"body": "first"}], '<https://api/comments?page=2>; rel="next"'),
+        "https://api/comments?page=2": ([{"body": "second"}], '<https://api/comments?page=3>; rel="next", '
+                                                              '<https://api/comments?page=1>; rel="first"'),
+        "https://api/comments?page=3": ([{"body": None}], '<https://api/comments?page=1>; rel="first"'),
+    }
+    requested = []
+
+    async def get(url, headers=None, params=None):
+        requested.append(url)
+        body, link = pages[url]
+        return http_client.HttpResponse(200, {"Link": link}, json.dumps(body).encode(), url)
+
+    monkeypatch.setattr(http_client, "get", get)
+    bodies = asyncio.run(CommitPublisher(MemoryPublishStore()).existing_bodies("https://api/comments", {}, "body"))
+    assert bodies == ["first", "second", ""]
+    assert len(requested) == 3
+
+
+def test_memory_store_drops_published_commits(monkeypatch):
+    store = MemoryPublishStore()
+    store.start("a", {}, 1)
+    store.complete_part("a", 0, [])
+    assert store.claim("a", 60)
+    store.finish("a", True)
+    store.start("b", {}, 1)
+
+    monkeypatch.setattr(publisher, "PUBLISHED_TTL", -1)
+    store.pruned_at = 0
+    store.start("c", {}, 1)
+    assert sorted(store.commits) == ["b", "c"]
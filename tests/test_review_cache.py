@@ -0,0 +1,56 @@
+import asyncio
+
+import mongomock
+
+from review_cache import ReviewCache, make_cache_key, normalize_patch
+
+PATCH = "index 1a2b3c..4d5e6f 100644\n@@ -10,3 +10,4 @@ def main():\n     run()\n+    stop()\n     exit()\n"
+
+
+def test_normalize_ignores_positions_and_whitespace():
+    moved = "index 9f8e7d..6c5b4a 100644\r\n@@ -40,3 +42,4 @@ class App:\r\n     run()   \r\n+    stop()\r\n     exit()\r\n" \
+            "\\ No newline at end of file\r\n"
+    assert normalize_patch(PATCH) == "@@\n     run()\n+    stop()\n     exit()"
+    assert normalize_patch(moved) == normalize_patch(PATCH)
+    assert make_cache_key(moved, "model-a", "1") == make_cache_key(PATCH, "model-a", "1")
+
+
+def test_key_changes_with_code_model_and_prompt():
+    key = make_cache_key(PATCH, "model-a", "1")
+    # indentation is code
+    assert make_cache_key(PATCH.replace("+    stop()", "+stop()"), "model-a", "1") != key
+    assert make_cache_key(PATCH.replace("stop", "halt"), "model-a", "1") != key
+    assert make_cache_key(PATCH, "model-b", "1") != key
+    assert make_cache_key(PATCH, "model-a", "2") != key
+
+
+def test_memory_lru_and_stats():
+    cache = ReviewCache(max_entries=2)
+
+    async def run():
+        await cache.put("a", "review a", "model-a", latency=2.0, tokens=100)
+        await cache.put("b", "review b", "model-b", latency=1.0, tokens=50)
+        entry = await cache.get("a")
+        assert (entry["review"], entry["model"]) == ("review a", "model-a")
+        # b is the least recently used one now
+        await cache.put("c", "review c", "model-a", latency=1.0, tokens=10)
+        assert await cache.get("b") is None
+        assert (await cache.get("c"))["review"] == "review c"
+
+    asyncio.run(run())
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["mongo_hits"], stats["misses"]) == (2, 0, 1)
+    assert stats["saved_tokens"] == 110
+    assert stats["saved_latency_seconds"] == 3.0
+    assert stats["entries"] == 2
+
+
+def test_mongo_survives_the_memory_cache():
+    db = mongomock.MongoClient().db
+    asyncio.run(ReviewCache(db).put("k", "review", "model-a", latency=1.0, tokens=5))
+
+    # a fresh process starts with an empty memory cache
+    cache = ReviewCache(db)
+    assert asyncio.run(cache.get("k"))["review"] == "review"
+    assert asyncio.run(cache.get("k"))["model"] == "model-a"
+    assert (cache.mongo_hits, cache.memory_hits, cache.misses) == (1, 1, 0)
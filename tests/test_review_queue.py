@@ -0,0 +1,118 @@
+import asyncio
+
+import mongomock
+
+import tracing
+import review_queue
+from review_queue import MemoryJobStore, MongoJobStore, ReviewQueue, ReviewWorkerPool, QueueFullError, new_job
+
+
+def make_queue(store=None):
+    return ReviewQueue(store or MemoryJobStore(), max_pending=0, visibility_timeout=60, max_attempts=3)
+
+
+def run_pool(queue, handler, until, timeout=5):
+    async def run():
+        pool = ReviewWorkerPool(queue, {"test": handler}, concurrency=1, poll_interval=0.01)
+        await pool.start()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not until() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+        alive = all(not task.done() for task in pool.tasks)
+        await pool.stop()
+        return alive
+    return asyncio.run(run())
+
+
+class FlakyAckStore(MemoryJobStore):
+    def __init__(self):
+        super().__init__()
+        self.ack_failures = 1
+
+    def ack(self, job):
+        if self.ack_failures:
+            self.ack_failures -= 1
+            raise ConnectionError("mongo went away")
+        super().ack(job)
+
+
+def test_worker_survives_store_errors():
+    store = FlakyAckStore()
+    queue = make_queue(store)
+    handled = []
+
+    async def handler(payload):
+        handled.append(payload["n"])
+
+    queue.enqueue("test", {"n": 1}, dedup_key="one")
+    queue.enqueue("test", {"n": 2}, dedup_key="two")
+    alive = run_pool(queue, handler, lambda: len(handled) >= 2)
+    assert alive
+    assert sorted(handled) == [1, 2]
+
+
+def test_deferred_job_keeps_its_attempts():
+    store = MemoryJobStore()
+    queue = make_queue(store)
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        raise QueueFullError("full")
+
+    queue.enqueue("test", {}, dedup_key="deferred")
+    run_pool(queue, handler, lambda: calls and all(job["status"] == review_queue.STATUS_READY
+                                                   for job in store.jobs.values()))
+    job, = store.jobs.values()
+    assert job["attempts"] == 0
+    assert job["status"] == review_queue.STATUS_READY
+
+
+def test_memory_store_prunes_finished_dedup_keys(monkeypatch):
+    store = MemoryJobStore()
+    assert store.put(new_job("test", {}, dedup_key="a"))
+    job = store.lease(60)
+    store.ack(job)
+    assert not store.jobs and not store.dedup_keys
+    # redelivered within the ttl it is still a duplicate
+    assert not store.put(new_job("test", {}, dedup_key="a"))
+
+    monkeypatch.setattr(review_queue, "FINISHED_TTL", -1)
+    assert store.put(new_job("test", {}, dedup_key="b"))
+    assert "a" not in store.finished
+
+
+def test_dead_jobs_expire_in_mongo():
+    store = MongoJobStore(mongomock.MongoClient()["test"])
+    store.put(new_job("test", {}, "dead"))
+    store.put(new_job("test", {}, "retried"))
+    for _ in range(2):
+        job = store.lease(60)
+        store.nack(job, 0, dead=job["dedup_key"] == "dead")
+
+    assert store.jobs.find_one({"dedup_key": "dead"})["done_at"] is not None
+    assert "done_at" not in store.jobs.find_one({"dedup_key": "retried"})
+
+
+def test_jobs_carry_a_trace_id():
+    store = MemoryJobStore()
+    queue = make_queue(store)
+    seen = {}
+
+    async def handler(payload):
+        seen[payload.get("n")] = tracing.trace_id.get()
+
+    # queued outside of a request
+    queue.enqueue("test", {"n": 1}, dedup_key="one")
+    token = tracing.trace_id.set("delivery-1")
+    try:
+        queue.enqueue("test", {"n": 2}, dedup_key="two")
+    finally:
+        tracing.trace_id.reset(token)
+    # a job stored before the payload carried an id
+    store.put(new_job("test", {"n": 3}, "three", 0, 0))
+
+    run_pool(queue, handler, lambda: len(seen) >= 3)
+    assert seen[1] and seen[1] not in ("delivery-1", seen[3])
+    assert seen[2] == "delivery-1"
+    assert seen[3]
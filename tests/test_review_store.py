@@ -0,0 +1,93 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+
+from review_store import (MemoryReviewStore, MongoReviewStore, ReviewStore, parse_code_score, patch_hash,
+                          reviewing)
+
+START = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def make_doc(i: int, created_at: datetime, repo: str = "org/repo", score: float = None):
+    return {"_id": f"{i:04d}", "repo": repo, "author": "dev", "source": "github", "sha": f"sha{i}",
+            "filename": f"f{i}.py", "review": "ok", "code_score": score, "created_at": created_at}
+
+
+@pytest.fixture(params=["memory", "mongo"])
+def store(request):
+    if request.param == "memory":
+        return ReviewStore(MemoryReviewStore())
+    return ReviewStore(MongoReviewStore(mongomock.MongoClient().db))
+
+
+def read_pages(store, limit, **filters):
+    async def run():
+        seen, cursor = [], None
+        while True:
+            docs, cursor = await store.query(cursor=cursor, limit=limit, **filters)
+            seen.extend(doc["_id"] for doc in docs)
+            if cursor is None:
+                return seen
+    return asyncio.run(run())
+
+
+def test_pages_are_stable_across_equal_timestamps(store):
+    # three reviews per second, the id breaks the tie
+    for i in range(10):
+        store.store.insert(make_doc(i, START + timedelta(seconds=i // 3)))
+    expected = sorted((f"{i:04d}" for i in range(10)), key=lambda _id: (int(_id) // 3, _id), reverse=True)
+    for limit in (1, 3, 4, 10):
+        assert read_pages(store, limit) == expected
+
+
+def test_new_reviews_do_not_shift_the_next_page(store):
+    for i in range(6):
+        store.store.insert(make_doc(i, START + timedelta(seconds=i)))
+
+    async def run():
+        first, cursor = await store.query(limit=3)
+        store.store.insert(make_doc(99, START + timedelta(hours=1)))
+        second, cursor = await store.query(cursor=cursor, limit=3)
+        return [doc["_id"] for doc in first + second]
+
+    assert asyncio.run(run()) == ["0005", "0004", "0003", "0002", "0001", "0000"]
+
+
+def test_filters(store):
+    for i in range(6):
+        store.store.insert(make_doc(i, START + timedelta(minutes=i), repo="org/a" if i % 2 else "org/b",
+                                    score=float(i)))
+    assert read_pages(store, 10, repo="org/a") == ["0005", "0003", "0001"]
+    assert read_pages(store, 10, min_score=2, max_score=4) == ["0004", "0003", "0002"]
+    # aware times are compared as utc
+    since = (START + timedelta(minutes=4)).replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=2)))
+    assert read_pages(store, 10, since=since) == ["0005", "0004"]
+
+
+def test_record_inside_a_review():
+    store = ReviewStore(MemoryReviewStore())
+
+    async def run():
+        # outside of a review job there is nothing to attribute the review to
+        await store.record("a.py", "+a\n", "Code Score: 7", "model-a", tokens=10, latency=1.0)
+        with reviewing({"repo": "org/repo", "sha": "abc", "author": "dev"}):
+            await store.record("a.py", "@@ -1 +1 @@\n+a\n", "Part 1 Code Score: 7\nPart 2 Code Score: 8",
+                               "model-a", tokens=10, latency=1.23456)
+        return await store.query()
+
+    docs, cursor = asyncio.run(run())
+    assert cursor is None
+    assert len(docs) == 1
+    doc = docs[0]
+    assert (doc["repo"], doc["sha"], doc["source"], doc["filename"]) == ("org/repo", "abc", "github", "a.py")
+    assert doc["code_score"] == 7.5
+    assert doc["latency"] == 1.235
+    assert doc["patch_hash"] == patch_hash("@@ -10 +10 @@\n+a\n")
+
+
+def test_parse_code_score():
+    assert parse_code_score("**Code Score:** 8.5/10") == 8.5
+    assert parse_code_score("Code Score: 42") is None
+    assert parse_code_score("no score") is None
@@ -0,0 +1,24 @@
+import serve
+
+
+def test_api_processes_review_without_worker_processes(monkeypatch):
+    monkeypatch.setattr(serve.config, "REVIEW_QUEUE_BACKEND", "mongo")
+    monkeypatch.setattr(serve.config, "API_PROCESSES", 2)
+    monkeypatch.setattr(serve.config, "WORKER_PROCESSES", 0)
+    assert [(name, role) for name, _, role in serve.plan_processes()] == [("api", "all")]
+
+    monkeypatch.setattr(serve.config, "WORKER_PROCESSES", 2)
+    assert [(name, role) for name, _, role in serve.plan_processes()] == \
+        [("api", "api"), ("worker-0", "worker"), ("worker-1", "worker")]
+
+
+def test_the_restart_backoff_starts_over_after_a_stable_run(monkeypatch):
+    supervisor = serve.Supervisor([])
+    now = [1000.0]
+    monkeypatch.setattr(serve.time, "monotonic", lambda: now[0])
+
+    supervisor.started["worker-0"] = now[0]
+    assert [supervisor.restart_delay("worker-0") for _ in range(3)] == [1, 2, 4]
+
+    now[0] += serve.STABLE_SECONDS
+    assert supervisor.restart_delay("worker-0") == 1
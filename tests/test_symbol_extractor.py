@@ -0,0 +1,89 @@
+import pytest
+
+import lsp_utils.lsp as lsp
+import symbol_extractor
+from symbol_extractor import PythonAstExtractor, SymbolExtractors, parse_backends
+
+SOURCE = '''import os
+
+LIMIT = 10
+name = "x"
+
+
+class Client(object):
+    retries = 3
+
+    def __init__(self):
+        self.session = None
+
+    @property
+    def closed(self):
+        def helper():
+            return 1
+        value = helper()
+        return value
+
+
+async def main():
+    pass
+
+
+if os.name == "nt":
+    def windows_only():
+        pass
+'''
+
+
+def outline(symbols):
+    # (name, kind, first line, last line, children)
+    return [(symbol["name"], symbol["kind"], symbol["range"]["start"]["line"], symbol["range"]["end"]["line"],
+             outline(symbol["children"])) for symbol in symbols]
+
+
+def test_python_ast_symbols():
+    symbols = PythonAstExtractor().extract(SOURCE, "client.py")
+    assert outline(symbols) == [
+        ("LIMIT", lsp.SymbolKind.Constant, 2, 2, []),
+        ("name", lsp.SymbolKind.Variable, 3, 3, []),
+        ("Client", lsp.SymbolKind.Class, 6, 17, [
+            ("retries", lsp.SymbolKind.Field, 7, 7, []),
+            ("__init__", lsp.SymbolKind.Constructor, 9, 10, []),
+            # the decorator belongs to the method, locals of a function are no symbols
+            ("closed", lsp.SymbolKind.Method, 12, 17, [("helper", lsp.SymbolKind.Function, 14, 15, [])]),
+        ]),
+        ("main", lsp.SymbolKind.Function, 20, 21, []),
+        ("windows_only", lsp.SymbolKind.Function, 25, 26, []),
+    ]
+    # the selection range points at the name line, not the decorator
+    assert symbols[2]["children"][2]["selectionRange"]["start"]["line"] == 13
+
+
+def test_python_ast_gives_up_on_a_syntax_error():
+    assert PythonAstExtractor().extract("def broken(:\n", "broken.py") is None
+
+
+def test_backends_per_language():
+    assert parse_backends(" python:ast, javascript : tree-sitter,bad,") == {"python": "ast",
+                                                                           "javascript": "tree-sitter"}
+    extractors = SymbolExtractors({"python": "ast", "go": "magic"})
+    assert isinstance(extractors.get("python", "a.py"), PythonAstExtractor)
+    assert extractors.get("python") is extractors.get("python")
+    # the language server stays in charge of the rest
+    assert extractors.get("java", "A.java") is None
+    assert extractors.get("go", "a.go") is None
+
+
+def test_tree_sitter_without_the_package(monkeypatch):
+    monkeypatch.setattr(symbol_extractor, "get_parser", None)
+    assert SymbolExtractors({"javascript": "tree-sitter"}).get("javascript", "a.js") is None
+
+
+def test_tree_sitter_javascript_symbols():
+    pytest.importorskip("tree_sitter_languages")
+    source = "class A {\n  run() {\n    return 1;\n  }\n}\nconst f = () => 1;\nconst LIMIT = 3;\n"
+    symbols = SymbolExtractors({"javascript": "tree-sitter"}).get("javascript", "a.js").extract(source, "a.js")
+    assert outline(symbols) == [
+        ("A", lsp.SymbolKind.Class, 0, 4, [("run", lsp.SymbolKind.Method, 1, 3, [])]),
+        ("f", lsp.SymbolKind.Function, 5, 5, []),
+        ("LIMIT", lsp.SymbolKind.Variable, 6, 6, []),
+    ]
@@ -0,0 +1,79 @@
+import random
+
+import utils
+import lsp_utils.lsp as lsp
+from symbol_index import SymbolIndex
+
+
+def symbol(name, kind, start, end, children=None):
+    result = {"name": name, "kind": kind,
+              "range": {"start": {"line": start, "character": 0}, "end": {"line": end, "character": 0}}}
+    if children is not None:
+        result["children"] = children
+    return result
+
+
+SYMBOLS = [
+    symbol("Outer", lsp.SymbolKind.Class, 0, 40, [
+        symbol("field", lsp.SymbolKind.Field, 1, 1),
+        symbol("method", lsp.SymbolKind.Method, 3, 10, [symbol("local", lsp.SymbolKind.Variable, 4, 4)]),
+        symbol("Inner", lsp.SymbolKind.Class, 12, 30, [
+            symbol("inner_method", lsp.SymbolKind.Method, 14, 20),
+            symbol("empty_namespace", lsp.SymbolKind.Namespace, 22, 25, []),
+        ]),
+        # language servers sometimes report a child outside of its parent
+        symbol("stray", lsp.SymbolKind.Method, 45, 50),
+    ]),
+    symbol("function", lsp.SymbolKind.Function, 42, 60),
+    {"name": "no range", "kind": lsp.SymbolKind.Function},
+    symbol("CONSTANT", lsp.SymbolKind.Constant, 62, 62),
+]
+
+
+def names(paths):
+    return [[item["name"] for item in path] for path in paths]
+
+
+def test_query_matches_the_recursive_search():
+    index = SymbolIndex(SYMBOLS)
+    ranges = [[start, end] for start in range(-1, 65) for end in range(start, min(start + 15, 65))]
+    for line_range, paths in zip(ranges, index.query_all(ranges)):
+        expected = names(utils.get_symbols_intersecting_with_range(SYMBOLS, line_range))
+        assert names(index.path_symbols(path) for path in paths) == expected, line_range
+
+
+def test_examples():
+    index = SymbolIndex(SYMBOLS)
+    # a terminal symbol stops the walk, its children are not reported
+    assert names(map(index.path_symbols, index.query([4, 4]))) == [["Outer", "method"]]
+    # a container without an intersecting child is reported itself
+    assert names(map(index.path_symbols, index.query([26, 27]))) == [["Outer", "Inner"]]
+    # the stray child is only reached while its parent overlaps the range too
+    assert names(map(index.path_symbols, index.query([45, 46]))) == [["function"]]
+    assert index.query([100, 120]) == []
+
+
+def test_random_trees_match_the_recursive_search():
+    rng = random.Random("symbols")
+    kinds = [lsp.SymbolKind.Class, lsp.SymbolKind.Namespace, lsp.SymbolKind.Method, lsp.SymbolKind.Field]
+
+    def make(depth, start, end):
+        children = []
+        line = start
+        while line < end and len(children) < 4:
+            length = rng.randint(0, 8)
+            # overlapping and escaping ranges on purpose
+            child_start = line + rng.randint(-2, 2)
+            kind = rng.choice(kinds)
+            children.append(symbol(f"s{depth}_{line}", kind, child_start, child_start + length,
+                                   make(depth + 1, child_start, child_start + length) if depth < 3 else []))
+            line += length + rng.randint(0, 3)
+        return children
+
+    for _ in range(20):
+        symbols = make(0, 0, 80)
+        index = SymbolIndex(symbols)
+        ranges = sorted([start, start + rng.randint(0, 6)] for start in rng.sample(range(90), 15))
+        for line_range, paths in zip(ranges, index.query_all(ranges)):
+            expected = names(utils.get_symbols_intersecting_with_range(symbols, line_range))
+            assert names(index.path_symbols(path) for path in paths) == expected
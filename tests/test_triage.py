@@ -0,0 +1,49 @@
+import triage
+
+
+def patch(removed, added):
+    lines = [f"@@ -1,{len(removed)} +1,{len(added)} @@"] + [f"-{line}" for line in removed] + [f"+{line}" for line in added]
+    return "\n".join(lines) + "\n"
+
+
+def test_reindented_code_is_whitespace():
+    assert triage.classify(patch(["if x:", "  call()  "], ["if x:", "    call()"]), "app.js") == \
+        (triage.TRIVIAL, "whitespace")
+
+
+def test_reindenting_python_is_a_code_change():
+    # the line moves out of the block
+    assert triage.classify(patch(["    call()"], ["call()"]), "app.py")[0] == triage.SUBSTANTIVE
+    assert triage.classify(patch(["    call()"], ["    call()   "]), "app.py") == (triage.TRIVIAL, "whitespace")
+
+
+def test_whitespace_inside_a_line_is_a_code_change():
+    assert triage.classify(patch(['name = "a b"'], ['name = "ab"']), "app.js")[0] == triage.SUBSTANTIVE
+    assert triage.classify(patch(["return x"], ["returnx"]), "app.js")[0] == triage.SUBSTANTIVE
+
+
+def test_version_bump():
+    assert triage.classify(patch(['  "version": "1.4.2",'], ['  "version": "1.5.0",']), "package.json") == \
+        (triage.MECHANICAL, "version bump")
+    # a changed number that is no version
+    assert triage.classify(patch(["timeout = 1.5"], ["timeout = 2.5"]), "app.py")[0] == triage.SUBSTANTIVE
+
+
+def test_lockfile_update_is_a_version_bump():
+    removed = ['      "version": "4.17.20",',
+               '      "resolved": "https://registry.npmjs.org/lodash/-/lodash-4.17.20.tgz",']
+    added = ['      "version": "4.17.21",',
+             '      "resolved": "https://registry.npmjs.org/lodash/-/lodash-4.17.21.tgz",']
+    assert triage.classify(patch(removed, added), "package-lock.json") == (triage.MECHANICAL, "version bump")
+
+
+def test_reordered_imports_and_moved_code():
+    assert triage.classify(patch(["import os", "import re"], ["import re", "import os"]), "app.py") == \
+        (triage.MECHANICAL, "import reorder")
+    assert triage.classify(patch(["a()", "b()"], ["b()", "a()"]), "app.py")[0] == triage.SUBSTANTIVE
+
+
+def test_renames_and_deletions():
+    assert triage.classify(None, "b.py", "renamed") == (triage.TRIVIAL, "rename")
+    assert triage.classify(patch(["x = 1"], []), "b.py", "removed") == (triage.TRIVIAL, "deleted file")
+    assert triage.classify(patch(["x = 1"], []), "b.py")[0] == triage.SUBSTANTIVE
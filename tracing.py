@@ -0,0 +1,17 @@
+import uuid
+import logging
+import contextvars
+
+# request-scoped id, set by the http middleware and carried into queued jobs through their payload
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+class TraceFormatter(logging.Formatter):
+    # lets log.ini use %(trace_id)s, "-" outside of a request or job
+    def format(self, record):
+        record.trace_id = trace_id.get() or "-"
+        return super().format(record)
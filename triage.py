@@ -0,0 +1,87 @@
+import re
+from collections import Counter
+
+import diff_parser
+from diff_planner import estimate_tokens
+
+TRIVIAL = "trivial"
+MECHANICAL = "mechanical"
+SUBSTANTIVE = "substantive"
+
+# x.y.z anywhere, x.y only on lines that say version, so that a changed 1.5 timeout is not a version bump
+SEMVER_REGEX = re.compile(r'v?\d+\.\d+\.\d+(?:[-+][0-9A-Za-z.-]+)?')
+VERSION_REGEX = re.compile(r'v?\d+(?:\.\d+)+(?:[-+][0-9A-Za-z.-]+)?')
+IMPORT_REGEX = re.compile(r'^\s*(?:import\s|from\s+\S+\s+import\s|#\s*include\s|using\s|require\s*\(|'
+                          r'(?:const|let|var)\s+\S+\s*=\s*require\s*\(|use\s)')
+
+
+def changed_lines(patch: str):
+    added, removed = [], []
+    for hunk in diff_parser.iter_hunks(patch):
+        for kind, _, _, _, text in hunk.lines():
+            if kind == diff_parser.ADDED:
+                added.append(text)
+            elif kind == diff_parser.REMOVED:
+                removed.append(text)
+    return added, removed
+
+
+# indentation is syntax in these, re-indenting a line can move it into or out of a block
+INDENTATION_SENSITIVE = (".py", ".pyx", ".yml", ".yaml", ".coffee", ".pug", ".haml", ".slim", "Makefile")
+
+
+def squash_whitespace(line: str, keep_indent: bool):
+    # only the ends of a line, whitespace between tokens and inside strings can be meaningful
+    if keep_indent:
+        return line.rstrip()
+    return line.strip()
+
+
+def without_versions(line: str):
+    # (line with the version numbers blanked out, how many there were)
+    regex = VERSION_REGEX if "version" in line.lower() else SEMVER_REGEX
+    return regex.subn("#", line)
+
+
+def classify(patch: str, filename: str = "", status: str = "modified"):
+    """Cheap local look at a file diff, returns (decision, reason).
+
+    trivial and mechanical changes do not need the model: whitespace, renames, deleted files,
+    import reordering and version bumps. Removed code is substantive, it may take a check away.
+    """
+    if status == "renamed" and not patch:
+        return TRIVIAL, "rename"
+    if status == "removed":
+        return TRIVIAL, "deleted file"
+    if not patch:
+        return TRIVIAL, "empty diff"
+
+    added, removed = changed_lines(patch)
+    if not added and not removed:
+        return TRIVIAL, "empty diff"
+
+    keep_indent = filename.endswith(INDENTATION_SENSITIVE)
+    squashed_added = Counter(squash_whitespace(line, keep_indent) for line in added)
+    squashed_removed = Counter(squash_whitespace(line, keep_indent) for line in removed)
+    squashed_added.pop("", None)
+    squashed_removed.pop("", None)
+    if squashed_added == squashed_removed:
+        if Counter(added) != Counter(removed):
+            return TRIVIAL, "whitespace"
+        # moving statements around can change behaviour, only moved imports are left out
+        if all(IMPORT_REGEX.match(line) for line in added):
+            return MECHANICAL, "import reorder"
+
+    if len(added) == len(removed):
+        added_versions = [without_versions(line) for line in added]
+        removed_versions = [without_versions(line) for line in removed]
+        if (all(count for _, count in added_versions + removed_versions)
+                and Counter(line for line, _ in added_versions) == Counter(line for line, _ in removed_versions)):
+            return MECHANICAL, "version bump"
+
+    return SUBSTANTIVE, "code change"
+
+
+def saved_tokens(patch: str):
+    # what the skipped request would have cost, prompt side only
+    return estimate_tokens(patch) if patch else 0
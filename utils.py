@@ -1,70 +1,53 @@
-import os
-import re
-import requests
-from config import *
+import logging
+import github_api
+from git_mirror import git_mirror, GitError
 import lsp_utils.lsp as lsp
-
-
-def should_skip_review(filename):
-    # list of file extensions for which review should be skipped
-    skip_extensions = ['.txt', '.json', '.xml', '.csv', '.md', '.log', '.ini', '.yml', '.pyc', '.class', '.cmake']
-
-    asset_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.svg', '.ico', '.eot', '.ttf', '.woff', '.woff2']
-
-    # list of file names to be skipped
-    skip_files = ['README.md', 'LICENSE', '.gitignore', 'package-lock.json', 'yarn.lock', 'Makefile', 'Dockerfile']
-
-    # list of folders to be skipped
-    skip_folders = ['__pycache__', '.git', '.vscode', 'node_modules', 'dist', 'build']
-
-    # get file extension
-    file_extension = os.path.splitext(filename)[-1]
-
-    # get file name
-    file_name = os.path.basename(filename)
-
-    # check if the file is in a skip folder
-    for folder in skip_folders:
-        if folder in filename.split(os.path.sep):
-            return True
-
-    # check if file extension is in the skip list
-    if file_extension in skip_extensions or file_name in skip_files:
-        return True
-
-    if file_extension in asset_extensions:
-        return True
-
-    return False
-
-def download_file(repo_full_name, filename, commit_id):
-    download_url = f"https://api.github.com/repos/{repo_full_name}/contents/{filename}?ref={commit_id}"
-    
-    # logger.info(f"download_file: {download_url}")
-    headers = {
-        "Authorization": f"token {GITHUB_API_TOKEN}",
-        "Accept": "application/vnd.github.v3.raw",
-    }
-    response = requests.get(download_url, headers=headers)
-    response.raise_for_status()  # Raise an exception if the request failed
-
-    return response.text
+import diff_parser
+
+logger = logging.getLogger(__name__)
+
+
+def unreviewable_reason(file_change):
+    # github leaves the patch out for binary files and for diffs too large to show, gitlab flags them
+    if "diff" in file_change:
+        if file_change.get("too_large") or file_change.get("collapsed"):
+            return "truncated"
+        if file_change["diff"].startswith("Binary files"):
+            return "binary"
+        return None
+    if file_change.get("patch"):
+        return None
+    if file_change.get("status") == "renamed" and not file_change.get("changes"):
+        return None
+    if file_change.get("status") == "removed":
+        return None
+    return "truncated" if file_change.get("changes") else "binary"
+
+
+async def download_file(repo_full_name, filename, commit_id):
+    if git_mirror:
+        try:
+            content = await git_mirror.read_file(repo_full_name, commit_id, filename)
+            if content is not None:
+                return content
+        except GitError as e:
+            logger.warning(f"git mirror read of {filename} failed, using the contents api: {e}")
+
+    return await github_api.get_file_content(repo_full_name, filename, commit_id)
 
 def parse_diff(patch):
-    # This regex will match the hunk headers, and capture the start line and line count of the new file
-    hunk_header_regex = re.compile(r'@@ -\d+,\d+ \+(\d+),(\d+) @@')
-
-    # This list will contain all the changed lines
-    changed_lines = []
+    # [start, start + count] of the new file side of every hunk
+    return [hunk.new_range for hunk in diff_parser.iter_hunks(patch)]
 
-    for match in hunk_header_regex.finditer(patch):
-        start_line = int(match.group(1))
-        line_count = int(match.group(2))
 
-        # Add all the lines in the hunk to the list
-        changed_lines.append([start_line, start_line + line_count])
+def split_patch_hunks(patch):
+    # split a patch into the text before the first hunk and the list of hunks, each starting with its header
+    hunks = diff_parser.parse_hunks(patch)
+    if not hunks:
+        return patch, []
 
-    return changed_lines
+    # hunks run up to the next header, so the pieces put back together give the patch
+    return patch[:hunks[0].offset], [hunk.text() for hunk in hunks]
 
 
 def get_language_type(filename):